@@ -0,0 +1,353 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+# Microbenchmarks for the editor's hot paths over generated data. Runs are
+# reproducible for a given --seed and write p50/p99 latency and peak traced
+# memory per case to JSON, so two runs can be compared with --compare.
+#
+#     python benchmarks/run_benchmarks.py
+#     python benchmarks/run_benchmarks.py --max-size 100MB --max-vocabulary 1000000
+#     python benchmarks/run_benchmarks.py --compare benchmarks/results/baseline.json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_engine import TextEngine, bounded_edit_distance
+try:
+    from text_editor import ChunkedFileReader, Document
+except ImportError:
+    # The editor needs tkinter; without it the file cases are skipped
+    ChunkedFileReader = Document = None
+
+CORPUS_SIZES = [10 << 10, 100 << 10, 1 << 20, 10 << 20, 100 << 20]
+VOCABULARY_SIZES = [1000, 10000, 100000, 1000000]
+SENTENCE_COUNTS = [1000, 10000, 100000]
+
+# Share of generated words that get a typo
+TYPO_RATE = 0.05
+
+# A case whose p50 grows by more than this is reported by --compare
+REGRESSION_THRESHOLD = 0.2
+
+# Latency target for word suggestions: a one-edit typo of an English word,
+# not yet cached, within SUGGESTION_TARGET_MS at p50 with up to
+# SUGGESTION_TARGET_VOCABULARY learned words. Cases over target are flagged.
+SUGGESTION_TARGET_MS = 1.0
+SUGGESTION_TARGET_VOCABULARY = 20000
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "an", "el", "or", "us",
+             "ber", "con", "dis", "for", "gra", "men", "pre", "str", "tion", "ing"]
+
+def make_word(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4)))
+
+def make_vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(make_word(rng))
+    return sorted(words)
+
+def add_typo(word, rng):
+    i = rng.randrange(len(word))
+    kind = rng.randrange(3)
+    if kind == 0:
+        return word[:i] + word[i + 1:] or word
+    if kind == 1:
+        return word[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + word[i:]
+    return word[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + word[i + 1:]
+
+def make_sentence(vocabulary, rng):
+    words = [rng.choice(vocabulary) for _ in range(rng.randint(5, 15))]
+    words = [add_typo(word, rng) if rng.random() < TYPO_RATE else word for word in words]
+    return ' '.join(words).capitalize() + '.'
+
+def make_corpus(size, vocabulary, rng):
+    # Paragraphs of 1-6 sentences until the text is size characters long
+    paragraphs = []
+    length = 0
+    while length < size:
+        paragraph = ' '.join(make_sentence(vocabulary, rng) for _ in range(rng.randint(1, 6)))
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 1
+    return '\n'.join(paragraphs)[:size]
+
+def parse_size(text):
+    units = {'KB': 1 << 10, 'MB': 1 << 20, 'GB': 1 << 30, 'B': 1}
+    text = text.strip().upper()
+    for unit, factor in units.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+def format_size(size):
+    for unit, factor in (('MB', 1 << 20), ('KB', 1 << 10)):
+        if size >= factor:
+            return f"{size / factor:g}{unit}"
+    return f"{size}B"
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class BenchmarkRun:
+    def __init__(self, repeat, only=None):
+        self.repeat = repeat
+        self.only = only
+        self.results = []
+
+    def wanted(self, name):
+        return not self.only or any(name.startswith(prefix) for prefix in self.only)
+
+    def measure(self, name, params, func, inputs=None, repeat=None, setup_s=None, reset=None, target_ms=None):
+        # Times func once per input (or repeat times without inputs), then
+        # runs it once more under tracemalloc for the peak memory. reset is
+        # called before that run, so a cache the timed runs filled doesn't
+        # hide the memory a cold call needs
+        if not self.wanted(name):
+            return
+        if inputs is None:
+            inputs = [()] * (repeat or self.repeat)
+        timings = []
+        for args in inputs:
+            started = time.perf_counter()
+            func(*args)
+            timings.append(time.perf_counter() - started)
+
+        if reset:
+            reset()
+        tracemalloc.start()
+        func(*inputs[0])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        result = {
+            'name': name,
+            'params': params,
+            'runs': len(timings),
+            'p50_ms': percentile(timings, 0.5) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000,
+            'mean_ms': sum(timings) / len(timings) * 1000,
+            'peak_memory_bytes': peak,
+        }
+        if setup_s is not None:
+            result['setup_s'] = setup_s
+        flag = ""
+        if target_ms is not None:
+            result['target_ms'] = target_ms
+            result['over_target'] = result['p50_ms'] > target_ms
+            if result['over_target']:
+                flag = f"  OVER TARGET ({target_ms:g} ms)"
+        self.results.append(result)
+        print(f"{name:<28} {json.dumps(params):<32} p50 {result['p50_ms']:10.3f} ms"
+              f"  p99 {result['p99_ms']:10.3f} ms  peak {peak / (1 << 10):10.1f} KB{flag}", flush=True)
+
+def clear_caches(engine):
+    engine.suggestion_cache.clear()
+    engine.spelling_cache.clear()
+    engine.synonym_cache.clear()
+
+def bench_edit_distance(run, vocabulary, rng):
+    # Pairs of a word and a typo of a word, most of them further apart than
+    # the bound, as the suggestion lookups see them
+    pairs = [(rng.choice(vocabulary), add_typo(rng.choice(vocabulary), rng), 2) for _ in range(1000)]
+    run.measure("bounded_edit_distance", {'pairs': len(pairs), 'max_distance': 2},
+                bounded_edit_distance, pairs)
+
+def bench_suggestions(run, model_dir, vocabulary_sizes, rng):
+    for size in vocabulary_sizes:
+        if not run.wanted("get_suggestions"):
+            return
+        vocabulary = make_vocabulary(size, rng)
+        engine = TextEngine(model_dir)
+        engine.build_word_indexes()
+        for word in vocabulary:
+            engine.word_frequency[word] = rng.randint(1, 100)
+        started = time.perf_counter()
+        for word, count in engine.word_frequency.items():
+            engine.vocabulary_index.add(word, count)
+        engine.completion_index.load(engine.word_frequency)
+        build = time.perf_counter() - started
+
+        queries = [(add_typo(rng.choice(vocabulary), rng),) for _ in range(200)]
+        prefixes = [(rng.choice(vocabulary)[:3],) for _ in range(200)]
+        reset = lambda: clear_caches(engine)
+        run.measure("get_suggestions.typo", {'vocabulary': size}, engine.get_suggestions, queries,
+                    setup_s=build, reset=reset)
+        run.measure("get_suggestions.prefix", {'vocabulary': size}, engine.get_suggestions, prefixes,
+                    reset=reset)
+
+def bench_english_suggestions(run, model_dir, vocabulary_sizes, rng):
+    # Typos of English words, with the spell dictionary's most frequent words
+    # as the learned vocabulary: the case the suggestion target is set for
+    if not run.wanted("get_suggestions.english"):
+        return
+    engine = TextEngine(model_dir)
+    engine.build_word_indexes()
+    words = sorted(((word, count) for word, count in engine.spell.word_frequency.items() if word.isalpha()),
+                   key=lambda item: item[1], reverse=True)
+    typos = [(add_typo(word, rng),) for word, count in rng.sample(words[:SUGGESTION_TARGET_VOCABULARY], 200)]
+    learned = 0
+    for size in vocabulary_sizes:
+        if size > len(words):
+            return
+        for word, count in words[learned:size]:
+            engine.word_frequency[word] = count
+            engine.vocabulary_index.add(word, count)
+        learned = size
+        engine.completion_index.load(engine.word_frequency)
+        clear_caches(engine)
+        target = SUGGESTION_TARGET_MS if size <= SUGGESTION_TARGET_VOCABULARY else None
+        run.measure("get_suggestions.english", {'vocabulary': size}, engine.get_suggestions, typos,
+                    reset=lambda: clear_caches(engine), target_ms=target)
+
+def bench_sentence_suggestions(run, model_dir, vocabulary, sentence_counts, rng):
+    for count in sentence_counts:
+        if not run.wanted("get_sentence_suggestions"):
+            return
+        engine = TextEngine(model_dir)
+        paragraphs = [make_sentence(vocabulary, rng) for _ in range(count)]
+        engine.update_ml_models(0, 0, paragraphs)
+        queries = [(' '.join(rng.choice(paragraphs).split()[:6]),) for _ in range(200)]
+        run.measure("get_sentence_suggestions", {'sentences': len(engine.sentence_index)},
+                    engine.get_sentence_suggestions, queries)
+
+def bench_corpus(run, model_dir, corpus, size):
+    params = {'size': format_size(size)}
+    paragraphs = corpus.split('\n')
+    repeat = max(1, min(run.repeat, (10 << 20) // size))
+
+    # Learning a whole document, and then re-learning one edited line of it
+    def learn_document():
+        engine = TextEngine(model_dir)
+        engine.update_ml_models(0, 0, paragraphs)
+    run.measure("update_ml_models.document", params, learn_document, repeat=repeat)
+
+    engine = TextEngine(model_dir)
+    engine.update_ml_models(0, 0, paragraphs)
+    middle = len(paragraphs) // 2
+    edits = [(middle, middle + 1, [paragraphs[middle] + f" edit{i}"]) for i in range(50)]
+    run.measure("update_ml_models.edit", params, engine.update_ml_models, edits)
+
+    run.measure("check_spelling", params, engine.check_text, [(corpus,)] * repeat)
+
+    run.measure("save_ml_models", params, engine.save_ml_models, repeat=repeat)
+    def load_models():
+        TextEngine(model_dir).load_ml_models()
+    run.measure("load_ml_models", params, load_models, repeat=repeat)
+
+    # Opening and saving a file the way the editor does: streamed into the
+    # chunked document, and written back from a snapshot
+    if Document is None:
+        return
+    path = os.path.join(model_dir, "corpus.txt")
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(corpus)
+    def open_file():
+        document = Document()
+        reader = ChunkedFileReader(path)
+        try:
+            text = reader.read_chunk()
+            while text is not None:
+                document.insert(document.length, text)
+                text = reader.read_chunk()
+        finally:
+            reader.close()
+        return document
+    run.measure("open_file", params, open_file, repeat=repeat)
+
+    document = open_file()
+    def save_file():
+        with open(path, 'w', encoding='utf-8') as file:
+            for chunk in document.snapshot().chunks:
+                file.write(chunk)
+            file.write('\n')
+    run.measure("save_file", params, save_file, repeat=repeat)
+
+def compare(results, baseline_path):
+    # Report cases that got slower than the baseline run by more than
+    # REGRESSION_THRESHOLD; returns the number of regressions
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    previous = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in baseline['results']}
+    regressions = 0
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        old = previous.get((result['name'], json.dumps(result['params'], sort_keys=True)))
+        if old is None or not old['p50_ms']:
+            continue
+        change = result['p50_ms'] / old['p50_ms'] - 1
+        if change > REGRESSION_THRESHOLD:
+            regressions += 1
+            print(f"  REGRESSION {result['name']} {json.dumps(result['params'])}: "
+                  f"p50 {old['p50_ms']:.3f} -> {result['p50_ms']:.3f} ms ({change:+.0%})")
+    if not regressions:
+        print("  no regressions")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the editor's hot paths on generated data.")
+    parser.add_argument("--max-size", default="10MB",
+                        help="largest generated corpus, from 10KB up to 100MB (default 10MB)")
+    parser.add_argument("--max-vocabulary", type=int, default=100000,
+                        help="largest vocabulary for get_suggestions, up to 1000000 (default 100000)")
+    parser.add_argument("--max-sentences", type=int, default=100000,
+                        help="largest sentence index for get_sentence_suggestions (default 100000)")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="runs per case that has no natural inputs (default 20)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--only", nargs="*", help="only run cases whose names start with these")
+    parser.add_argument("--output", help="results file (default benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results file to check for regressions")
+    args = parser.parse_args(argv)
+
+    if Document is None:
+        print("tkinter is not available: skipping open_file and save_file", file=sys.stderr)
+    rng = random.Random(args.seed)
+    max_size = parse_size(args.max_size)
+    run = BenchmarkRun(args.repeat, args.only)
+    vocabulary = make_vocabulary(5000, rng)
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        bench_edit_distance(run, vocabulary, rng)
+        bench_suggestions(run, model_dir, [n for n in VOCABULARY_SIZES if n <= args.max_vocabulary], rng)
+        bench_english_suggestions(run, model_dir, [n for n in VOCABULARY_SIZES if n <= args.max_vocabulary], rng)
+        bench_sentence_suggestions(run, model_dir, vocabulary,
+                                   [n for n in SENTENCE_COUNTS if n <= args.max_sentences], rng)
+        for size in CORPUS_SIZES:
+            if size > max_size:
+                break
+            corpus = make_corpus(size, vocabulary, random.Random(args.seed + size))
+            bench_corpus(run, model_dir, corpus, size)
+
+    output = args.output
+    if not output:
+        directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'max_size': max_size,
+        },
+        'results': run.results,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {output}")
+
+    if args.compare:
+        return 1 if compare(run.results, args.compare) else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,385 @@
+import os
+import re
+import sys
+import json
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import text_editor
+from text_editor import (FenwickTree, Document, SentenceBoundaries, EditJournal, delete_ranges,
+                         compile_search, find_replacements, SearchIndex)
+
+PIECES = ["Hello there. ", "How are you?\n", "Fine.\n\n", "ok ", "\n", "\n\n\n", "  ", "The end", ". ", "x"]
+
+def random_text(rng, count):
+    return ''.join(rng.choice(PIECES) for _ in range(count))
+
+class FenwickTreeTest(unittest.TestCase):
+    def test_matches_plain_sums(self):
+        rng = random.Random(1)
+        values = [rng.randint(0, 9) for _ in range(50)]
+        tree = FenwickTree(values)
+        for _ in range(500):
+            if rng.random() < 0.3:
+                values.append(rng.randint(0, 9))
+                tree.append(values[-1])
+            else:
+                i = rng.randrange(len(values))
+                delta = rng.randint(-values[i], 9)
+                values[i] += delta
+                tree.add(i, delta)
+            self.assertEqual(len(tree), len(values))
+            count = rng.randint(0, len(values))
+            self.assertEqual(tree.prefix(count), sum(values[:count]))
+
+    def test_search(self):
+        values = [3, 0, 2, 5]
+        tree = FenwickTree(values)
+        # Position 3 is the first of the value at index 2; the empty
+        # value at index 1 never covers a position
+        self.assertEqual([tree.search(target) for target in range(10)],
+                         [(0, 0)] * 3 + [(2, 3)] * 2 + [(3, 5)] * 5)
+        self.assertEqual(tree.search(10), (4, 10))
+
+class DocumentTest(unittest.TestCase):
+    def assert_matches(self, document, text):
+        self.assertEqual(document.length, len(text))
+        self.assertEqual(document.snapshot().text(), text)
+        lines = text.split('\n')
+        self.assertEqual(document.line_count, len(lines))
+        starts = [0]
+        for line in lines[:-1]:
+            starts.append(starts[-1] + len(line) + 1)
+        self.assertEqual([document.line_start(line) for line in range(len(lines))], starts)
+        for offset in range(0, len(text) + 1, 7):
+            self.assertEqual(document.line_of(offset), text.count('\n', 0, offset))
+        self.assertEqual(document.lines(0, len(lines)), lines)
+
+    def test_edits_match_string(self):
+        # Small chunks, so edits split, merge and span chunks
+        with mock.patch.object(text_editor, 'DOCUMENT_CHUNK_SIZE', 16):
+            rng = random.Random(2)
+            text = random_text(rng, 20)
+            document = Document(text)
+            self.assert_matches(document, text)
+            for step in range(400):
+                version = document.version
+                if rng.random() < 0.6 or not text:
+                    offset = rng.randint(0, len(text))
+                    inserted = random_text(rng, rng.randint(1, 6))
+                    document.insert(offset, inserted)
+                    text = text[:offset] + inserted + text[offset:]
+                else:
+                    start = rng.randrange(len(text))
+                    end = min(len(text), start + rng.randint(1, 60))
+                    document.delete(start, end)
+                    text = text[:start] + text[end:]
+                self.assertEqual(document.version, version + 1)
+                start = rng.randint(0, len(text))
+                self.assertEqual(document.get(start, start + 40), text[start:start + 40])
+                if step % 20 == 0:
+                    self.assert_matches(document, text)
+            self.assert_matches(document, text)
+
+    def test_no_op_edits_keep_version(self):
+        document = Document("abc")
+        document.insert(1, "")
+        document.delete(2, 2)
+        self.assertEqual(document.version, 0)
+
+    def test_snapshot_is_unaffected_by_edits(self):
+        document = Document("one\ntwo")
+        snapshot = document.snapshot()
+        document.insert(3, " more")
+        self.assertEqual(snapshot.text(), "one\ntwo")
+        self.assertEqual(len(snapshot), 7)
+
+class SentenceBoundariesTest(unittest.TestCase):
+    def check_edits(self, rng, steps, exact=True):
+        # Without exact, segments cut at whitespace may be cut elsewhere
+        # than a fresh build would, so only their sizes are checked
+        document = Document(random_text(rng, 50))
+        boundaries = SentenceBoundaries(document)
+        boundaries.sentence_at(0)
+        for step in range(steps):
+            if rng.random() < 0.7 or not document.length:
+                offset = rng.randint(0, document.length)
+                inserted = random_text(rng, rng.randint(1, 3))
+                document.insert(offset, inserted)
+                boundaries.edit(offset, offset, offset + len(inserted))
+            else:
+                start = rng.randrange(document.length)
+                end = min(document.length, start + rng.randint(1, 30))
+                document.delete(start, end)
+                boundaries.edit(start, end, start)
+
+            self.assertEqual(boundaries.lengths.prefix(len(boundaries.sizes)), document.length, step)
+            self.assertTrue(all(0 < size <= text_editor.SENTENCE_SEGMENT_SIZE
+                                for size in boundaries.sizes) or document.length == 0, step)
+            if not exact:
+                continue
+            fresh = SentenceBoundaries(document)
+            fresh.build()
+            self.assertEqual(boundaries.sizes, fresh.sizes, step)
+            for offset in range(0, document.length + 1, max(1, document.length // 20)):
+                self.assertEqual(boundaries.sentence_at(offset), fresh.sentence_at(offset), (step, offset))
+
+    def test_edits_match_fresh_build(self):
+        self.check_edits(random.Random(3), 500)
+
+    def test_long_segments_are_cut(self):
+        with mock.patch.object(text_editor, 'SENTENCE_SEGMENT_SIZE', 40):
+            self.check_edits(random.Random(4), 300, exact=False)
+            document = Document("word " * 100)
+            boundaries = SentenceBoundaries(document)
+            boundaries.build()
+            self.assertTrue(all(size <= 40 for size in boundaries.sizes))
+            self.assertEqual(sum(boundaries.sizes), document.length)
+
+    def test_sentence_spans_lines(self):
+        document = Document("This sentence\nwraps across lines. Next one.")
+        boundaries = SentenceBoundaries(document)
+        self.assertEqual(boundaries.sentence_at(5), (0, 33))
+        self.assertEqual(boundaries.sentence_at(40), (34, 43))
+
+class DeleteRangesTest(unittest.TestCase):
+    # Positions are what Tk's index command gives; the widget's text is the
+    # document plus the newline Tk keeps at the end, and "end" is the
+    # start of the line after it
+    def setUp(self):
+        self.document = Document("a\nb\nc")
+        self.end = (4, 0)
+
+    def test_plain_ranges(self):
+        self.assertEqual(delete_ranges(self.document, [((1, 0), (2, 1))]), [(0, 3)])
+        self.assertEqual(delete_ranges(self.document, [((2, 0), (1, 0))]), [])
+
+    def test_merges_overlapping_ranges(self):
+        self.assertEqual(delete_ranges(self.document, [((3, 0), (3, 1)), ((1, 0), (1, 1)), ((1, 1), (2, 0))]),
+                         [(0, 2), (4, 5)])
+
+    def test_whole_lines_to_end_take_the_newline_before(self):
+        # delete 3.0 end leaves "a\nb"
+        self.assertEqual(delete_ranges(self.document, [((3, 0), self.end)]), [(3, 5)])
+        # delete 2.0 end leaves "a"
+        self.assertEqual(delete_ranges(self.document, [((2, 0), self.end)]), [(1, 5)])
+        # delete 1.0 end has no newline before it to take
+        self.assertEqual(delete_ranges(self.document, [((1, 0), self.end)]), [(0, 5)])
+
+    def test_mid_line_to_end_keeps_the_newline(self):
+        self.assertEqual(delete_ranges(self.document, [((2, 1), self.end)]), [(3, 5)])
+        self.assertEqual(delete_ranges(Document("ab"), [((1, 1), (2, 0))]), [(1, 2)])
+
+    def test_final_empty_line(self):
+        # delete end-1c end on "a\n" removes the newline that ends line 1
+        self.assertEqual(delete_ranges(Document("a\n"), [((2, 0), (3, 0))]), [(1, 2)])
+        self.assertEqual(delete_ranges(Document("ab"), [((1, 2), (2, 0))]), [])
+
+    def test_applied_ranges_match_widget(self):
+        text = "a\nb\nc"
+        for start in range(len(text) + 1):
+            document = Document(text)
+            line = document.line_of(start)
+            position = (line + 1, start - document.line_start(line))
+            for first, last in reversed(delete_ranges(document, [(position, self.end)])):
+                document.delete(first, last)
+            # A range that starts a line also takes the newline before it
+            expected = text[:start - 1] if position[1] == 0 and position[0] > 1 else text[:start]
+            self.assertEqual(document.snapshot().text(), expected, start)
+
+class ReplaceTest(unittest.TestCase):
+    def test_plain_terms_are_literal(self):
+        pattern = compile_search("a.b")
+        self.assertEqual([m.group() for m in pattern.finditer("a.b axb A.B")], ["a.b", "A.B"])
+
+    def test_match_case(self):
+        pattern = compile_search("Word", match_case=True)
+        self.assertEqual([m.start() for m in pattern.finditer("word Word WORD")], [5])
+
+    def test_whole_word(self):
+        pattern = compile_search("cat|dog", regex=True, whole_word=True)
+        self.assertEqual([m.group() for m in pattern.finditer("cat cats dog hotdog")], ["cat", "dog"])
+
+    def test_bad_regex(self):
+        with self.assertRaises(re.error):
+            compile_search("(", regex=True)
+
+    def test_plain_replacement(self):
+        text = "one two one"
+        self.assertEqual(find_replacements(text, compile_search("one"), r"\1"),
+                         [(0, 3, r"\1"), (8, 11, r"\1")])
+
+    def test_regex_replacement_expands_groups(self):
+        text = "John Smith, Jane Doe"
+        edits = find_replacements(text, compile_search(r"(\w+) (\w+)", regex=True), r"\2 \1", regex=True)
+        self.assertEqual(edits, [(0, 10, "Smith John"), (12, 20, "Doe Jane")])
+
+    def test_skips_empty_matches(self):
+        self.assertEqual(find_replacements("abc", compile_search("x*", regex=True), "-", regex=True), [])
+
+    def test_edits_rebuild_sub(self):
+        rng = random.Random(5)
+        pattern = compile_search(r"(e)(\s)", regex=True)
+        for _ in range(50):
+            text = random_text(rng, 10)
+            result = text
+            for start, end, new in reversed(find_replacements(text, pattern, r"<\2\1>", regex=True)):
+                result = result[:start] + new + result[end:]
+            self.assertEqual(result, pattern.sub(r"<\2\1>", text))
+
+class SearchIndexTest(unittest.TestCase):
+    def expected(self, text, term, regex=False, match_case=False, whole_word=False):
+        pattern = compile_search(term, regex, match_case, whole_word)
+        return [match.span() for match in pattern.finditer(text) if match.start() != match.end()]
+
+    def test_typed_queries_match_full_scan(self):
+        # Each query extends the one before, so most are narrowed from the
+        # cached occurrences of a prefix
+        rng = random.Random(6)
+        document = Document(random_text(rng, 200) + "aaaa aAaA")
+        index = SearchIndex()
+        index.update(document)
+        text = document.snapshot().text()
+        for word in ["Hello there", "how are", "aaa", "The end.", "e."]:
+            for match_case in (False, True):
+                for length in range(1, len(word) + 1):
+                    term = word[:length]
+                    self.assertEqual(index.find(term, match_case=match_case),
+                                     self.expected(text, term, match_case=match_case), (term, match_case))
+
+    def test_overlapping_occurrences_are_not_matches(self):
+        document = Document("aaaaa")
+        index = SearchIndex()
+        index.update(document)
+        self.assertEqual(index.find("a"), [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5)])
+        self.assertEqual(index.find("aa"), [(0, 2), (2, 4)])
+        self.assertEqual(index.find("aaa"), [(0, 3)])
+
+    def test_regex_and_whole_word(self):
+        document = Document("cat cats\nconcat cat.")
+        index = SearchIndex()
+        index.update(document)
+        text = document.snapshot().text()
+        self.assertEqual(index.find("cat", whole_word=True), [(0, 3), (16, 19)])
+        self.assertEqual(index.find("c.t", regex=True), self.expected(text, "c.t", regex=True))
+        self.assertEqual(index.find("^c", regex=True), [(0, 1), (9, 10)])
+
+    def test_edits_refresh_the_index(self):
+        document = Document("one\ntwo")
+        index = SearchIndex()
+        index.update(document)
+        self.assertEqual(index.find("two"), [(4, 7)])
+        self.assertEqual(index.line_starts, [0, 4])
+        document.insert(0, "two\n")
+        index.update(document)
+        self.assertEqual(index.find("two"), [(0, 3), (8, 11)])
+        self.assertEqual(index.line_starts, [0, 4, 8])
+
+    def test_cache_is_bounded(self):
+        document = Document("abcdefghijklmnopqrstuvwxyz" * 3)
+        index = SearchIndex()
+        index.update(document)
+        for i in range(40):
+            index.find(document.get(i, i + 2))
+        self.assertLessEqual(len(index.results), text_editor.SEARCH_CACHE_SIZE)
+        self.assertLessEqual(len(index.occurrences), text_editor.SEARCH_CACHE_SIZE)
+
+class EditJournalTest(unittest.TestCase):
+    def setUp(self):
+        # The untitled journal and recovery pointer go to a state directory
+        # that doesn't exist yet
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_dir = os.path.join(self.directory.name, "state")
+        self.defaults = (text_editor.STATE_DIR, text_editor.UNTITLED_JOURNAL)
+        patcher = mock.patch.multiple(text_editor, STATE_DIR=self.state_dir,
+                                      UNTITLED_JOURNAL=os.path.join(self.state_dir, "untitled-1"),
+                                      RECOVERY_FILE=os.path.join(self.state_dir, "recovery.json"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.path = os.path.join(self.directory.name, "notes.txt")
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write("hello world\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replays_edits_over_file(self):
+        journal = EditJournal(self.path, length=12)
+        journal.insert(5, ",")
+        journal.delete(7, 12)
+        journal.insert(7, "there")
+        journal.append(journal.take())
+        with open(text_editor.RECOVERY_FILE, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), {'journal': journal.journal_path})
+        self.assertEqual(EditJournal.recover(journal.journal_path), (self.path, "hello, there\n"))
+
+    def test_ignores_torn_last_line(self):
+        journal = EditJournal(self.path, length=12)
+        journal.insert(0, "oh ")
+        journal.append(journal.take())
+        with open(journal.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(['i', 0, "lost"])[:-4])
+        self.assertEqual(EditJournal.recover(journal.journal_path), (self.path, "oh hello world\n"))
+
+    def test_replays_over_snapshot(self):
+        journal = EditJournal(self.path, length=12)
+        journal.insert(0, "a")
+        journal.append(journal.take())
+        journal.compact(Document("a snapshot").snapshot())
+        journal.insert(10, "!")
+        journal.append(journal.take())
+        self.assertEqual(EditJournal.recover(journal.journal_path), (self.path, "a snapshot!"))
+
+    def test_rejects_changed_file(self):
+        journal = EditJournal(self.path, length=12)
+        journal.insert(0, "x")
+        journal.append(journal.take())
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write("more\n")
+        with self.assertRaises(ValueError):
+            EditJournal.recover(journal.journal_path)
+
+    def test_untitled_journal_in_state_directory(self):
+        journal = EditJournal(None)
+        journal.insert(0, "draft")
+        journal.append(journal.take())
+        self.assertEqual(os.path.dirname(journal.journal_path), self.state_dir)
+        with open(text_editor.RECOVERY_FILE, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), {'journal': journal.journal_path})
+        self.assertEqual(EditJournal.recover(journal.journal_path), (None, "draft"))
+
+    def test_untitled_journal_per_process(self):
+        state_dir, untitled_journal = self.defaults
+        self.assertEqual(os.path.dirname(untitled_journal), state_dir)
+        self.assertIn(str(os.getpid()), os.path.basename(untitled_journal))
+
+    def test_nothing_to_recover(self):
+        journal = EditJournal(None)
+        journal.append(journal.take())
+        self.assertIsNone(EditJournal.recover(journal.journal_path))
+        journal.discard()
+        self.assertFalse(os.path.exists(journal.journal_path))
+        self.assertFalse(os.path.exists(text_editor.RECOVERY_FILE))
+
+class StartupTimingTest(unittest.TestCase):
+    def test_first_suggestion_recorded_once(self):
+        # The editor's methods run against a stand-in, since there is no display
+        editor = mock.Mock(startup_timings={}, suggestion_layout_pending=None)
+        editor.record_startup = lambda stage: text_editor.TextEditor.record_startup(editor, stage)
+        bar = mock.Mock(visible=False, hide_at=None)
+        bar.show.return_value = False
+        text_editor.TextEditor.update_suggestion_bar(editor, bar, [])
+        self.assertEqual(editor.startup_timings, {})
+        bar.show.return_value = True
+        text_editor.TextEditor.update_suggestion_bar(editor, bar, ["word"])
+        first = editor.startup_timings['first_suggestion']
+        text_editor.TextEditor.update_suggestion_bar(editor, bar, ["other"])
+        self.assertEqual(editor.startup_timings, {'first_suggestion': first})
+        editor.profiler.record.assert_called_once_with("startup.first_suggestion", mock.ANY, mock.ANY)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,727 @@
+import os
+import sys
+import json
+import random
+import tempfile
+import unittest
+from collections import Counter
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import text_engine
+from text_engine import (NgramStore, Vocabulary, SymSpellIndex, DictionaryIndex, WriteBehindStore,
+                         TextEngine, PrefixIndex, SentenceIndex, SuggestionCache, SynonymTable,
+                         bounded_edit_distance, count_training_text, read_training_chunks,
+                         tokenize_words, tokenize_sentences, word_ngrams, diff_paragraphs)
+
+def reference_distance(s1, s2):
+    # Optimal string alignment distance over the full table
+    rows = [[max(i, j) if not i or not j else 0 for j in range(len(s2) + 1)] for i in range(len(s1) + 1)]
+    for i in range(1, len(s1) + 1):
+        for j in range(1, len(s2) + 1):
+            rows[i][j] = min(rows[i - 1][j] + 1, rows[i][j - 1] + 1,
+                             rows[i - 1][j - 1] + (s1[i - 1] != s2[j - 1]))
+            if i > 1 and j > 1 and s1[i - 1] == s2[j - 2] and s1[i - 2] == s2[j - 1]:
+                rows[i][j] = min(rows[i][j], rows[i - 2][j - 2] + 1)
+    return rows[-1][-1]
+
+real_open = open
+
+def read_only_open(path, mode='r', *args, **kwargs):
+    # open() for a file system mounted read-only
+    if any(flag in mode for flag in 'wax+'):
+        raise PermissionError(13, "Read-only file system", path)
+    return real_open(path, mode, *args, **kwargs)
+
+def random_word(rng, alphabet="abcde", low=1, high=8):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(low, high)))
+
+class BoundedEditDistanceTest(unittest.TestCase):
+    def test_known_distances(self):
+        self.assertEqual(bounded_edit_distance("kitten", "sitting", 3), 3)
+        self.assertEqual(bounded_edit_distance("form", "from", 1), 1)
+        self.assertEqual(bounded_edit_distance("", "abc", 3), 3)
+        self.assertEqual(bounded_edit_distance("same", "same", 0), 0)
+
+    def test_stops_past_the_bound(self):
+        self.assertEqual(bounded_edit_distance("kitten", "sitting", 2), 3)
+        self.assertEqual(bounded_edit_distance("a", "abcdef", 2), 3)
+
+    def test_matches_full_table(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            s1, s2 = random_word(rng, low=0), random_word(rng, low=0)
+            max_distance = rng.randint(0, 3)
+            expected = min(reference_distance(s1, s2), max_distance + 1)
+            self.assertEqual(bounded_edit_distance(s1, s2, max_distance), expected, (s1, s2, max_distance))
+
+class SymSpellIndexTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(2)
+        self.words = {}
+        while len(self.words) < 300:
+            self.words[random_word(rng, low=2)] = len(self.words) + 1
+        self.queries = [random_word(rng, low=2) for _ in range(200)]
+
+    def test_search_finds_every_word_in_range(self):
+        # With the whole word as prefix the index is exact
+        index = SymSpellIndex(max_distance=2, prefix_length=8)
+        for word, count in self.words.items():
+            index.add(word, count)
+        for query in self.queries:
+            distances = {word: reference_distance(query, word) for word in self.words}
+            for max_distance in range(3):
+                expected = {word: distance for word, distance in distances.items() if distance <= max_distance}
+                self.assertEqual(dict(index.search(query, max_distance)), expected, query)
+
+    def test_lookup_orders_by_distance_then_count(self):
+        index = SymSpellIndex()
+        for word, count in (("hello", 5), ("hallo", 9), ("help", 20), ("hell", 1)):
+            index.add(word, count)
+        self.assertEqual(index.lookup("hello"), [("hello", 0), ("hallo", 1), ("hell", 1), ("help", 2)])
+        self.assertEqual(index.lookup("hello", limit=2), [("hello", 0), ("hallo", 1)])
+
+    def test_lookup_matches_exhaustive_ranking(self):
+        # Lookups stop once they have enough matches; the counts are distinct,
+        # so there is only one right answer
+        counts = {word: i + 1 for i, word in enumerate(self.words)}
+        index = SymSpellIndex(max_distance=2, prefix_length=8)
+        for word, count in counts.items():
+            index.add(word, count)
+        for query in self.queries:
+            ranked = sorted((reference_distance(query, word), -count, word) for word, count in counts.items())
+            for limit in (1, 3, 10):
+                expected = [(word, distance) for distance, count, word in ranked if distance <= 2][:limit]
+                self.assertEqual(index.lookup(query, limit=limit), expected, (query, limit))
+
+    def test_nearest_lookup(self):
+        index = SymSpellIndex()
+        for word, count in (("hello", 5), ("hallo", 9), ("help", 20)):
+            index.add(word, count)
+        self.assertEqual(index.lookup("hellp", nearest=True), [("help", 1), ("hello", 1)])
+        self.assertEqual(index.lookup("hallp"), [("hallo", 1), ("help", 2), ("hello", 2)])
+        self.assertEqual(index.lookup("hallp", nearest=True), [("hallo", 1)])
+
+    def test_remove(self):
+        index = SymSpellIndex(prefix_length=8)
+        for word, count in self.words.items():
+            index.add(word, count)
+        removed = list(self.words)[::2]
+        for word in removed:
+            index.remove(word)
+        reference = SymSpellIndex(prefix_length=8)
+        for word, count in self.words.items():
+            if word not in removed:
+                reference.add(word, count)
+        self.assertEqual(len(index), len(reference))
+        for query in self.queries:
+            self.assertEqual(sorted(index.search(query, 2)), sorted(reference.search(query, 2)))
+
+    def test_max_words(self):
+        index = SymSpellIndex(max_words=2)
+        self.assertTrue(index.add("one"))
+        self.assertTrue(index.add("two"))
+        self.assertFalse(index.add("three"))
+        self.assertTrue(index.add("one"))
+        self.assertEqual(index.words, {"one": 2, "two": 1})
+
+class DictionaryIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "dictionary_index.bin")
+        rng = random.Random(3)
+        words = set()
+        while len(words) < 500:
+            words.add(random_word(rng, "abcdefg", 2, 10))
+        # Distinct counts, so both indexes rank ties the same way
+        self.dictionary = [(word, 1000 - i) for i, word in enumerate(sorted(words))]
+        self.queries = [random_word(rng, "abcdefg", 2, 10) for _ in range(200)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_lookup_matches_symspell_index(self):
+        self.assertEqual(DictionaryIndex.write(self.path, self.dictionary), len(self.dictionary))
+        index = DictionaryIndex.open(self.path)
+        self.assertIsNotNone(index)
+        self.assertEqual(len(index), len(self.dictionary))
+        self.assertEqual(index.fingerprint, DictionaryIndex.fingerprint_of(self.dictionary))
+        reference = SymSpellIndex()
+        for word, count in self.dictionary:
+            reference.add(word, count)
+        for query in self.queries:
+            for max_distance in range(3):
+                self.assertEqual(index.lookup(query, max_distance), reference.lookup(query, max_distance),
+                                 (query, max_distance))
+
+    def test_keeps_most_frequent_words(self):
+        DictionaryIndex.write(self.path, self.dictionary, max_words=10)
+        index = DictionaryIndex.open(self.path)
+        self.assertEqual([index.word(i) for i in range(len(index))], [word for word, count in self.dictionary[:10]])
+
+    def test_fingerprint_follows_counts(self):
+        changed = list(self.dictionary)
+        changed[0] = (changed[0][0], changed[0][1] + 1)
+        self.assertNotEqual(DictionaryIndex.fingerprint_of(changed), DictionaryIndex.fingerprint_of(self.dictionary))
+
+    def test_open_rejects_other_files(self):
+        self.assertIsNone(DictionaryIndex.open(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'not an index' * 10)
+        self.assertIsNone(DictionaryIndex.open(self.path))
+
+class PrefixIndexTest(unittest.TestCase):
+    def assert_completes(self, index, counts, prefix, limit=None):
+        # Ties may come in any order, so compare the ranked counts
+        found = index.complete(prefix, limit)
+        expected = sorted((count for word, count in counts.items() if word.startswith(prefix)), reverse=True)
+        self.assertEqual([counts[word] for word in found], expected[:index.k][:limit], prefix)
+        self.assertTrue(all(word.startswith(prefix) for word in found))
+        self.assertEqual(len(set(found)), len(found))
+
+    def test_completions_follow_counts(self):
+        rng = random.Random(7)
+        counts = Counter()
+        for _ in range(400):
+            counts[random_word(rng, "abc", 1, 6)] += rng.randint(1, 20)
+        index = PrefixIndex(k=5)
+        index.load(counts)
+        prefixes = ["a", "ab", "b", "ca", "abc", "cc"]
+        for prefix in prefixes:
+            self.assert_completes(index, counts, prefix)
+        # Counts change after the top words of those prefixes were cached
+        for step in range(500):
+            word = random_word(rng, "abc", 1, 6)
+            count = rng.randint(1, 30)
+            counts[word] += count
+            index.add(word, count)
+            if step % 25 == 0:
+                for prefix in prefixes:
+                    self.assert_completes(index, counts, prefix)
+                    self.assert_completes(index, counts, prefix, limit=2)
+
+    def test_small_ranges_are_not_cached(self):
+        index = PrefixIndex(k=3)
+        index.load({"car": 1, "cat": 5, "dog": 2})
+        self.assertEqual(index.complete("ca"), ["cat", "car"])
+        self.assertEqual(index.top, {})
+        self.assertEqual(index.complete(""), [])
+        self.assertEqual(index.complete("x"), [])
+
+SENTENCE_WORDS = ["river", "stone", "bright", "morning", "quiet", "garden", "letter", "window",
+                  "the", "a", "of", "is", "was", "and"]
+
+def random_sentence(rng):
+    return ' '.join(rng.choice(SENTENCE_WORDS) for _ in range(rng.randint(3, 9))).capitalize() + '.'
+
+class SentenceIndexTest(unittest.TestCase):
+    def assert_consistent(self, index):
+        # Postings and document frequencies match the stored sentences
+        postings = {}
+        frequency = Counter()
+        for sentence_id, (text, terms) in index.sentences.items():
+            self.assertEqual(terms, index.features(text))
+            for feature in terms:
+                postings.setdefault(feature, set()).add(sentence_id)
+                frequency[feature] += 1
+        self.assertEqual({feature: set(ids) for feature, ids in index.postings.items()}, postings)
+        self.assertEqual(dict(index.document_frequency), dict(frequency))
+
+    def ranked(self, index, text, limit):
+        # Every stored sentence scored by cosine similarity
+        query, query_norm = index.weigh(index.features(text))
+        scored = []
+        for sentence_id, (candidate, terms) in index.sentences.items():
+            weights, norm = index.weigh(terms)
+            dot = sum(weight * weights.get(feature, 0) for feature, weight in query.items())
+            if dot:
+                scored.append((dot / (norm * query_norm), sentence_id, candidate))
+        scored.sort(reverse=True)
+        return [candidate for score, sentence_id, candidate in scored[:limit]]
+
+    def test_matches_exhaustive_ranking(self):
+        rng = random.Random(8)
+        index = SentenceIndex(max_candidates=10000)
+        for _ in range(300):
+            index.add(random_sentence(rng))
+        for _ in range(50):
+            query = random_sentence(rng)
+            self.assertEqual(index.similar(query, 3), self.ranked(index, query, 3), query)
+
+    def test_probing_is_bounded(self):
+        index = SentenceIndex(max_candidates=5)
+        for i in range(50):
+            index.add("river stone %d" % i)
+        self.assertEqual(len(index.similar("river stone", 10)), 5)
+        self.assertEqual(index.similar("the and of", 3), [])
+
+    def test_evicts_oldest(self):
+        rng = random.Random(9)
+        index = SentenceIndex(max_sentences=20)
+        added = [random_sentence(rng) for _ in range(60)]
+        for text in added:
+            index.add(text)
+        self.assertEqual(index.texts(), added[-20:])
+        self.assert_consistent(index)
+
+    def test_remove_drops_latest_copy(self):
+        index = SentenceIndex()
+        index.add("Quiet garden.")
+        index.add("Bright window.")
+        index.add("Quiet garden.")
+        index.remove("Quiet garden.")
+        self.assertEqual(index.texts(), ["Quiet garden.", "Bright window."])
+        index.remove("Quiet garden.")
+        index.remove("Never added.")
+        self.assertEqual(index.texts(), ["Bright window."])
+        self.assert_consistent(index)
+
+    def test_random_updates_stay_consistent(self):
+        rng = random.Random(10)
+        index = SentenceIndex(max_sentences=50)
+        for _ in range(500):
+            if index.sentences and rng.random() < 0.3:
+                index.remove(rng.choice(index.texts()))
+            else:
+                index.add(random_sentence(rng))
+        self.assert_consistent(index)
+
+class SuggestionCacheTest(unittest.TestCase):
+    def test_least_recently_used_go_first(self):
+        evicted = []
+        cache = SuggestionCache(max_size=2, on_evict=evicted.append)
+        cache.get("a", str.upper)
+        cache.get("b", str.upper)
+        cache.get("a", str.upper)
+        cache.get("c", str.upper)
+        self.assertEqual(list(cache.entries), ["a", "c"])
+        self.assertEqual(evicted, ["b"])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_entries_expire(self):
+        cache = SuggestionCache(ttl=10)
+        calls = []
+        compute = lambda key: calls.append(key) or key
+        with mock.patch('text_engine.time.monotonic', return_value=100.0):
+            cache.get("a", compute)
+        with mock.patch('text_engine.time.monotonic', return_value=105.0):
+            cache.get("a", compute)
+        with mock.patch('text_engine.time.monotonic', return_value=111.0):
+            cache.get("a", compute)
+        self.assertEqual(calls, ["a", "a"])
+
+    def test_invalidate_and_clear_report_evictions(self):
+        evicted = []
+        cache = SuggestionCache(on_evict=evicted.append)
+        for key in "abc":
+            cache.get(key, str.upper)
+        cache.invalidate(["b", "x"])
+        self.assertEqual((evicted, cache.invalidations), (["b"], 1))
+        cache.clear()
+        self.assertEqual((sorted(evicted), cache.invalidations, len(cache)), (["a", "b", "c"], 3, 0))
+
+class SuggestionInvalidationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = TextEngine(self.directory.name)
+        # Spelling corrections need the dictionary, and never depend on
+        # what was learned
+        self.engine.spelling_corrections = lambda word: []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def uncached(self, word):
+        engine = self.engine
+        return engine.completion_index.complete(word) + [w for w, distance in engine.vocabulary_index.lookup(word)]
+
+    def test_cached_lists_follow_learning(self):
+        rng = random.Random(11)
+        queries = [random_word(rng, "abcd", 1, 5) for _ in range(40)]
+        for step in range(600):
+            self.engine.learn_word(random_word(rng, "abcd", 2, 6))
+            query = rng.choice(queries)
+            cached = self.engine.suggestion_cache.get(query, self.engine.rank_suggestions)
+            self.assertEqual(cached, self.uncached(query), (step, query))
+        self.assertGreater(self.engine.suggestion_cache.hits, 0)
+
+class SynonymTableTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "synonyms.bin")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        rng = random.Random(12)
+        entries = {}
+        for _ in range(300):
+            word = random_word(rng, "abcdé", 1, 7)
+            entries[word] = [random_word(rng, "abcdé", 1, 7) for _ in range(rng.randint(1, 4))]
+        words = set(entries).union(*entries.values())
+        self.assertEqual(SynonymTable.write(self.path, entries), len(words))
+        table = SynonymTable.open(self.path)
+        for word in words:
+            i = table.find(word.encode('utf-8'))
+            self.assertIsNotNone(i, word)
+            self.assertEqual(table.synonyms_of(i), list(dict.fromkeys(entries.get(word, ()))), word)
+        self.assertIsNone(table.find("zzz".encode('utf-8')))
+
+    def test_lookup(self):
+        SynonymTable.write(self.path, {"cat": ["feline", "kitty"], "box": ["crate", "chest"],
+                                       "fly": ["soar"], "run": ["sprint", "dash"]})
+        table = SynonymTable.open(self.path)
+        self.assertEqual(table.lookup("Cat"), ["feline", "kitty"])
+        # Words without an entry are looked up by their base forms
+        self.assertEqual(table.lookup("cats"), ["feline", "kitty"])
+        self.assertEqual(table.lookup("boxes"), ["crate", "chest"])
+        self.assertEqual(table.lookup("flies"), ["soar"])
+        self.assertEqual(table.lookup("running"), [])
+        self.assertEqual(table.lookup("runs"), ["sprint", "dash"])
+        self.assertEqual(table.lookup("feline"), [])
+        self.assertEqual(table.lookup("dog"), [])
+
+    def test_open_rejects_other_files(self):
+        self.assertIsNone(SynonymTable.open(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'not a table' * 10)
+        self.assertIsNone(SynonymTable.open(self.path))
+
+class ParagraphLearningTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def engine(self, name):
+        model_dir = os.path.join(self.directory.name, name)
+        os.makedirs(model_dir, exist_ok=True)
+        return TextEngine(model_dir)
+
+    def test_diff_paragraphs(self):
+        self.assertEqual(diff_paragraphs(["a", "b", "c"], ["a", "x", "c"]), (1, 2, 2))
+        self.assertEqual(diff_paragraphs(["a", "b"], ["a", "b", "c"]), (2, 2, 3))
+        self.assertEqual(diff_paragraphs(["a", "b", "c"], ["c"]), (0, 2, 0))
+        self.assertEqual(diff_paragraphs(["a", "a"], ["a", "a", "a"]), (2, 2, 3))
+        self.assertEqual(diff_paragraphs(["a"], ["a"]), (1, 1, 1))
+
+    def models(self, engine, paragraphs):
+        counts = {}
+        for name, n in (('bigrams', 2), ('trigrams', 3)):
+            store = getattr(engine, name)
+            for paragraph in paragraphs:
+                for ngram in word_ngrams(tokenize_words(paragraph.lower()), n):
+                    counts[name, ngram[:-1]] = dict(store.most_common(ngram[:-1], 1000))
+        return counts, sorted(engine.sentence_index.texts())
+
+    def test_edits_match_learning_from_scratch(self):
+        rng = random.Random(14)
+        lines = [random_sentence(rng) for _ in range(30)]
+        engine = self.engine("edited")
+        engine.update_ml_models(0, 0, lines)
+        seen = list(lines)
+        for _ in range(200):
+            start = rng.randint(0, len(lines))
+            end = min(len(lines), start + rng.randint(0, 3))
+            new = [random_sentence(rng) if rng.random() < 0.7 else lines[rng.randrange(len(lines))]
+                   for _ in range(rng.randint(0, 3))] if lines else [random_sentence(rng)]
+            # The editor passes the current text of the lines around an edit
+            first = max(0, start - 1)
+            engine.update_ml_models(first, end, lines[first:start] + new)
+            lines[start:end] = new
+            seen.extend(new)
+        self.assertEqual(engine.document_paragraphs, lines)
+
+        reference = self.engine("fresh")
+        reference.update_ml_models(0, 0, lines)
+        self.assertEqual(self.models(engine, seen), self.models(reference, seen))
+
+        # The logged deltas replay to the same models
+        engine.flush()
+        replayed = self.engine("edited")
+        replayed.load_ml_models()
+        self.assertEqual(self.models(replayed, seen), self.models(reference, seen))
+
+    def test_forget_document_keeps_what_was_learned(self):
+        engine = self.engine("models")
+        engine.update_ml_models(0, 0, ["The river is quiet."])
+        engine.forget_document()
+        engine.update_ml_models(0, 0, ["The garden is bright."])
+        self.assertEqual(dict(engine.bigrams.most_common(("is",), 5)), {"quiet": 1, "bright": 1})
+
+class TrainingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.corpus = os.path.join(self.directory.name, "corpus")
+        os.makedirs(os.path.join(self.corpus, "sub"))
+        rng = random.Random(13)
+        self.paragraphs = []
+        for name in ("a.txt", os.path.join("sub", "b.txt")):
+            lines = [' '.join(random_sentence(rng) for _ in range(rng.randint(1, 3))) for _ in range(60)]
+            lines[5] = ""
+            with open(os.path.join(self.corpus, name), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            self.paragraphs.extend(lines)
+        with open(os.path.join(self.corpus, "c.bin"), 'wb') as f:
+            f.write(b'river\0stone')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def engine(self, name):
+        model_dir = os.path.join(self.directory.name, name)
+        os.makedirs(model_dir, exist_ok=True)
+        return TextEngine(model_dir)
+
+    def train(self, engine, processes=1):
+        # Small chunks, so counts from many chunks are merged
+        with mock.patch.object(text_engine, 'read_training_chunks',
+                               lambda files: read_training_chunks(files, chunk_size=500)):
+            return engine.train([self.corpus], processes=processes)
+
+    def ngram_counts(self, engine):
+        counts = {}
+        for name, n in (('bigrams', 2), ('trigrams', 3)):
+            store = getattr(engine, name)
+            contexts = {tuple(ngram[:-1]) for paragraph in self.paragraphs
+                        for ngram in word_ngrams(tokenize_words(paragraph.lower()), n)}
+            for context in contexts:
+                counts[name, context] = dict(store.most_common(context, 1000))
+        return counts
+
+    def test_count_training_text(self):
+        text = '\n'.join(self.paragraphs[:20])
+        result = count_training_text(text, 0.5)
+        words = result['words']
+        tokens = [token for paragraph in self.paragraphs[:20] for token in tokenize_words(paragraph.lower())]
+        self.assertEqual(dict(zip(words, result['counts'].tolist())), dict(Counter(tokens)))
+        self.assertEqual(result['tokens'], len(tokens))
+        for key, n in (('bigrams', 2), ('trigrams', 3)):
+            rows, counts = result[key]
+            found = {tuple(words[i] for i in row): count for row, count in zip(rows.tolist(), counts.tolist())}
+            expected = Counter(ngram for paragraph in self.paragraphs[:20]
+                               for ngram in word_ngrams(tokenize_words(paragraph.lower()), n))
+            self.assertEqual(found, dict(expected), key)
+        self.assertEqual(result['sentences'], [sentence for paragraph in self.paragraphs[:20]
+                                               for sentence in tokenize_sentences(paragraph)])
+
+    def test_sentence_sample(self):
+        text = '\n'.join(self.paragraphs)
+        with mock.patch.object(text_engine, 'TRAINING_SENTENCE_SAMPLE', 5):
+            first = count_training_text(text, 0.25)['sentences']
+            self.assertEqual(len(first), 5)
+            self.assertEqual(count_training_text(text, 0.25)['sentences'], first)
+        everything = set(count_training_text(text, 0.25)['sentences'])
+        self.assertTrue(set(first) <= everything)
+
+    def test_train_matches_learning(self):
+        engine = self.engine("trained")
+        stats = self.train(engine)
+        reference = self.engine("learned")
+        reference.update_ml_models(0, 0, self.paragraphs)
+        self.assertEqual(self.ngram_counts(engine), self.ngram_counts(reference))
+
+        tokens = [token for paragraph in self.paragraphs for token in tokenize_words(paragraph.lower())]
+        self.assertEqual(dict(engine.word_frequency), dict(Counter(token for token in tokens if token.isalpha())))
+        sentences = [sentence for paragraph in self.paragraphs for sentence in tokenize_sentences(paragraph)]
+        self.assertEqual(sorted(engine.sentence_index.texts()), sorted(sentences))
+        self.assertEqual(stats, {'files': 2, 'bytes': sum(os.path.getsize(os.path.join(self.corpus, name))
+                                                          for name in ("a.txt", os.path.join("sub", "b.txt"))),
+                                 'words': len(tokens), 'sentences': len(sentences), 'cancelled': False})
+
+        # The models were saved
+        loaded = self.engine("trained")
+        loaded.load_word_frequency()
+        loaded.load_ml_models()
+        self.assertEqual(self.ngram_counts(loaded), self.ngram_counts(engine))
+        self.assertEqual(dict(loaded.word_frequency), dict(engine.word_frequency))
+
+    def test_sentence_reservoir_is_bounded(self):
+        engine = self.engine("trained")
+        engine.sentence_index.max_sentences = 10
+        stats = self.train(engine)
+        sentences = {sentence for paragraph in self.paragraphs for sentence in tokenize_sentences(paragraph)}
+        self.assertEqual(len(engine.sentence_index), 10)
+        self.assertEqual(stats['sentences'], 10)
+        self.assertTrue(set(engine.sentence_index.texts()) <= sentences)
+
+    def test_processes_match_inline(self):
+        inline = self.engine("inline")
+        self.train(inline)
+        pooled = self.engine("pooled")
+        self.train(pooled, processes=2)
+        self.assertEqual(self.ngram_counts(pooled), self.ngram_counts(inline))
+        self.assertEqual(dict(pooled.word_frequency), dict(inline.word_frequency))
+        self.assertEqual(pooled.sentence_index.texts(), inline.sentence_index.texts())
+
+    def test_cancel(self):
+        engine = self.engine("trained")
+        cancelled = mock.Mock()
+        cancelled.is_set.return_value = True
+        stats = self.train(engine)
+        self.assertFalse(stats['cancelled'])
+        stats = engine.train([self.corpus], processes=1, cancelled=cancelled)
+        self.assertTrue(stats['cancelled'])
+
+class NgramStoreTest(unittest.TestCase):
+    def assert_matches(self, store, reference):
+        contexts = {context for context, word in reference}
+        for context in contexts:
+            expected = {word: count for (c, word), count in reference.items() if c == context and count > 0}
+            self.assertEqual(dict(store.most_common(context, len(expected) + 5)), expected, context)
+            if expected:
+                top = store.most_common(context, 2)
+                self.assertEqual([count for word, count in top],
+                                 sorted(expected.values(), reverse=True)[:2])
+
+    def test_matches_counter(self):
+        rng = random.Random(4)
+        vocabulary = Vocabulary()
+        store = NgramStore(3, vocabulary, merge_after=7)
+        reference = Counter()
+        words = ["a", "b", "c", "d", "e", "f"]
+        for step in range(3000):
+            context = (rng.choice(words), rng.choice(words))
+            word = rng.choice(words)
+            weight = 1
+            if reference[context, word] > 0 and rng.random() < 0.4:
+                weight = -rng.randint(1, reference[context, word])
+            store.add(context, word, weight)
+            reference[context, word] += weight
+            if step % 250 == 0:
+                self.assert_matches(store, reference)
+        store.merge()
+        self.assertEqual(store.overlay, {})
+        self.assertEqual(len(store), sum(1 for count in reference.values() if count > 0))
+        self.assert_matches(store, reference)
+
+    def test_unknown_context(self):
+        store = NgramStore(2, Vocabulary())
+        store.add(("a",), "b", 1)
+        self.assertEqual(store.most_common(("z",), 3), [])
+
+    def test_budget_evicts_lowest_counts(self):
+        vocabulary = Vocabulary()
+        store = NgramStore(2, vocabulary, merge_after=1000, budget=10)
+        for i in range(20):
+            store.add(("w%d" % i,), "next", i + 1)
+        store.merge()
+        self.assertLessEqual(len(store), 10)
+        kept = {context for context in range(20) if store.most_common(("w%d" % context,), 1)}
+        self.assertEqual(kept, set(range(20 - len(store), 20)))
+
+        # An evicted entry comes back with at least what it had after aging
+        store.add(("w5",), "next", 1)
+        store.merge()
+        self.assertGreaterEqual(store.most_common(("w5",), 1)[0][1], 1 + 3)
+
+    def fill_rounds(self, store, decay):
+        # A high count that is never used again, then rounds of entries
+        # that are each used twice, every round over budget
+        store.add(("old",), "x", 8)
+        store.merge(decay=decay)
+        for round in range(3):
+            for i in range(4):
+                store.add(("new%d_%d" % (round, i),), "x", 2)
+            store.merge(decay=decay)
+
+    def test_budget_evicts_stale_entries_first(self):
+        store = NgramStore(2, Vocabulary(), merge_after=1000, budget=4)
+        self.fill_rounds(store, text_engine.DECAY_FACTOR)
+        self.assertEqual(store.most_common(("old",), 1), [])
+        self.assertEqual(len(store), 3)
+        self.assertTrue(all(store.most_common(("new2_%d" % i,), 1) for i in range(1, 4)))
+
+        # Without aging the stale entry outlasts every recent one
+        store = NgramStore(2, Vocabulary(), merge_after=1000, budget=4)
+        self.fill_rounds(store, 1)
+        self.assertEqual(store.most_common(("old",), 1), [("x", 8)])
+
+class VocabularyBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = TextEngine(self.directory.name)
+        self.engine.budgets['vocabulary'] = 4
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_stale_words_are_evicted_first(self):
+        for _ in range(8):
+            self.engine.learn_word("old")
+        for round in range(3):
+            for i in range(4):
+                self.engine.learn_word("new%d%d" % (round, i))
+                self.engine.learn_word("new%d%d" % (round, i))
+        self.assertNotIn("old", self.engine.word_frequency)
+        self.assertLessEqual(len(self.engine.word_frequency), 4)
+        self.assertIn("new23", self.engine.word_frequency)
+        self.assertNotIn("old", self.engine.vocabulary_index)
+
+class WriteBehindStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "model.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replays_log_after_snapshot(self):
+        store = WriteBehindStore(self.path)
+        store.record({'a': 1})
+        store.flush()
+        store.compact({'a': 1})
+        store.record({'b': 2})
+        store.record({'c': 3})
+        store.flush()
+
+        reopened = WriteBehindStore(self.path)
+        self.assertEqual(reopened.load(), ({'a': 1}, [{'b': 2}, {'c': 3}]))
+        self.assertEqual(reopened.seq, 3)
+
+    def test_cuts_torn_line(self):
+        store = WriteBehindStore(self.path)
+        store.record({'a': 1})
+        store.flush()
+        with open(store.log_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps([2, {'b': 2}])[:-3])
+
+        reopened = WriteBehindStore(self.path)
+        with open(store.log_path, 'rb') as f:
+            log = f.read()
+        self.assertEqual(reopened.load(), (None, [{'a': 1}]))
+        # Loading leaves the file alone; the next flush cuts the torn line
+        with open(store.log_path, 'rb') as f:
+            self.assertEqual(f.read(), log)
+        reopened.record({'c': 3})
+        reopened.flush()
+
+        payload, deltas = WriteBehindStore(self.path).load(with_seq=True)
+        self.assertEqual(deltas, [(1, {'a': 1}), (2, {'c': 3})])
+
+    def test_loads_read_only_log(self):
+        store = WriteBehindStore(self.path)
+        store.record({'a': 1})
+        store.flush()
+        with open(store.log_path, 'a', encoding='utf-8') as f:
+            f.write('[2, {"b"')
+        with mock.patch('builtins.open', read_only_open):
+            self.assertEqual(WriteBehindStore(self.path).load(), (None, [{'a': 1}]))
+
+    def test_skips_deltas_in_snapshot(self):
+        # A crash between writing the snapshot and emptying the log
+        store = WriteBehindStore(self.path)
+        store.record({'a': 1})
+        store.flush()
+        with open(store.log_path, encoding='utf-8') as f:
+            log = f.read()
+        store.compact({'a': 1})
+        with open(store.log_path, 'w', encoding='utf-8') as f:
+            f.write(log)
+        self.assertEqual(WriteBehindStore(self.path).load(), ({'a': 1}, []))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,25 +4,930 @@ import os
 from tkinter import *
 import json
 from datetime import datetime
-from spellchecker import SpellChecker
-import nltk
-from nltk.corpus import wordnet
-from collections import defaultdict, Counter
+import time
+import sys
+from collections import OrderedDict
 import re
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import pandas as pd
-from nltk.tokenize import word_tokenize, sent_tokenize
-from nltk.util import ngrams
-
-# Download required NLTK data
-try:
-    nltk.data.find('corpora/wordnet')
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('wordnet')
-    nltk.download('punkt')
+import queue
+import threading
+import multiprocessing
+import bisect
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from text_engine import (TextEngine, find_misspelled_spans, split_text, tokenize_sentences,
+                         PARALLEL_SPELLCHECK_SIZE, SPELLCHECK_CHUNK_SIZE, MODEL_BUDGETS)
+
+# The language models live in text_engine; pyspellchecker, nltk and
+# scikit-learn are imported on first use, off the startup path
+STARTUP_STARTED = time.perf_counter()
+
+# Startup budgets in seconds: until the window is drawn, and until the
+# models are loaded and suggestions can be made. The first suggestion shown
+# is timed as a startup stage too, but it waits for the user to start typing,
+# so it has no budget.
+STARTUP_BUDGET = {'first_paint': 0.5, 'models_ready': 3.0}
+STARTUP_STAGES = ('first_paint', 'models_ready', 'first_suggestion')
+
+# Misspellings found by a bulk spell check are tagged this many at a time
+SPELLCHECK_TAG_BATCH = 500
+
+# Files of at least LARGE_FILE_SIZE bytes are streamed into the editor,
+# LOAD_CHUNK_SIZE characters at a time
+LARGE_FILE_SIZE = 8 << 20
+LOAD_CHUNK_SIZE = 1 << 18
+
+# Target size of the chunks the in-memory document is stored in
+DOCUMENT_CHUNK_SIZE = 4096
+
+# The sentence index segments the text after blank lines and after lines
+# that end a sentence, which sentences never cross; longer segments are cut
+# at whitespace into pieces of at most SENTENCE_SEGMENT_SIZE characters.
+# Edits larger than SENTENCE_REINDEX_SIZE characters drop the sentence index
+# instead of patching it; it is rebuilt when next needed.
+SENTENCE_BREAK = re.compile(r'\n\s*\n|[.!?]["\')\]]*[ \t]*\n')
+SENTENCE_SEGMENT_SIZE = 4096
+SENTENCE_REINDEX_SIZE = 1 << 16
+
+# Find keeps match lists for this many recent queries, and highlights
+# matches in batches of this many tags
+SEARCH_CACHE_SIZE = 16
+SEARCH_TAG_BATCH = 1000
+
+# Suggestion bars have a fixed number of buttons that are relabelled in place
+WORD_SUGGESTION_SLOTS = 5
+SENTENCE_SUGGESTION_SLOTS = 3
+
+# Showing or hiding a suggestion bar re-lays out the window, so that happens
+# at most once per SUGGESTION_LAYOUT_INTERVAL (ms), and a bar that runs out of
+# suggestions stays up for SUGGESTION_HIDE_DELAY (ms) in case the next
+# keystroke brings some back
+SUGGESTION_LAYOUT_INTERVAL = 16
+SUGGESTION_HIDE_DELAY = 500
+
+# Live spell checking waits this long (ms) after the last edit or scroll
+LIVE_SPELLCHECK_DELAY = 300
+
+# Per-user directory for the settings, untitled journals and recovery
+# pointer, so they don't depend on the directory the editor was started in
+STATE_DIR = os.path.join(os.environ.get('APPDATA') or os.environ.get('XDG_CONFIG_HOME')
+                         or os.path.join(os.path.expanduser('~'), '.config'), 'text-editor')
+SETTINGS_FILE = os.path.join(STATE_DIR, "editor_settings.json")
+
+# Edits are appended to a journal next to the open file every
+# AUTOSAVE_INTERVAL ms. Once JOURNAL_COMPACT_SIZE bytes of edits have been
+# appended, the whole document is saved next to it instead and the journal
+# starts over. Untitled documents are journaled in STATE_DIR, one journal per
+# editor process so two editors don't write to the same one, and
+# RECOVERY_FILE points at the journal to recover after a crash.
+AUTOSAVE_INTERVAL = 2000
+JOURNAL_COMPACT_SIZE = 1 << 20
+UNTITLED_JOURNAL = os.path.join(STATE_DIR, f"untitled-{os.getpid()}")
+RECOVERY_FILE = os.path.join(STATE_DIR, "recovery.json")
+
+# Learning from edits waits until typing pauses for this long (ms)
+LEARNING_DELAY = 250
+
+# Work deferred from event handlers runs in slices of at most SCHEDULER_SLICE
+# ms, leaving the rest of each 16 ms frame for input and redraws. Cursor and
+# status updates run first, then suggestions, then background work such as
+# learning and live spell checking.
+SCHEDULER_SLICE = 8
+PRIORITY_CURSOR = 0
+PRIORITY_SUGGESTIONS = 1
+PRIORITY_BACKGROUND = 2
+
+# How often (ms) buffered model changes are appended to disk
+FLUSH_INTERVAL = 5000
+
+# How often (ms) the performance overlay refreshes, and how many of the
+# slowest stages it lists
+PERF_OVERLAY_INTERVAL = 1000
+PERF_OVERLAY_STAGES = 6
+
+# How often (ms) the status bar shows the progress of training from a folder
+TRAINING_PROGRESS_INTERVAL = 200
+
+def compile_search(term, regex=False, match_case=False, whole_word=False):
+    # Pattern for a find/replace term; raises re.error for a bad regex
+    pattern = term if regex else re.escape(term)
+    if whole_word:
+        pattern = r'\b(?:' + pattern + r')\b'
+    flags = re.MULTILINE if match_case else re.MULTILINE | re.IGNORECASE
+    return re.compile(pattern, flags)
+
+def find_replacements(text, pattern, replacement, regex=False):
+    # (start, end, new text) for every non-empty match, in one pass over the
+    # text; regex replacements may use group references like \1
+    edits = []
+    for match in pattern.finditer(text):
+        if match.start() == match.end():
+            continue
+        new = match.expand(replacement) if regex else replacement
+        edits.append((match.start(), match.end(), new))
+    return edits
+
+def spans_to_indices(spans, line_starts, first_line=1):
+    # Converts character spans to a flat list of Tk "line.column" index pairs;
+    # line_starts holds the offset of each line, the first being first_line
+    indices = []
+    for start, end in spans:
+        line = bisect.bisect_right(line_starts, start) - 1
+        column = start - line_starts[line]
+        indices.append(f"{first_line + line}.{column}")
+        indices.append(f"{first_line + line}.{column + end - start}")
+    return indices
+
+def delete_ranges(document, positions):
+    # Sorted, merged character ranges of document that a Tk text delete of
+    # (first, last) 1-based (line, column) position pairs removes. Tk keeps
+    # the newline that ends the text: a range running to the line after it
+    # (the "end" index) stops before it, and if the range starts a line the
+    # newline before it is deleted instead, so whole lines go.
+    ranges = []
+    for (first_line, first_column), (last_line, last_column) in sorted(positions):
+        if (first_line, first_column) >= (last_line, last_column):
+            continue
+        first = min(document.line_start(first_line - 1) + first_column, document.length)
+        last = min(document.line_start(last_line - 1) + last_column, document.length)
+        if last_line > document.line_count and first_column == 0 and first_line > 1:
+            first -= 1
+        if first >= last:
+            continue
+        if ranges and first <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(last, ranges[-1][1]))
+        else:
+            ranges.append((first, last))
+    return ranges
+
+class SpellCheckJob:
+    # A whole-document spell check running on its own thread. Misspelled
+    # words are turned into batches of Tk index pairs and queued for the Tk
+    # loop to tag; progress and cancellation are shared through this object.
+    def __init__(self, snapshot, spell):
+        self.snapshot = snapshot
+        self.text = None
+        self.spell = spell
+        self.cancelled = threading.Event()
+        self.results = queue.Queue()
+        self.progress = 0.0
+        self.misspelled = 0
+        self.line_starts = [0]
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            self.text = self.snapshot.text()
+            self.line_starts.extend(match.end() for match in re.finditer('\n', self.text))
+            chunks = list(split_text(self.text, SPELLCHECK_CHUNK_SIZE))
+            if len(self.text) >= PARALLEL_SPELLCHECK_SIZE:
+                self.check_in_processes(chunks)
+            else:
+                for i, (offset, chunk) in enumerate(chunks):
+                    if self.cancelled.is_set():
+                        break
+                    self.report(find_misspelled_spans(chunk, offset, self.spell), i + 1, len(chunks))
+        finally:
+            self.text = None
+            self.results.put(None)
+
+    def check_in_processes(self, chunks):
+        # Workers are spawned rather than forked: forking copies the Tk
+        # interpreter and the locks held by the editor's other threads
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(find_misspelled_spans, chunk, offset) for offset, chunk in chunks]
+            # Results are consumed in document order so offsets stay sorted
+            for i, future in enumerate(futures):
+                if self.cancelled.is_set():
+                    for pending in futures[i:]:
+                        pending.cancel()
+                    break
+                self.report(future.result(), i + 1, len(chunks))
+
+    def report(self, spans, done, total):
+        self.misspelled += len(spans)
+        for i in range(0, len(spans), SPELLCHECK_TAG_BATCH):
+            self.results.put(spans_to_indices(spans[i:i + SPELLCHECK_TAG_BATCH], self.line_starts))
+        self.progress = done / total
+
+class ChunkedFileReader:
+    # Streams a text file in decoded chunks so a large file is never held in
+    # memory as one string. Undecodable bytes become U+FFFD instead of
+    # aborting the load.
+    def __init__(self, path, chunk_size=LOAD_CHUNK_SIZE, encoding='utf-8'):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+        self.file = open(path, 'r', encoding=encoding, errors='replace')
+
+    @property
+    def progress(self):
+        if not self.size or self.file.closed:
+            return 1.0
+        return min(1.0, self.file.buffer.tell() / self.size)
+
+    def read_chunk(self):
+        # The next chunk of text, or None at the end of the file
+        return self.file.read(self.chunk_size) or None
+
+    def close(self):
+        self.file.close()
+
+def write_atomically(path, chunks):
+    # Write through a temporary file so a crash never leaves a truncated file.
+    # A symlink is written through to its target, and the new file keeps the
+    # old one's permissions and, where allowed, its owner.
+    path = os.path.realpath(path)
+    temp_path = path + ".tmp"
+    try:
+        stat = os.stat(path)
+    except OSError:
+        stat = None
+    with open(temp_path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        if stat is not None:
+            os.chmod(temp_path, stat.st_mode & 0o7777)
+            if hasattr(os, 'chown'):
+                try:
+                    os.chown(temp_path, stat.st_uid, stat.st_gid)
+                except OSError:
+                    pass
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+class EditJournal:
+    # Append-only record of the inserts and deletes made to a document since
+    # its base: the file it was opened from or last saved to (as many
+    # characters of it as the editor held), an empty document, or after
+    # compaction a full copy saved next to the journal. The first line
+    # describes the base and every other line is one edit, so autosaving
+    # costs the size of the edits. Edits are buffered on the Tk thread; the
+    # file methods run on the editor's journal thread.
+    def __init__(self, path, length=0):
+        self.path = path
+        self.journal_path = EditJournal.journal_for(path)
+        self.snapshot_path = EditJournal.snapshot_for(self.journal_path)
+        self.header = {'file': path, 'base': 'empty', 'length': length}
+        if path and os.path.exists(path):
+            stat = os.stat(path)
+            self.header.update(base='file', size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        self.pending = []
+        self.size = 0
+        self.started = False
+
+    @staticmethod
+    def journal_for(path):
+        return (path if path else UNTITLED_JOURNAL) + ".journal"
+
+    @staticmethod
+    def snapshot_for(journal_path):
+        return journal_path[:-len(".journal")] + ".autosave"
+
+    def insert(self, offset, text):
+        self.pending.append(json.dumps(['i', offset, text]) + '\n')
+
+    def delete(self, start, end):
+        self.pending.append(json.dumps(['d', start, end]) + '\n')
+
+    def take(self):
+        # The buffered edits as journal lines, to hand to append()
+        lines = ''.join(self.pending)
+        self.pending = []
+        self.size += len(lines)
+        return lines
+
+    def needs_compaction(self):
+        return self.size >= JOURNAL_COMPACT_SIZE
+
+    def append(self, lines):
+        if not self.started:
+            self.start(self.header)
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def start(self, header):
+        # Replace any journal at this path with one over a new base
+        os.makedirs(STATE_DIR, exist_ok=True)
+        write_atomically(self.journal_path, [json.dumps(header) + '\n'])
+        if header['base'] != 'snapshot' and os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+        write_atomically(RECOVERY_FILE, [json.dumps({'journal': self.journal_path})])
+        self.started = True
+
+    def compact(self, snapshot):
+        # Save the whole document next to the journal, then restart the
+        # journal from it. Until the rename, the old journal still applies.
+        write_atomically(self.snapshot_path, snapshot.chunks)
+        self.start({'file': self.path, 'base': 'snapshot', 'length': snapshot.length})
+
+    def discard(self):
+        EditJournal.remove(self.journal_path)
+
+    @staticmethod
+    def remove(journal_path):
+        for path in (journal_path, EditJournal.snapshot_for(journal_path)):
+            if os.path.exists(path):
+                os.remove(path)
+        try:
+            with open(RECOVERY_FILE, 'r', encoding='utf-8') as f:
+                if json.load(f).get('journal') == journal_path:
+                    os.remove(RECOVERY_FILE)
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def recover(journal_path):
+        # (file path, text) after replaying a journal over its base, or None
+        # if there is nothing to recover. Raises ValueError when the base
+        # file changed after the journal was started.
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            lines = f.readlines()
+        if not lines and header['base'] != 'snapshot':
+            return None
+        
+        text = ''
+        if header['base'] == 'snapshot':
+            with open(EditJournal.snapshot_for(journal_path), 'r', encoding='utf-8', newline='') as f:
+                text = f.read()
+        elif header['base'] == 'file':
+            stat = os.stat(header['file'])
+            if (stat.st_size, stat.st_mtime_ns) != (header['size'], header['mtime_ns']):
+                raise ValueError(f"{header['file']} changed after the unsaved edits were made")
+            with open(header['file'], 'r', encoding='utf-8', errors='replace') as f:
+                text = f.read()
+        document = Document(text[:header['length']])
+        for line in lines:
+            try:
+                kind, a, b = json.loads(line)
+            except ValueError:
+                # The last line may have been cut short by the crash
+                break
+            if kind == 'i':
+                document.insert(a, b)
+            else:
+                document.delete(a, b)
+        return header['file'], document.snapshot().text()
+
+class FenwickTree:
+    # Prefix sums over a list of numbers with O(log n) updates and searches
+    def __init__(self, values=()):
+        # Built in O(n) by pushing each node's sum up to its parent
+        self.tree = [0]
+        self.tree.extend(values)
+        for i in range(1, len(self.tree)):
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def append(self, value):
+        i = len(self.tree)
+        self.tree.append(value + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+
+    def add(self, index, delta):
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, count):
+        # Sum of the first count values
+        total = 0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def search(self, target):
+        # The index of the value covering position target, and the sum of
+        # the values before it
+        index, total = 0, 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            if index + step < len(self.tree) and total + self.tree[index + step] <= target:
+                index += step
+                total += self.tree[index]
+            step >>= 1
+        return index, total
+
+class DocumentSnapshot:
+    # Immutable view of a Document; chunks are plain strings, so taking one is
+    # only a copy of the chunk list and it can be read from any thread
+    def __init__(self, chunks, length):
+        self.chunks = chunks
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def text(self):
+        return ''.join(self.chunks)
+
+class Document:
+    # In-memory copy of the text widget's contents, kept in sync with every
+    # insert and delete. Text is stored in chunks of roughly DOCUMENT_CHUNK_SIZE
+    # characters with Fenwick trees over their lengths and newline counts, so
+    # offset and line lookups are O(log n), edits only copy one chunk and
+    # snapshots never copy the text itself.
+    def __init__(self, text=''):
+        self.set_text(text)
+
+    def set_text(self, text):
+        self.version = 0
+        self.chunks = [text[i:i + DOCUMENT_CHUNK_SIZE]
+                       for i in range(0, len(text), DOCUMENT_CHUNK_SIZE)] or ['']
+        self.rebuild()
+
+    def rebuild(self):
+        self.lengths = FenwickTree(len(chunk) for chunk in self.chunks)
+        self.newlines = FenwickTree(chunk.count('\n') for chunk in self.chunks)
+
+    @property
+    def length(self):
+        return self.lengths.prefix(len(self.chunks))
+
+    @property
+    def line_count(self):
+        return self.newlines.prefix(len(self.chunks)) + 1
+
+    def locate(self, offset):
+        # The chunk holding offset and that chunk's start; the end of the
+        # document belongs to the last chunk
+        if offset >= self.length:
+            last = len(self.chunks) - 1
+            return last, self.lengths.prefix(last)
+        return self.lengths.search(offset)
+
+    def insert(self, offset, text):
+        if not text:
+            return
+        self.version += 1
+        i, start = self.locate(offset)
+        chunk = self.chunks[i]
+        local = offset - start
+        merged = chunk[:local] + text + chunk[local:]
+        if len(merged) <= 2 * DOCUMENT_CHUNK_SIZE:
+            self.chunks[i] = merged
+            self.lengths.add(i, len(text))
+            self.newlines.add(i, text.count('\n'))
+            return
+        
+        pieces = [merged[j:j + DOCUMENT_CHUNK_SIZE] for j in range(0, len(merged), DOCUMENT_CHUNK_SIZE)]
+        if i == len(self.chunks) - 1:
+            # Appending (e.g. loading a file) extends the trees in place
+            self.chunks[i] = pieces[0]
+            self.lengths.add(i, len(pieces[0]) - len(chunk))
+            self.newlines.add(i, pieces[0].count('\n') - chunk.count('\n'))
+            for piece in pieces[1:]:
+                self.chunks.append(piece)
+                self.lengths.append(len(piece))
+                self.newlines.append(piece.count('\n'))
+        else:
+            self.chunks[i:i + 1] = pieces
+            self.rebuild()
+
+    def delete(self, start, end):
+        end = min(end, self.length)
+        if start >= end:
+            return
+        self.version += 1
+        i, chunk_start = self.locate(start)
+        chunk = self.chunks[i]
+        if end - chunk_start <= len(chunk):
+            removed = chunk[start - chunk_start:end - chunk_start]
+            self.chunks[i] = chunk[:start - chunk_start] + chunk[end - chunk_start:]
+            self.lengths.add(i, -len(removed))
+            self.newlines.add(i, -removed.count('\n'))
+            if not self.chunks[i] and len(self.chunks) > 1:
+                del self.chunks[i]
+                self.rebuild()
+            return
+        
+        # Deletes spanning chunks keep the head of the first and the tail of
+        # the last chunk
+        j, last_start = self.locate(end)
+        head = chunk[:start - chunk_start]
+        tail = self.chunks[j][end - last_start:]
+        self.chunks[i:j + 1] = [piece for piece in (head, tail) if piece] or ['']
+        if len(self.chunks) > 1 and '' in self.chunks:
+            self.chunks.remove('')
+        self.rebuild()
+
+    def get(self, start, end):
+        end = min(end, self.length)
+        if start >= end:
+            return ''
+        i, chunk_start = self.locate(start)
+        parts = []
+        while chunk_start < end:
+            chunk = self.chunks[i]
+            parts.append(chunk[max(0, start - chunk_start):end - chunk_start])
+            chunk_start += len(chunk)
+            i += 1
+        return ''.join(parts)
+
+    def line_start(self, line):
+        # Offset of the first character of a 0-based line
+        if line <= 0:
+            return 0
+        if line >= self.line_count:
+            return self.length
+        i, before = self.newlines.search(line - 1)
+        chunk = self.chunks[i]
+        position = -1
+        for _ in range(line - before):
+            position = chunk.find('\n', position + 1)
+        return self.lengths.prefix(i) + position + 1
+
+    def line_of(self, offset):
+        # 0-based line holding offset
+        i, start = self.locate(offset)
+        return self.newlines.prefix(i) + self.chunks[i].count('\n', 0, offset - start)
+
+    def lines(self, start, end):
+        # The text of 0-based lines start to end (exclusive)
+        end = min(end, self.line_count)
+        if start >= end:
+            return []
+        stop = self.line_start(end) - 1 if end < self.line_count else self.length
+        return self.get(self.line_start(start), stop).split('\n')
+
+    def snapshot(self):
+        return DocumentSnapshot(tuple(self.chunks), self.length)
+
+class SentenceBoundaries:
+    # Sentence offsets of a Document. The text is split into short segments
+    # (see SENTENCE_BREAK), with a Fenwick tree over their lengths to find
+    # the one holding an offset in O(log n). Each segment is split into
+    # sentences on first use and again only after an edit touches it.
+    def __init__(self, document):
+        self.document = document
+        self.segments = None
+
+    def split(self, text):
+        # Segment lengths of text, each including its trailing line breaks
+        lengths = []
+        start = 0
+        for match in SENTENCE_BREAK.finditer(text):
+            self.cut(text, start, match.end(), lengths)
+            start = match.end()
+        if start < len(text) or not lengths:
+            self.cut(text, start, len(text), lengths)
+        return lengths
+
+    def cut(self, text, start, end, lengths):
+        # Lengths of text[start:end] in pieces of at most
+        # SENTENCE_SEGMENT_SIZE, cut after the last whitespace that fits
+        while end - start > SENTENCE_SEGMENT_SIZE:
+            limit = start + SENTENCE_SEGMENT_SIZE
+            space = max(text.rfind(' ', start, limit), text.rfind('\n', start, limit))
+            stop = space + 1 if space > start else limit
+            lengths.append(stop - start)
+            start = stop
+        lengths.append(end - start)
+
+    def build(self):
+        self.sizes = self.split(self.document.snapshot().text())
+        self.segments = [None] * len(self.sizes)
+        self.lengths = FenwickTree(self.sizes)
+
+    def edit(self, start, old_end, new_end):
+        # Characters start to old_end were replaced by start to new_end.
+        # Re-split the segments the edit touched, with one neighbour on
+        # each side in case it joined or split them.
+        if self.segments is None:
+            return
+        if max(old_end, new_end) - start > SENTENCE_REINDEX_SIZE:
+            self.segments = None
+            return
+        first = max(0, min(self.lengths.search(start)[0], len(self.segments)) - 1)
+        first_start = self.lengths.prefix(first)
+        last = min(self.lengths.search(old_end)[0] + 1, len(self.segments) - 1)
+        old_length = self.lengths.prefix(last + 1) - first_start
+        
+        new_length = old_length + new_end - old_end
+        lengths = self.split(self.document.get(first_start, first_start + new_length))
+        if len(lengths) == last + 1 - first:
+            for i, length in enumerate(lengths, first):
+                self.lengths.add(i, length - self.sizes[i])
+                self.sizes[i] = length
+                self.segments[i] = None
+        else:
+            self.sizes[first:last + 1] = lengths
+            self.segments[first:last + 1] = [None] * len(lengths)
+            self.lengths = FenwickTree(self.sizes)
+
+    def sentences(self, i, start):
+        # (start, end) offsets of segment i's sentences, relative to start
+        if self.segments[i] is None:
+            text = self.document.get(start, start + self.sizes[i])
+            spans = []
+            position = 0
+            for sentence in tokenize_sentences(text):
+                sentence_start = text.find(sentence, position)
+                if sentence_start < 0:
+                    continue
+                position = sentence_start + len(sentence)
+                spans.append((sentence_start, position))
+            self.segments[i] = spans
+        return self.segments[i]
+
+    def sentence_at(self, offset):
+        # (start, end) of the sentence holding offset, counting the offset
+        # just after its last character, or None between sentences
+        if self.segments is None:
+            self.build()
+        i, start = self.lengths.search(offset)
+        if i >= len(self.segments):
+            i = len(self.segments) - 1
+            start = self.lengths.prefix(i)
+        spans = self.sentences(i, start)
+        j = bisect.bisect_right(spans, (offset - start, float('inf'))) - 1
+        if j >= 0 and spans[j][1] >= offset - start:
+            return start + spans[j][0], start + spans[j][1]
+        return None
+
+class SearchIndex:
+    # Text and line offsets of one document version, plus the matches of
+    # recent queries on it. Plain-text queries that extend a cached query
+    # only re-check that query's matches instead of rescanning the text.
+    def __init__(self):
+        self.version = None
+        self.text = ''
+        self.line_starts = [0]
+        self.results = OrderedDict()
+        self.occurrences = OrderedDict()
+
+    def update(self, document):
+        if document.version == self.version:
+            return
+        self.version = document.version
+        self.text = document.snapshot().text()
+        self.line_starts = [0]
+        self.line_starts.extend(match.end() for match in re.finditer('\n', self.text))
+        self.results.clear()
+        self.occurrences.clear()
+
+    def find(self, term, regex=False, match_case=False, whole_word=False):
+        # Non-overlapping (start, end) spans, as re.finditer would give them
+        key = (term, regex, match_case, whole_word)
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+        
+        pattern = compile_search(term, regex, match_case, whole_word)
+        if regex or whole_word:
+            spans = [match.span() for match in pattern.finditer(self.text)
+                     if match.start() != match.end()]
+        else:
+            spans = []
+            end = 0
+            for start in self.find_occurrences(term, match_case, pattern):
+                if start >= end:
+                    end = start + len(term)
+                    spans.append((start, end))
+        
+        self.results[key] = spans
+        if len(self.results) > SEARCH_CACHE_SIZE:
+            self.results.popitem(last=False)
+        return spans
+
+    def find_occurrences(self, term, match_case, pattern):
+        # Start of every occurrence of a plain term, overlapping ones included.
+        # Each one begins with an occurrence of any prefix of the term, so the
+        # longest cached prefix narrows the candidates.
+        key = (term, match_case)
+        if key in self.occurrences:
+            self.occurrences.move_to_end(key)
+            return self.occurrences[key]
+        
+        base = None
+        for (prefix, prefix_case), starts in self.occurrences.items():
+            if prefix_case == match_case and term.startswith(prefix):
+                if base is None or len(prefix) > len(base[0]):
+                    base = (prefix, starts)
+        
+        if base is not None:
+            starts = [start for start in base[1] if pattern.match(self.text, start)]
+        else:
+            starts = []
+            match = pattern.search(self.text)
+            while match:
+                starts.append(match.start())
+                match = pattern.search(self.text, match.start() + 1)
+        
+        self.occurrences[key] = starts
+        if len(self.occurrences) > SEARCH_CACHE_SIZE:
+            self.occurrences.popitem(last=False)
+        return starts
+
+class SuggestionBar:
+    # A suggestion frame with a fixed pool of buttons. show() relabels only
+    # the buttons whose suggestion changed and packs or unpacks only the
+    # trailing buttons that came into or out of use. Whether the frame itself
+    # is on screen is left to the editor, which batches those changes.
+    def __init__(self, frame, buttons_frame, slots, command):
+        self.frame = frame
+        self.command = command
+        self.buttons = [ttk.Button(buttons_frame, style='Toolbar.TButton',
+                                   command=lambda i=i: self.choose(i))
+                        for i in range(slots)]
+        self.labels = [None] * slots
+        self.values = [None] * slots
+        self.used = 0
+        self.disabled = 0
+        self.wanted = False
+        self.visible = False
+        self.hide_at = None
+
+    def choose(self, i):
+        if self.values[i] is not None:
+            self.command(self.values[i])
+
+    def show(self, suggestions):
+        # Returns whether there is anything to show. Without suggestions the
+        # old buttons stay in place, disabled, until the bar is hidden.
+        suggestions = suggestions[:len(self.buttons)]
+        self.values = list(suggestions) + [None] * (len(self.buttons) - len(suggestions))
+        if not suggestions:
+            for button in self.buttons[self.disabled:self.used]:
+                button.state(['disabled'])
+            self.disabled = max(self.disabled, self.used)
+            return False
+        
+        for button in self.buttons[:self.disabled]:
+            button.state(['!disabled'])
+        self.disabled = 0
+        
+        for i, suggestion in enumerate(suggestions):
+            if self.labels[i] != suggestion:
+                self.buttons[i].configure(text=suggestion)
+                self.labels[i] = suggestion
+        for button in self.buttons[self.used:len(suggestions)]:
+            button.pack(side=LEFT, padx=2)
+        for button in self.buttons[len(suggestions):self.used]:
+            button.pack_forget()
+        self.used = len(suggestions)
+        return True
+
+class MainLoopScheduler:
+    # Runs deferred UI work from the Tk main loop. Requests are keyed:
+    # requesting a key that is still waiting replaces it rather than queueing
+    # a second run, and its delay starts over, so bursts of events collapse
+    # into one run. Due tasks run highest priority first until the slice's
+    # time is up. A task that returns a generator is resumed one step at a
+    # time, across as many slices as it needs.
+    def __init__(self, root, profiler):
+        self.root = root
+        self.profiler = profiler
+        self.tasks = {}
+        self.running = {}
+        self.sequence = 0
+        self.pending = None
+        self.pending_due = None
+
+    def request(self, key, func, *args, priority=PRIORITY_SUGGESTIONS, delay=0):
+        # A new request supersedes the task's unfinished run
+        self.cancel(key)
+        self.sequence += 1
+        self.tasks[key] = (priority, time.perf_counter() + delay / 1000, self.sequence, func, args)
+        self.wake()
+
+    def cancel(self, key):
+        self.tasks.pop(key, None)
+        running = self.running.pop(key, None)
+        if running:
+            running[2].close()
+
+    def shutdown(self):
+        for key in list(self.tasks) + list(self.running):
+            self.cancel(key)
+        if self.pending:
+            self.root.after_cancel(self.pending)
+            self.pending = None
+
+    def wake(self):
+        # Make sure a slice is scheduled for when the next task is due
+        if self.running:
+            due = 0
+        elif self.tasks:
+            due = min(task[1] for task in self.tasks.values())
+        else:
+            return
+        if self.pending:
+            if self.pending_due <= due:
+                return
+            self.root.after_cancel(self.pending)
+        delay = max(0, int((due - time.perf_counter()) * 1000 + 0.999))
+        self.pending_due = due
+        if delay:
+            self.pending = self.root.after(delay, self.run_slice)
+        else:
+            self.pending = self.root.after_idle(self.run_slice)
+
+    def run_slice(self):
+        self.pending = None
+        deadline = time.perf_counter() + SCHEDULER_SLICE / 1000
+        with self.profiler.span("scheduler.slice"):
+            while True:
+                now = time.perf_counter()
+                ready = [(task[0], task[2], key) for key, task in self.tasks.items() if task[1] <= now]
+                ready.extend((task[0], task[1], key) for key, task in self.running.items())
+                if not ready:
+                    break
+                priority, sequence, key = min(ready)
+                with self.profiler.span("task." + key):
+                    try:
+                        if key in self.running:
+                            next(self.running[key][2])
+                        else:
+                            func, args = self.tasks.pop(key)[3:]
+                            result = func(*args)
+                            if hasattr(result, '__next__'):
+                                self.running[key] = (priority, sequence, result)
+                                next(result)
+                    except StopIteration:
+                        self.running.pop(key, None)
+                    except:
+                        # A failing task must not stop the others
+                        self.running.pop(key, None)
+                if time.perf_counter() >= deadline:
+                    break
+        self.wake()
+
+class BackgroundWorker:
+    # Runs language jobs on a single background thread so they never block the
+    # Tk main loop. One thread keeps the models single-owner: every job that
+    # reads or writes them is serialised. Submitting a job under a key cancels
+    # the older job with that key, and stale results are never delivered.
+    def __init__(self, root, poll_interval=30):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="editor-worker")
+        self.results = queue.Queue()
+        self.generations = {}
+        self.pending = {}
+        self.root.after(self.poll_interval, self.poll)
+
+    def submit(self, key, func, *args, callback=None):
+        # Jobs without a key (e.g. learning a word) are never coalesced
+        generation = None
+        if key is not None:
+            generation = self.generations.get(key, 0) + 1
+            self.generations[key] = generation
+            previous = self.pending.get(key)
+            if previous is not None:
+                previous.cancel()
+        future = self.executor.submit(self.run, key, generation, func, args, callback)
+        if key is not None and callback is not None:
+            self.pending[key] = future
+        return future
+
+    def is_stale(self, key, generation):
+        return key is not None and self.generations.get(key) != generation
+
+    def run(self, key, generation, func, args, callback):
+        if self.is_stale(key, generation):
+            return
+        try:
+            result = func(*args)
+        except Exception:
+            return
+        if callback is not None:
+            self.results.put((key, generation, callback, result))
+
+    def poll(self):
+        # Deliver finished results on the Tk thread
+        try:
+            while True:
+                key, generation, callback, result = self.results.get_nowait()
+                if self.is_stale(key, generation):
+                    continue
+                self.pending.pop(key, None)
+                try:
+                    callback(result)
+                except Exception:
+                    pass
+        except queue.Empty:
+            pass
+        self.root.after(self.poll_interval, self.poll)
+
+    def shutdown(self):
+        # Let queued learning and saving finish, drop jobs whose results
+        # would only have been shown in the UI
+        for future in self.pending.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
 
 class TextEditor:
     def __init__(self, root):
@@ -44,14 +949,56 @@ class TextEditor:
         self.text_modified = False
         self.font_size = 12
         self.current_font = "Consolas"
-        
-        # Initialize spell checker and word suggestions
-        self.spell = SpellChecker()
-        self.word_frequency = defaultdict(int)
-        self.load_word_frequency()
-        
-        # Initialize ML models
-        self.initialize_ml_models()
+        self.theme = "nord"
+        # Memory budgets from the settings; the rest keep their defaults
+        self.model_budgets = {}
+        self.spell_job = None
+        self.loader = None
+        self.search_index = SearchIndex()
+        self.search_matches = []
+        self.search_current = None
+        self.search_key = None
+        self.search_pending = None
+        self.search_highlight = 0
+        
+        # Copy of the text kept in sync with the widget, and the region of
+        # lines (first, learned end, current end) the models have yet to learn
+        self.document = Document()
+        self.sentence_boundaries = SentenceBoundaries(self.document)
+        self.pending_learn = (0, 0, 1)
+        
+        # Journal of the edits made since the document was opened or saved
+        self.journal = None
+        self.live_spell_check = BooleanVar(value=False)
+        self.dirty_lines = set()
+        self.show_performance = BooleanVar(value=False)
+        self.keystroke_started = {}
+        self.words_to_learn = []
+        
+        # Training from a folder: an event that cancels it when set, and its
+        # progress as (done, total) bytes
+        self.training = None
+        self.training_progress = (0, 0)
+        
+        # Spell checker, suggestion indexes and language models, and the
+        # profiler timing both the engine and the UI stages
+        self.engine = TextEngine()
+        self.profiler = self.engine.profiler
+        self.startup_timings = {}
+        
+        # Model loading, training and suggestions run off the Tk main loop;
+        # the window is drawn while the saved models load
+        self.worker = BackgroundWorker(self.root)
+        
+        # Journal writes get a thread of their own, so autosave never waits
+        # behind model loading or training on the worker
+        self.journal_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="editor-journal")
+        
+        # Work deferred from event handlers, run in time-budgeted slices
+        self.scheduler = MainLoopScheduler(self.root, self.profiler)
+        self.worker.submit(None, self.engine.load, callback=self.models_loaded)
+        self.root.after(FLUSH_INTERVAL, self.schedule_flush)
+        self.root.after(AUTOSAVE_INTERVAL, self.autosave)
         
         # Configure root window
         self.root.configure(bg=self.bg_color)
@@ -76,19 +1023,25 @@ class TextEditor:
         
         # Load settings
         self.load_settings()
-
-    def initialize_ml_models(self):
-        # Initialize n-gram models
-        self.bigrams = defaultdict(Counter)
-        self.trigrams = defaultdict(Counter)
-        
-        # Initialize TF-IDF vectorizer for sentence similarity
-        self.vectorizer = TfidfVectorizer(stop_words='english')
-        self.sentence_vectors = None
-        self.sentences = []
         
-        # Load existing models
-        self.load_ml_models()
+        self.root.after_idle(self.first_paint)
+        self.root.after_idle(self.recover_journal)
+
+    def models_loaded(self, result):
+        self.record_startup('models_ready')
+
+    def first_paint(self):
+        self.root.update_idletasks()
+        self.record_startup('first_paint')
+
+    def record_startup(self, stage):
+        # Startup stages are timed from import; going over budget is reported
+        now = time.perf_counter()
+        elapsed = now - STARTUP_STARTED
+        self.startup_timings[stage] = elapsed
+        self.profiler.record("startup." + stage, STARTUP_STARTED, now)
+        if elapsed > STARTUP_BUDGET.get(stage, float('inf')):
+            sys.stderr.write(f"Startup: {stage} took {elapsed:.2f}s (budget {STARTUP_BUDGET[stage]:.2f}s)\n")
 
     def create_menu(self):
         menubar = Menu(self.root, bg=self.bg_color, fg=self.text_fg)
@@ -100,11 +1053,16 @@ class TextEditor:
         file_menu.add_command(label="Save", command=self.save_file, accelerator="Ctrl+S")
         file_menu.add_command(label="Save As", command=self.save_as, accelerator="Ctrl+Shift+S")
         file_menu.add_separator()
+        file_menu.add_command(label="Train from Folder...", command=self.train_from_folder)
+        file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.exit_editor)
         menubar.add_cascade(label="File", menu=file_menu)
         
         # Edit Menu
         edit_menu = Menu(menubar, tearoff=0, bg=self.bg_color, fg=self.text_fg)
+        edit_menu.add_command(label="Undo", command=lambda: self.text_area.event_generate("<<Undo>>"), accelerator="Ctrl+Z")
+        edit_menu.add_command(label="Redo", command=lambda: self.text_area.event_generate("<<Redo>>"), accelerator="Ctrl+Y")
+        edit_menu.add_separator()
         edit_menu.add_command(label="Cut", command=lambda: self.text_area.event_generate("<<Cut>>"), accelerator="Ctrl+X")
         edit_menu.add_command(label="Copy", command=lambda: self.text_area.event_generate("<<Copy>>"), accelerator="Ctrl+C")
         edit_menu.add_command(label="Paste", command=lambda: self.text_area.event_generate("<<Paste>>"), accelerator="Ctrl+V")
@@ -118,6 +1076,12 @@ class TextEditor:
         view_menu.add_command(label="Zoom In", command=self.zoom_in, accelerator="Ctrl++")
         view_menu.add_command(label="Zoom Out", command=self.zoom_out, accelerator="Ctrl+-")
         view_menu.add_command(label="Reset Zoom", command=self.reset_zoom, accelerator="Ctrl+0")
+        view_menu.add_separator()
+        view_menu.add_checkbutton(label="Performance Overlay", variable=self.show_performance,
+                                  command=self.toggle_performance_overlay)
+        view_menu.add_command(label="Export Performance Trace...", command=self.export_performance_trace)
+        view_menu.add_checkbutton(label="Live Spell Check", variable=self.live_spell_check,
+                                  command=self.toggle_live_spell_check)
         menubar.add_cascade(label="View", menu=view_menu)
         
         # Theme Menu
@@ -130,7 +1094,7 @@ class TextEditor:
         self.root.config(menu=menubar)
 
     def create_toolbar(self):
-        toolbar = Frame(self.root, bg=self.bg_color)
+        toolbar = self.toolbar = Frame(self.root, bg=self.bg_color)
         toolbar.pack(fill=X, padx=5, pady=2)
         
         # Font family combobox
@@ -184,15 +1148,25 @@ class TextEditor:
             selectbackground=self.accent_color,
             font=(self.current_font, self.font_size),
             padx=10,
-            pady=10
+            pady=10,
+            undo=True
         )
         self.text_area.pack(fill=BOTH, expand=True)
         
+        # Live spell checking follows the viewport as it scrolls
+        self.text_area.configure(yscrollcommand=self.on_text_scroll)
+        
+        # Mirror every edit into self.document
+        self.install_document_sync()
+        
         # Configure tags for text styling
         self.text_area.tag_configure("bold", font=(self.current_font, self.font_size, "bold"))
         self.text_area.tag_configure("italic", font=(self.current_font, self.font_size, "italic"))
         self.text_area.tag_configure("underline", underline=1)
         self.text_area.tag_configure("misspelled", underline=True, underlinefg="red")
+        self.text_area.tag_configure("search", background="yellow", foreground="black")
+        self.text_area.tag_configure("search_current", background="orange", foreground="black")
+        self.text_area.tag_raise("search_current", "search")
 
     def create_suggestion_box(self):
         # Create suggestion frame
@@ -234,6 +1208,54 @@ class TextEditor:
         # Initially hide suggestion boxes
         self.suggestion_frame.pack_forget()
         self.sentence_suggestion_frame.pack_forget()
+        
+        # Pooled buttons for both boxes
+        self.word_bar = SuggestionBar(self.suggestion_frame, self.suggestion_buttons_frame,
+                                      WORD_SUGGESTION_SLOTS, self.apply_suggestion)
+        self.sentence_bar = SuggestionBar(self.sentence_suggestion_frame, self.sentence_suggestion_buttons_frame,
+                                          SENTENCE_SUGGESTION_SLOTS, self.apply_sentence_suggestion)
+        self.suggestion_layout_pending = None
+
+    def update_suggestion_bar(self, bar, suggestions, immediate=False):
+        # Update a bar's buttons now and its visibility at the next layout
+        if bar.show(suggestions):
+            bar.wanted = True
+            bar.hide_at = None
+            if 'first_suggestion' not in self.startup_timings:
+                self.record_startup('first_suggestion')
+        elif immediate or not bar.visible:
+            bar.wanted = False
+            bar.hide_at = None
+        elif bar.hide_at is None:
+            bar.hide_at = time.perf_counter() + SUGGESTION_HIDE_DELAY / 1000
+        if self.suggestion_layout_pending is None:
+            self.suggestion_layout_pending = self.root.after(SUGGESTION_LAYOUT_INTERVAL,
+                                                             self.apply_suggestion_layout)
+
+    def apply_suggestion_layout(self):
+        # Pack or unpack the bars whose visibility changed, in one pass and
+        # in a fixed order below the text area
+        self.suggestion_layout_pending = None
+        now = time.perf_counter()
+        previous = self.main_frame
+        waiting = False
+        for bar in (self.word_bar, self.sentence_bar):
+            if bar.hide_at is not None:
+                if now >= bar.hide_at:
+                    bar.wanted = False
+                    bar.hide_at = None
+                else:
+                    waiting = True
+            if bar.wanted and not bar.visible:
+                bar.frame.pack(fill=X, padx=5, pady=2, after=previous)
+            elif bar.visible and not bar.wanted:
+                bar.frame.pack_forget()
+            bar.visible = bar.wanted
+            if bar.visible:
+                previous = bar.frame
+        if waiting:
+            self.suggestion_layout_pending = self.root.after(SUGGESTION_LAYOUT_INTERVAL,
+                                                             self.apply_suggestion_layout)
 
     def create_status_bar(self):
         self.status_bar = Label(
@@ -246,6 +1268,57 @@ class TextEditor:
             fg=self.text_fg
         )
         self.status_bar.pack(side=BOTTOM, fill=X)
+        
+        # Stage latencies and model sizes, shown from the View menu
+        self.performance_overlay = Label(
+            self.root,
+            text="",
+            anchor=W,
+            justify=LEFT,
+            font=("Consolas", 9),
+            bg=self.bg_color,
+            fg=self.text_fg
+        )
+
+    def toggle_performance_overlay(self):
+        if self.show_performance.get():
+            self.performance_overlay.pack(side=BOTTOM, fill=X, before=self.status_bar)
+            self.refresh_performance_overlay()
+        else:
+            self.performance_overlay.pack_forget()
+
+    def refresh_performance_overlay(self):
+        if not self.show_performance.get():
+            return
+        # Model sizes are read on the worker, which owns the models
+        self.worker.submit("performance_counters", self.engine.memory_counters,
+                           callback=self.update_performance_overlay)
+        self.root.after(PERF_OVERLAY_INTERVAL, self.refresh_performance_overlay)
+
+    def update_performance_overlay(self, counters):
+        stats = self.profiler.stats()
+        slowest = sorted(stats.items(), key=lambda item: item[1]['p99_ms'], reverse=True)
+        stages = "  ".join(f"{name} {stat['p50_ms']:.1f}/{stat['p99_ms']:.1f}ms"
+                           for name, stat in slowest[:PERF_OVERLAY_STAGES])
+        sizes = "  ".join(f"{name} {value:,}" for name, value in counters.items())
+        startup = "  ".join(f"{stage} {self.startup_timings[stage]:.2f}s"
+                            for stage in STARTUP_STAGES if stage in self.startup_timings)
+        self.performance_overlay.config(text=f"p50/p99  {stages or 'no samples yet'}\n{sizes}\n"
+                                             f"startup  {startup}")
+
+    def export_performance_trace(self):
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".json",
+            initialfile="editor-trace.json",
+            filetypes=[("Chrome Trace", "*.json"), ("All Files", "*.*")]
+        )
+        if not file_path:
+            return
+        try:
+            count = self.profiler.export_trace(file_path)
+            self.status_bar.config(text=f"Exported {count} trace events to {os.path.basename(file_path)}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Could not export trace: {str(e)}")
 
     def bind_events(self):
         self.text_area.bind("<<Modified>>", self.on_text_modified)
@@ -256,16 +1329,23 @@ class TextEditor:
         self.root.bind("<Control-plus>", lambda e: self.zoom_in())
         self.root.bind("<Control-minus>", lambda e: self.zoom_out())
         self.root.bind("<Control-0>", lambda e: self.reset_zoom())
-        self.root.bind("<space>", self.on_space_press)
+        # On the widget itself, so it runs before the Text class binding
+        # inserts the space
+        self.text_area.bind("<KeyPress-space>", self.on_space_press)
+        self.root.protocol("WM_DELETE_WINDOW", self.exit_editor)
 
     def new_file(self):
         if self.text_modified:
             if messagebox.askyesno("Unsaved Changes", "Do you want to save changes?"):
                 self.save_file()
+        self.discard_journal()
+        self.restart_learning()
         self.text_area.delete(1.0, END)
+        self.text_area.edit_reset()
         self.current_file = None
         self.text_modified = False
         self.update_title()
+        self.journal = EditJournal(None)
 
     def open_file(self):
         if self.text_modified:
@@ -278,24 +1358,112 @@ class TextEditor:
         )
         
         if file_path:
+            self.cancel_file_load()
+            self.discard_journal()
+            # Edits to this file that were never saved survive in its journal
+            if os.path.exists(EditJournal.journal_for(file_path)):
+                if self.offer_recovery(EditJournal.journal_for(file_path)):
+                    return
             try:
+                if os.path.getsize(file_path) >= LARGE_FILE_SIZE:
+                    self.load_large_file(file_path)
+                    return
                 with open(file_path, 'r', encoding='utf-8') as file:
+                    self.restart_learning()
                     self.text_area.delete(1.0, END)
                     self.text_area.insert(1.0, file.read())
+                self.text_area.edit_reset()
                 self.current_file = file_path
                 self.text_modified = False
                 self.update_title()
+                self.journal = EditJournal(file_path, self.document.length)
             except Exception as e:
                 messagebox.showerror("Error", f"Could not open file: {str(e)}")
 
+    def load_large_file(self, file_path):
+        # Insert the file in chunks from the Tk loop so the UI stays live;
+        # model training waits until the whole file is in
+        reader = ChunkedFileReader(file_path)
+        self.restart_learning()
+        self.loader = reader
+        # The journal starts once the whole file is in
+        self.journal = None
+        # Don't keep a second copy of the file on the undo stack
+        self.text_area.configure(undo=False)
+        self.text_area.delete(1.0, END)
+        self.current_file = None
+        self.root.bind("<Escape>", lambda e: self.cancel_file_load())
+        self.root.after(1, self.load_next_chunk, reader)
+
+    def load_next_chunk(self, reader):
+        if reader is not self.loader:
+            return
+        
+        # Insert chunks for up to 30 ms, then yield to the UI
+        deadline = time.perf_counter() + 0.03
+        try:
+            while time.perf_counter() < deadline:
+                text = reader.read_chunk()
+                if text is None:
+                    self.finish_file_load(reader)
+                    return
+                self.text_area.insert("end-1c", text)
+        except Exception as e:
+            self.cancel_file_load()
+            messagebox.showerror("Error", f"Could not open file: {str(e)}")
+            return
+        
+        name = os.path.basename(reader.path)
+        self.status_bar.config(text=f"Loading {name}... {int(reader.progress * 100)}% (Esc to cancel)")
+        self.root.after(1, self.load_next_chunk, reader)
+
+    def finish_file_load(self, reader):
+        reader.close()
+        self.root.unbind("<Escape>")
+        self.current_file = reader.path
+        self.status_bar.config(text=f"Loaded {os.path.basename(reader.path)}")
+        # Let the <<Modified>> events queued by the inserts drain first
+        self.root.after_idle(self.end_file_load, reader)
+
+    def end_file_load(self, reader):
+        if reader is not self.loader:
+            return
+        self.loader = None
+        self.text_area.configure(undo=True)
+        self.text_area.edit_reset()
+        self.text_area.edit_modified(False)
+        self.text_modified = False
+        self.update_title()
+        self.submit_learning()
+        self.journal = EditJournal(reader.path, self.document.length)
+
+    def cancel_file_load(self):
+        reader = self.loader
+        if reader is None or reader.file.closed:
+            return
+        reader.close()
+        self.loader = None
+        self.root.unbind("<Escape>")
+        # A partly loaded file must not be saved over the original
+        self.text_area.delete(1.0, END)
+        self.text_area.configure(undo=True)
+        self.text_area.edit_reset()
+        self.current_file = None
+        self.text_modified = False
+        self.update_title()
+        self.status_bar.config(text="Loading cancelled")
+        self.journal = EditJournal(None)
+
     def save_file(self):
         if self.current_file:
             try:
-                content = self.text_area.get(1.0, END)
-                with open(self.current_file, 'w', encoding='utf-8') as file:
-                    file.write(content)
+                snapshot = self.document.snapshot()
+                write_atomically(self.current_file, snapshot.chunks + ('\n',))
                 self.text_modified = False
                 self.update_title()
+                # The saved file is the new base; the old journal is obsolete
+                self.discard_journal()
+                self.journal = EditJournal(self.current_file, snapshot.length)
             except Exception as e:
                 messagebox.showerror("Error", f"Could not save file: {str(e)}")
         else:
@@ -311,41 +1479,203 @@ class TextEditor:
             self.current_file = file_path
             self.save_file()
 
+    def train_from_folder(self):
+        # Learn from every text file in a folder; choosing the command again
+        # while training cancels it
+        if self.training is not None:
+            self.training.set()
+            self.status_bar.config(text="Cancelling training...")
+            return
+        folder = filedialog.askdirectory(title="Train from Folder")
+        if not folder:
+            return
+        self.training = threading.Event()
+        self.training_progress = (0, 0)
+        self.worker.submit("training", self.run_training, folder, self.training,
+                           callback=self.training_finished)
+        self.root.after(TRAINING_PROGRESS_INTERVAL, self.show_training_progress)
+
+    def run_training(self, folder, cancelled):
+        # Runs on the worker, so other language jobs wait until it is done
+        def progress(done, total):
+            self.training_progress = (done, total)
+        try:
+            return self.engine.train([folder], progress=progress, cancelled=cancelled)
+        except Exception as e:
+            return {'error': str(e)}
+
+    def show_training_progress(self):
+        if self.training is None:
+            return
+        if not self.training.is_set():
+            done, total = self.training_progress
+            self.status_bar.config(text=f"Training... {done * 100 // max(total, 1)}% "
+                                        "(Train from Folder again to cancel)")
+        self.root.after(TRAINING_PROGRESS_INTERVAL, self.show_training_progress)
+
+    def training_finished(self, stats):
+        self.training = None
+        if 'error' in stats:
+            messagebox.showerror("Error", f"Could not train: {stats['error']}")
+            return
+        action = "Training cancelled after" if stats['cancelled'] else "Trained on"
+        self.status_bar.config(text=f"{action} {stats['words']:,} words from {stats['files']:,} files")
+
     def exit_editor(self):
         if self.text_modified:
             if messagebox.askyesno("Unsaved Changes", "Do you want to save changes?"):
                 self.save_file()
+        self.save_settings()
+        # Nothing is left to recover after a clean exit
+        self.discard_journal()
+        # Training stops after its current chunk and saves what it learned
+        if self.training is not None:
+            self.training.set()
+        # Hand over learning that was still waiting for a pause in typing
+        self.scheduler.shutdown()
+        self.submit_learning()
+        self.submit_words()
+        self.worker.submit(None, self.engine.flush)
+        self.journal_writer.shutdown()
+        self.worker.shutdown()
         self.root.quit()
 
     def show_find_dialog(self):
         find_dialog = Toplevel(self.root)
         find_dialog.title("Find")
-        find_dialog.geometry("300x100")
+        find_dialog.geometry("320x240")
         find_dialog.transient(self.root)
         
         Label(find_dialog, text="Find:").pack(pady=5)
         find_entry = Entry(find_dialog, width=30)
         find_entry.pack(pady=5)
-        
-        def find_text():
-            search_term = find_entry.get()
-            if search_term:
-                start_pos = self.text_area.search(search_term, "1.0", END)
-                if start_pos:
-                    end_pos = f"{start_pos}+{len(search_term)}c"
-                    self.text_area.tag_remove("search", "1.0", END)
-                    self.text_area.tag_add("search", start_pos, end_pos)
-                    self.text_area.tag_config("search", background="yellow", foreground="black")
-                    self.text_area.see(start_pos)
-                else:
-                    messagebox.showinfo("Find", "Text not found")
-        
-        Button(find_dialog, text="Find", command=find_text).pack(pady=5)
+        find_entry.focus_set()
+        
+        use_regex = BooleanVar(value=False)
+        match_case = BooleanVar(value=False)
+        whole_word = BooleanVar(value=False)
+        
+        count_label = Label(find_dialog, text="")
+        
+        def options():
+            return find_entry.get(), use_regex.get(), match_case.get(), whole_word.get()
+        
+        def search(event=None):
+            # Highlight as the user types, once typing pauses
+            if self.search_pending:
+                self.root.after_cancel(self.search_pending)
+            self.search_pending = self.root.after(150, run_search)
+        
+        def run_search():
+            self.search_pending = None
+            if not self.update_search(*options()):
+                count_label.config(text="Invalid regular expression")
+                return
+            count_label.config(text=self.search_status())
+        
+        def find_next(backwards=False):
+            if self.update_search(*options()):
+                self.select_match(backwards)
+                count_label.config(text=self.search_status())
+        
+        def close():
+            if self.search_pending:
+                self.root.after_cancel(self.search_pending)
+                self.search_pending = None
+            self.clear_search()
+            find_dialog.destroy()
+        
+        for label, variable in (("Regular expression", use_regex), ("Match case", match_case), ("Whole word", whole_word)):
+            Checkbutton(find_dialog, text=label, variable=variable, command=search).pack(anchor=W, padx=20)
+        
+        buttons = Frame(find_dialog)
+        buttons.pack(pady=5)
+        Button(buttons, text="Previous", command=lambda: find_next(True)).pack(side=LEFT, padx=2)
+        Button(buttons, text="Next", command=find_next).pack(side=LEFT, padx=2)
+        Button(buttons, text="Find All", command=run_search).pack(side=LEFT, padx=2)
+        count_label.pack()
+        
+        find_entry.bind("<KeyRelease>", search)
+        find_entry.bind("<Return>", lambda e: find_next())
+        find_entry.bind("<Shift-Return>", lambda e: find_next(True))
+        find_dialog.protocol("WM_DELETE_WINDOW", close)
+
+    def update_search(self, term, regex, match_case, whole_word):
+        # Find every match and start highlighting them; False for a bad regex.
+        # Nothing changes while the query and the document stay the same.
+        key = (term, regex, match_case, whole_word, self.document.version)
+        if key == self.search_key:
+            return True
+        self.clear_search()
+        if not term:
+            return True
+        try:
+            self.search_index.update(self.document)
+            self.search_matches = self.search_index.find(term, regex, match_case, whole_word)
+        except re.error:
+            return False
+        self.search_key = key
+        
+        # Tag the visible matches first, then the rest in batches
+        first = self.text_offset("@0,0")
+        last = self.text_offset(f"@0,{self.text_area.winfo_height()} lineend")
+        low = bisect.bisect_left(self.search_matches, (first,))
+        high = bisect.bisect_right(self.search_matches, (last,))
+        order = self.search_matches[low:high] + self.search_matches[:low] + self.search_matches[high:]
+        self.highlight_matches(self.search_highlight, order, 0)
+        return True
+
+    def highlight_matches(self, generation, spans, position):
+        if generation != self.search_highlight:
+            return
+        batch = spans[position:position + SEARCH_TAG_BATCH]
+        if batch:
+            self.text_area.tag_add("search", *spans_to_indices(batch, self.search_index.line_starts))
+        if position + SEARCH_TAG_BATCH < len(spans):
+            self.root.after(1, self.highlight_matches, generation, spans, position + SEARCH_TAG_BATCH)
+
+    def clear_search(self):
+        self.search_key = None
+        self.search_highlight += 1
+        self.search_matches = []
+        self.search_current = None
+        self.text_area.tag_remove("search", "1.0", END)
+        self.text_area.tag_remove("search_current", "1.0", END)
+
+    def select_match(self, backwards=False):
+        # Move to the match after (or before) the cursor, wrapping around
+        matches = self.search_matches
+        if not matches:
+            return
+        cursor = self.text_offset("insert")
+        current = self.search_current
+        if current is not None and current < len(matches) and matches[current][1] == cursor:
+            index = current - 1 if backwards else current + 1
+        elif backwards:
+            index = bisect.bisect_left(matches, (cursor,)) - 1
+        else:
+            index = bisect.bisect_left(matches, (cursor,))
+        index %= len(matches)
+        self.search_current = index
+        
+        start, end = spans_to_indices([matches[index]], self.search_index.line_starts)
+        self.text_area.tag_remove("search_current", "1.0", END)
+        self.text_area.tag_add("search_current", start, end)
+        self.text_area.mark_set("insert", end)
+        self.text_area.see(start)
+
+    def search_status(self):
+        count = len(self.search_matches)
+        if not count:
+            return "No matches"
+        if self.search_current is None:
+            return f"{count} match{'es' if count != 1 else ''}"
+        return f"{self.search_current + 1} of {count} matches"
 
     def show_replace_dialog(self):
         replace_dialog = Toplevel(self.root)
         replace_dialog.title("Replace")
-        replace_dialog.geometry("300x150")
+        replace_dialog.geometry("300x260")
         replace_dialog.transient(self.root)
         
         Label(replace_dialog, text="Find:").pack(pady=5)
@@ -356,18 +1686,57 @@ class TextEditor:
         replace_entry = Entry(replace_dialog, width=30)
         replace_entry.pack(pady=5)
         
+        use_regex = BooleanVar(value=False)
+        match_case = BooleanVar(value=True)
+        whole_word = BooleanVar(value=False)
+        Checkbutton(replace_dialog, text="Regular expression", variable=use_regex).pack(anchor=W, padx=20)
+        Checkbutton(replace_dialog, text="Match case", variable=match_case).pack(anchor=W, padx=20)
+        Checkbutton(replace_dialog, text="Whole word", variable=whole_word).pack(anchor=W, padx=20)
+        
+        result_label = Label(replace_dialog, text="")
+        
         def replace_text():
             search_term = find_entry.get()
-            replace_term = replace_entry.get()
-            if search_term:
-                content = self.text_area.get(1.0, END)
-                new_content = content.replace(search_term, replace_term)
-                self.text_area.delete(1.0, END)
-                self.text_area.insert(1.0, new_content)
-                self.text_modified = True
-                self.update_title()
-        
-        Button(replace_dialog, text="Replace", command=replace_text).pack(pady=5)
+            if not search_term or self.loader:
+                return
+            try:
+                pattern = compile_search(search_term, use_regex.get(), match_case.get(), whole_word.get())
+                edits = find_replacements(self.document.snapshot().text(), pattern,
+                                          replace_entry.get(), use_regex.get())
+            except re.error as e:
+                messagebox.showerror("Replace", f"Invalid regular expression: {e}")
+                return
+            count = self.replace_all(edits)
+            result_label.config(text=f"Replaced {count} occurrence{'s' if count != 1 else ''}")
+        
+        Button(replace_dialog, text="Replace All", command=replace_text).pack(pady=5)
+        result_label.pack()
+
+    def replace_all(self, edits):
+        # Apply (start, end, new text) edits as targeted deletes and inserts,
+        # back to front so earlier offsets stay valid, as one undo step.
+        # Replacements keep the formatting of the text they replace. Returns
+        # the number of edits that changed the text.
+        if not edits:
+            return 0
+        applied = 0
+        self.text_area.configure(autoseparators=False)
+        self.text_area.edit_separator()
+        try:
+            for start, end, new in reversed(edits):
+                start_index = self.text_index(start)
+                end_index = self.text_index(end)
+                if self.text_area.get(start_index, end_index) == new:
+                    continue
+                tags = tuple(tag for tag in self.text_area.tag_names(start_index)
+                             if tag not in ("sel", "search", "misspelled"))
+                self.text_area.delete(start_index, end_index)
+                self.text_area.insert(start_index, new, tags)
+                applied += 1
+        finally:
+            self.text_area.edit_separator()
+            self.text_area.configure(autoseparators=True)
+        return applied
 
     def zoom_in(self):
         self.font_size += 2
@@ -386,6 +1755,7 @@ class TextEditor:
         self.font_size_combo.set(self.font_size)
 
     def change_theme(self, theme):
+        self.theme = theme
         if theme == "nord":
             self.bg_color = "#2E3440"
             self.text_bg = "#3B4252"
@@ -408,6 +1778,7 @@ class TextEditor:
         self.root.configure(bg=self.bg_color)
         self.text_area.configure(bg=self.text_bg, fg=self.text_fg)
         self.status_bar.configure(bg=self.bg_color, fg=self.text_fg)
+        self.performance_overlay.configure(bg=self.bg_color, fg=self.text_fg)
         self.toolbar.configure(bg=self.bg_color)
         self.main_frame.configure(bg=self.bg_color)
 
@@ -459,14 +1830,168 @@ class TextEditor:
                 pass
 
     def on_text_modified(self, event=None):
-        self.text_modified = True
-        self.update_title()
-        self.text_area.edit_modified(False)
+        # Hold everything off while a large file is streaming in
+        if self.loader:
+            self.text_area.edit_modified(False)
+            return
         
-        # Update ML models with new text
-        if self.text_modified:
-            text = self.text_area.get("1.0", END)
-            self.update_ml_models(text)
+        with self.profiler.span("text_modified"):
+            self.text_modified = True
+            self.scheduler.request("title", self.update_title, priority=PRIORITY_CURSOR)
+            self.text_area.edit_modified(False)
+            
+            # Offsets from a running spell check no longer match the text
+            self.cancel_spell_check()
+            self.schedule_live_spell_check()
+            
+            # Update ML models with the changed part of the text once typing
+            # pauses; edits in between are merged into pending_learn
+            self.scheduler.request("learning", self.submit_learning, priority=PRIORITY_BACKGROUND,
+                                   delay=LEARNING_DELAY)
+
+    def install_document_sync(self):
+        # Wrap the widget's Tcl command in a Tcl proc so every insert, delete
+        # and replace, including typing, paste and undo, reaches
+        # self.document. The widget command itself runs in Tcl, so its
+        # errors reach Tk's bindings (which rely on them, e.g. Copy with no
+        # selection) and only edits that succeed are applied.
+        widget = str(self.text_area)
+        self.text_widget_command = widget + "_document"
+        self.text_edit = None
+        tk = self.text_area.tk
+        tk.call("rename", widget, self.text_widget_command)
+        tk.createcommand(widget + "_before_edit", self.before_text_edit)
+        tk.createcommand(widget + "_after_edit", self.after_text_edit)
+        tk.call("proc", widget, "command args", f"""
+            if {{$command in {{insert delete replace}}}} {{
+                {widget}_before_edit $command {{*}}$args
+                set result [{self.text_widget_command} $command {{*}}$args]
+                {widget}_after_edit
+                return $result
+            }}
+            return [{self.text_widget_command} $command {{*}}$args]
+        """)
+
+    def before_text_edit(self, command, *args):
+        # Offsets of an edit, taken before the widget makes it
+        self.text_edit = None
+        try:
+            if command == "insert" and len(args) >= 2:
+                self.text_edit = ([], self.text_offset(args[0]), ''.join(args[1::2]))
+            elif command == "delete" and len(args) >= 1:
+                self.text_edit = (self.text_ranges(args), None, '')
+            elif command == "replace" and len(args) >= 3:
+                ranges = self.text_ranges(args[:2])
+                start = ranges[0][0] if ranges else self.text_offset(args[0])
+                self.text_edit = (ranges, start, ''.join(args[2::2]))
+        except TclError:
+            # A bad index; the widget command fails on it as well
+            pass
+
+    def after_text_edit(self):
+        # The widget made the edit; make it in self.document too
+        if self.text_edit is None:
+            return
+        ranges, offset, text = self.text_edit
+        self.text_edit = None
+        for start, end in reversed(ranges):
+            self.document_delete(start, end)
+        if text:
+            self.document_insert(offset, text)
+        length = self.text_area.tk.call(self.text_widget_command, "count", "-chars", "1.0", "end-1c")
+        if int(length or 0) != self.document.length:
+            self.resync_document()
+
+    def resync_document(self):
+        # The mirror missed how the widget made an edit; take the widget's
+        # text and rebuild everything kept in the mirror's offsets
+        version = self.document.version
+        self.document.set_text(self.text_area.tk.call(self.text_widget_command, "get", "1.0", "end-1c"))
+        self.document.version = version + 1
+        self.sentence_boundaries.segments = None
+        self.dirty_lines.clear()
+        self.restart_learning()
+        journal = self.journal
+        if journal:
+            journal.pending = []
+            journal.size = 0
+            self.journal_writer.submit(journal.compact, self.document.snapshot())
+
+    def text_position(self, index):
+        # 1-based (line, column) of a Tk text index
+        position = self.text_area.tk.call(self.text_widget_command, "index", index)
+        line, column = map(int, str(position).split('.'))
+        return line, column
+
+    def text_offset(self, index):
+        # Character offset in self.document of a Tk text index
+        line, column = self.text_position(index)
+        return min(self.document.line_start(line - 1) + column, self.document.length)
+
+    def text_index(self, offset):
+        # Tk text index of a character offset in self.document
+        line = self.document.line_of(offset)
+        return f"{line + 1}.{offset - self.document.line_start(line)}"
+
+    def text_ranges(self, indices):
+        # Character ranges for a delete command's indices; an unpaired index
+        # deletes the character after it
+        if len(indices) % 2:
+            indices = indices + (indices[-1] + "+1c",)
+        return delete_ranges(self.document, [(self.text_position(a), self.text_position(b))
+                                             for a, b in zip(indices[::2], indices[1::2])])
+
+    def document_insert(self, offset, text):
+        line = self.document.line_of(offset)
+        self.document.insert(offset, text)
+        if self.journal:
+            self.journal.insert(offset, text)
+        self.sentence_boundaries.edit(offset, offset, offset + len(text))
+        self.record_edit(line, line + 1, line + 1 + text.count('\n'))
+
+    def document_delete(self, start, end):
+        first_line = self.document.line_of(start)
+        last_line = self.document.line_of(end)
+        end = min(end, self.document.length)
+        self.document.delete(start, end)
+        if self.journal and start < end:
+            self.journal.delete(start, end)
+        self.sentence_boundaries.edit(start, end, start)
+        self.record_edit(first_line, last_line + 1, first_line + 1)
+
+    def record_edit(self, start, old_end, new_end):
+        # Lines start to old_end (0-based, exclusive) became start to new_end.
+        # Merge that into the region the models have yet to learn.
+        if self.pending_learn is None:
+            self.pending_learn = (start, old_end, new_end)
+        else:
+            first, learned_end, current_end = self.pending_learn
+            covered = max(current_end, old_end)
+            self.pending_learn = (min(first, start),
+                                  learned_end + covered - current_end,
+                                  covered + new_end - old_end)
+        
+        # Lines marked for live spell checking (1-based) move with the edit,
+        # and small edits mark their own lines
+        if self.dirty_lines and new_end != old_end:
+            self.dirty_lines = {line if line <= start else line + new_end - old_end
+                                for line in self.dirty_lines if not start < line <= old_end}
+        if new_end - start <= 100:
+            self.dirty_lines.update(range(start + 1, new_end + 1))
+
+    def restart_learning(self):
+        # Keep what was learned from the old document instead of un-learning
+        # it, and learn the next document from scratch
+        self.worker.submit(None, self.engine.forget_document)
+        self.pending_learn = (0, 0, self.document.line_count)
+
+    def submit_learning(self):
+        if self.pending_learn is None:
+            return
+        start, learned_end, current_end = self.pending_learn
+        self.pending_learn = None
+        lines = self.document.lines(start, current_end)
+        self.worker.submit(None, self.engine.update_ml_models, start, learned_end, lines)
 
     def update_title(self):
         title = "Advanced Text Editor"
@@ -485,12 +2010,41 @@ class TextEditor:
             pass
 
     def load_settings(self):
+        # Settings saved by older versions are in the working directory
+        settings = None
+        for path in (SETTINGS_FILE, "editor_settings.json"):
+            try:
+                with open(path, "r") as f:
+                    settings = json.load(f)
+                break
+            except:
+                pass
+        if not isinstance(settings, dict):
+            return
+        # Each setting is applied on its own, so one bad value doesn't
+        # lose the others
+        try:
+            # Memory budgets for the language models, applied once they load
+            self.model_budgets = dict(settings.get("model_budgets", {}))
+            if self.model_budgets:
+                self.worker.submit(None, self.engine.set_budgets, self.model_budgets)
+        except:
+            pass
         try:
-            with open("editor_settings.json", "r") as f:
-                settings = json.load(f)
-                self.font_size = settings.get("font_size", 12)
-                self.current_font = settings.get("font_family", "Consolas")
-                self.change_theme(settings.get("theme", "nord"))
+            self.live_spell_check.set(bool(settings.get("live_spell_check", False)))
+            self.schedule_live_spell_check()
+        except:
+            pass
+        try:
+            self.font_size = int(settings.get("font_size", 12))
+            self.current_font = settings.get("font_family", "Consolas")
+            self.text_area.configure(font=(self.current_font, self.font_size))
+            self.font_family.set(self.current_font)
+            self.font_size_combo.set(self.font_size)
+        except:
+            pass
+        try:
+            self.change_theme(settings.get("theme", "nord"))
         except:
             pass
 
@@ -498,26 +2052,51 @@ class TextEditor:
         settings = {
             "font_size": self.font_size,
             "font_family": self.current_font,
-            "theme": "nord"  # Default theme
+            "theme": self.theme,
+            "live_spell_check": self.live_spell_check.get(),
+            "model_budgets": dict(MODEL_BUDGETS, **self.model_budgets)
         }
         try:
-            with open("editor_settings.json", "w") as f:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            with open(SETTINGS_FILE, "w") as f:
                 json.dump(settings, f)
         except:
             pass
 
     def on_key_release(self, event):
-        self.update_status_bar()
-        if event.char.isalpha():
-            self.show_word_suggestions()
-            self.show_sentence_suggestions()
+        with self.profiler.span("key_release"):
+            self.scheduler.request("status_bar", self.update_status_bar, priority=PRIORITY_CURSOR)
+            if event.char.isalpha():
+                # Suggestions are timed from here until they are on screen;
+                # keys typed before they are looked up share one lookup
+                started = time.perf_counter()
+                self.keystroke_started = {"words": started, "sentences": started}
+                self.scheduler.request("suggestions", self.show_suggestions, priority=PRIORITY_SUGGESTIONS)
+
+    def show_suggestions(self):
+        self.show_word_suggestions()
+        yield
+        self.show_sentence_suggestions()
 
     def on_space_press(self, event):
-        # Update word frequency when space is pressed
-        current_word = self.get_current_word()
-        if current_word:
-            self.word_frequency[current_word.lower()] += 1
-            self.save_word_frequency()
+        # Update word frequency when space is pressed. The word is read now,
+        # before the space is inserted after it, and handed to the worker
+        # with any others typed in the same frame.
+        with self.profiler.span("space_press"):
+            current_word = self.get_current_word()
+            if current_word:
+                self.words_to_learn.append(current_word.lower())
+                self.scheduler.request("learn_words", self.submit_words, priority=PRIORITY_BACKGROUND)
+
+    def submit_words(self):
+        for word in self.words_to_learn:
+            self.worker.submit(None, self.engine.learn_word, word)
+        self.words_to_learn = []
+
+    def record_keystroke(self, kind):
+        started = self.keystroke_started.pop(kind, None)
+        if started is not None:
+            self.profiler.record("keystroke_to_" + kind, started, time.perf_counter())
 
     def get_current_word(self):
         try:
@@ -542,73 +2121,24 @@ class TextEditor:
         return None
 
     def show_word_suggestions(self):
-        current_word = self.get_current_word()
+        with self.profiler.span("get_current_word"):
+            current_word = self.get_current_word()
         if not current_word:
-            self.suggestion_frame.pack_forget()
+            self.worker.submit("word_suggestions", lambda: [], callback=self.display_word_suggestions)
             return
 
-        # Get suggestions
-        suggestions = self.get_suggestions(current_word)
-        if not suggestions:
-            self.suggestion_frame.pack_forget()
-            return
+        # Get suggestions in the background
+        self.worker.submit("word_suggestions", self.engine.get_suggestions, current_word,
+                           callback=self.display_word_suggestions)
 
-        # Clear existing suggestion buttons
-        for widget in self.suggestion_buttons_frame.winfo_children():
-            widget.destroy()
+    def display_word_suggestions(self, suggestions):
+        with self.profiler.span("widgets.word_suggestions"):
+            self.show_word_buttons(suggestions)
+        self.record_keystroke("words")
 
-        # Create suggestion buttons
-        for suggestion in suggestions[:5]:  # Show top 5 suggestions
-            btn = ttk.Button(
-                self.suggestion_buttons_frame,
-                text=suggestion,
-                command=lambda s=suggestion: self.apply_suggestion(s),
-                style='Toolbar.TButton'
-            )
-            btn.pack(side=LEFT, padx=2)
-
-        # Show suggestion box
-        self.suggestion_frame.pack(fill=X, padx=5, pady=2)
-
-    def get_suggestions(self, word):
-        suggestions = set()
-        
-        # Add spell checker suggestions
-        if word.lower() not in self.spell:
-            suggestions.update(self.spell.candidates(word))
-        
-        # Add wordnet synonyms
-        for syn in wordnet.synsets(word):
-            suggestions.update([lemma.name() for lemma in syn.lemmas()])
-        
-        # Add frequency-based suggestions
-        word_lower = word.lower()
-        similar_words = [w for w in self.word_frequency.keys() 
-                        if w.startswith(word_lower) or 
-                        self.levenshtein_distance(word_lower, w) <= 2]
-        suggestions.update(sorted(similar_words, 
-                                key=lambda x: self.word_frequency[x], 
-                                reverse=True))
-        
-        return list(suggestions)
-
-    def levenshtein_distance(self, s1, s2):
-        if len(s1) < len(s2):
-            return self.levenshtein_distance(s2, s1)
-        if len(s2) == 0:
-            return len(s1)
-        
-        previous_row = range(len(s2) + 1)
-        for i, c1 in enumerate(s1):
-            current_row = [i + 1]
-            for j, c2 in enumerate(s2):
-                insertions = previous_row[j + 1] + 1
-                deletions = current_row[j] + 1
-                substitutions = previous_row[j] + (c1 != c2)
-                current_row.append(min(insertions, deletions, substitutions))
-            previous_row = current_row
-        
-        return previous_row[-1]
+    def show_word_buttons(self, suggestions):
+        # Relabel the pooled buttons with the top suggestions
+        self.update_suggestion_bar(self.word_bar, suggestions)
 
     def apply_suggestion(self, suggestion):
         try:
@@ -631,193 +2161,219 @@ class TextEditor:
                 current_pos = word_end
             
             # Hide suggestion box
-            self.suggestion_frame.pack_forget()
+            self.update_suggestion_bar(self.word_bar, [], immediate=True)
         except:
             pass
 
     def check_spelling(self):
+        # The button cancels a check that is still running
+        if self.spell_job:
+            self.cancel_spell_check()
+            return
+        
         # Clear existing misspelled tags
         self.text_area.tag_remove("misspelled", "1.0", END)
         
-        # Get all text
-        text = self.text_area.get("1.0", END)
-        words = re.findall(r'\b\w+\b', text)
-        
-        # Check each word
-        for word in words:
-            if word.lower() not in self.spell:
-                # Find all occurrences of the word
-                start_pos = "1.0"
-                while True:
-                    start_pos = self.text_area.search(r'\y' + word + r'\y', start_pos, END, regexp=True)
-                    if not start_pos:
-                        break
-                    end_pos = f"{start_pos}+{len(word)}c"
-                    self.text_area.tag_add("misspelled", start_pos, end_pos)
-                    start_pos = end_pos
+        # Check the text on a background thread and tag results as they arrive
+        self.spell_job = SpellCheckJob(self.document.snapshot(), self.engine.spell)
+        self.spell_job.start()
+        self.spell_btn.config(text="Cancel")
+        self.status_bar.config(text="Checking spelling... 0%")
+        self.root.after(50, self.tag_misspelled, self.spell_job)
+
+    def tag_misspelled(self, job):
+        if job is not self.spell_job:
+            return
+        
+        # Apply batches of tags for up to 20 ms, then yield to the UI
+        deadline = time.perf_counter() + 0.02
+        while time.perf_counter() < deadline:
+            try:
+                indices = job.results.get_nowait()
+            except queue.Empty:
+                break
+            if indices is None:
+                self.finish_spell_check(f"Spell check: {job.misspelled} misspelled words")
+                return
+            self.text_area.tag_add("misspelled", *indices)
+        
+        self.status_bar.config(text=f"Checking spelling... {int(job.progress * 100)}%")
+        self.root.after(20, self.tag_misspelled, job)
+
+    def cancel_spell_check(self):
+        if self.spell_job:
+            self.spell_job.cancel()
+            self.finish_spell_check("Spell check cancelled")
 
-    def load_word_frequency(self):
+    def finish_spell_check(self, message):
+        self.spell_job = None
+        self.spell_btn.config(text="Spell Check")
+        self.status_bar.config(text=message)
+
+    def toggle_live_spell_check(self):
+        if self.live_spell_check.get():
+            self.schedule_live_spell_check()
+        else:
+            self.text_area.tag_remove("misspelled", "1.0", END)
+            self.dirty_lines.clear()
+
+    def on_text_scroll(self, first, last):
+        self.text_area.vbar.set(first, last)
+        self.schedule_live_spell_check()
+
+    def schedule_live_spell_check(self):
+        # Re-check dirty and visible lines once editing or scrolling pauses
+        if not self.live_spell_check.get():
+            self.dirty_lines.clear()
+            return
+        self.scheduler.request("live_spell_check", self.run_live_spell_check,
+                               priority=PRIORITY_BACKGROUND, delay=LIVE_SPELLCHECK_DELAY)
+
+    def run_live_spell_check(self):
+        if self.spell_job or self.loader:
+            return
+        
+        # Only the visible lines and lines edited elsewhere are re-checked.
+        # Their text is checked on the worker, which owns the dictionary.
+        first = int(self.text_area.index("@0,0").split('.')[0])
+        last = int(self.text_area.index(f"@0,{self.text_area.winfo_height()}").split('.')[0])
+        ranges = [(first, last)]
+        ranges.extend((line, line) for line in sorted(self.dirty_lines) if not first <= line <= last)
+        texts = [self.text_area.get(f"{start}.0", f"{end}.end") for start, end in ranges]
+        self.worker.submit("live_spell_check", self.check_lines, ranges, texts, self.document.version,
+                           callback=self.show_misspelled_lines)
+
+    def check_lines(self, ranges, texts, version):
+        # Runs on the worker: the misspelled spans of each range's text
+        checked = []
+        for (first, last), text in zip(ranges, texts):
+            line_starts = [0]
+            line_starts.extend(match.end() for match in re.finditer('\n', text))
+            checked.append((first, last, spans_to_indices(find_misspelled_spans(text, 0, self.engine.spell),
+                                                          line_starts, first)))
+        return version, checked
+
+    def show_misspelled_lines(self, result):
+        # Results for text that has changed since are dropped; the edit
+        # kept its lines dirty and scheduled another check
+        version, checked = result
+        if version != self.document.version or not self.live_spell_check.get():
+            return
+        for first, last, indices in checked:
+            self.text_area.tag_remove("misspelled", f"{first}.0", f"{last}.end")
+            if indices:
+                self.text_area.tag_add("misspelled", *indices)
+            self.dirty_lines.difference_update(range(first, last + 1))
+
+    def autosave(self):
+        # Append the edits made since the last autosave to the journal, or
+        # once it has grown large, save the whole document beside it
+        journal = self.journal
+        if journal and journal.pending:
+            if journal.needs_compaction():
+                journal.pending = []
+                journal.size = 0
+                self.journal_writer.submit(journal.compact, self.document.snapshot())
+            else:
+                self.journal_writer.submit(journal.append, journal.take())
+        self.root.after(AUTOSAVE_INTERVAL, self.autosave)
+
+    def discard_journal(self):
+        if self.journal:
+            self.journal_writer.submit(self.journal.discard)
+            self.journal = None
+
+    def recover_journal(self):
+        # After a crash, offer the journal RECOVERY_FILE points at
+        journal_path = None
         try:
-            with open("word_frequency.json", "r") as f:
-                self.word_frequency = defaultdict(int, json.load(f))
-        except:
+            with open(RECOVERY_FILE, 'r', encoding='utf-8') as f:
+                journal_path = json.load(f).get('journal')
+        except (OSError, ValueError):
             pass
+        if not (journal_path and os.path.exists(journal_path) and self.offer_recovery(journal_path)):
+            if self.journal is None and self.loader is None:
+                self.journal = EditJournal(self.current_file, self.document.length)
 
-    def save_word_frequency(self):
+    def offer_recovery(self, journal_path):
+        # Ask whether to restore the edits in a journal left behind by a
+        # crash; returns whether they were restored
+        recovered = None
         try:
-            with open("word_frequency.json", "w") as f:
-                json.dump(dict(self.word_frequency), f)
-        except:
-            pass
+            recovered = EditJournal.recover(journal_path)
+        except (OSError, ValueError, KeyError) as e:
+            messagebox.showwarning("Recovery", f"Could not recover unsaved changes: {str(e)}")
+        if recovered:
+            path, text = recovered
+            name = os.path.basename(path) if path else "an untitled document"
+            if messagebox.askyesno("Recover Unsaved Changes",
+                                   f"Unsaved changes to {name} were found. Do you want to recover them?"):
+                self.load_recovered(path, text)
+                return True
+        self.journal_writer.submit(EditJournal.remove, journal_path)
+        return False
+
+    def load_recovered(self, path, text):
+        self.cancel_file_load()
+        self.discard_journal()
+        self.restart_learning()
+        self.text_area.delete(1.0, END)
+        self.text_area.insert(1.0, text)
+        self.text_area.edit_reset()
+        self.current_file = path
+        self.text_modified = True
+        self.update_title()
+        # Start the journal over from a copy of the recovered text
+        self.journal = EditJournal(path, self.document.length)
+        self.journal_writer.submit(self.journal.compact, self.document.snapshot())
+        self.status_bar.config(text="Recovered unsaved changes")
+
+    def schedule_flush(self):
+        # Write buffered model changes in the background every FLUSH_INTERVAL
+        self.worker.submit(None, self.engine.flush)
+        self.root.after(FLUSH_INTERVAL, self.schedule_flush)
 
     def show_sentence_suggestions(self):
-        current_sentence = self.get_current_sentence()
+        with self.profiler.span("get_current_sentence"):
+            current_sentence = self.get_current_sentence()
         if not current_sentence:
-            self.sentence_suggestion_frame.pack_forget()
-            return
-
-        # Get sentence suggestions
-        suggestions = self.get_sentence_suggestions(current_sentence)
-        if not suggestions:
-            self.sentence_suggestion_frame.pack_forget()
+            self.worker.submit("sentence_suggestions", lambda: [], callback=self.display_sentence_suggestions)
             return
 
-        # Clear existing suggestion buttons
-        for widget in self.sentence_suggestion_buttons_frame.winfo_children():
-            widget.destroy()
+        # Get sentence suggestions in the background
+        self.worker.submit("sentence_suggestions", self.engine.get_sentence_suggestions, current_sentence,
+                           callback=self.display_sentence_suggestions)
 
-        # Create suggestion buttons
-        for suggestion in suggestions[:3]:  # Show top 3 suggestions
-            btn = ttk.Button(
-                self.sentence_suggestion_buttons_frame,
-                text=suggestion,
-                command=lambda s=suggestion: self.apply_sentence_suggestion(s),
-                style='Toolbar.TButton'
-            )
-            btn.pack(side=LEFT, padx=2)
+    def display_sentence_suggestions(self, suggestions):
+        with self.profiler.span("widgets.sentence_suggestions"):
+            self.show_sentence_buttons(suggestions)
+        self.record_keystroke("sentences")
 
-        # Show suggestion box
-        self.sentence_suggestion_frame.pack(fill=X, padx=5, pady=2)
+    def show_sentence_buttons(self, suggestions):
+        # Relabel the pooled buttons with the top suggestions
+        self.update_suggestion_bar(self.sentence_bar, suggestions)
 
     def get_current_sentence(self):
         try:
-            # Get the current line and column
-            line = self.text_area.index("insert").split('.')[0]
-            col = int(self.text_area.index("insert").split('.')[1])
-            
-            # Get the current line text
-            line_text = self.text_area.get(f"{line}.0", f"{line}.end")
-            
-            # Find the current sentence
-            sentences = sent_tokenize(line_text)
-            current_pos = 0
-            for sentence in sentences:
-                sentence_start = line_text.find(sentence, current_pos)
-                sentence_end = sentence_start + len(sentence)
-                if sentence_start <= col <= sentence_end:
-                    return sentence.strip()
-                current_pos = sentence_end
+            # Find the sentence around the cursor, which may span lines
+            span = self.sentence_boundaries.sentence_at(self.text_offset("insert"))
+            if span:
+                return self.document.get(*span).strip()
         except:
             pass
         return None
 
-    def get_sentence_suggestions(self, current_sentence):
-        suggestions = set()
-        
-        # Get n-gram based suggestions
-        words = word_tokenize(current_sentence.lower())
-        if len(words) >= 2:
-            # Get bigram suggestions
-            last_word = words[-1]
-            if last_word in self.bigrams:
-                suggestions.update(self.bigrams[last_word].most_common(3))
-        
-        if len(words) >= 3:
-            # Get trigram suggestions
-            last_two_words = ' '.join(words[-2:])
-            if last_two_words in self.trigrams:
-                suggestions.update(self.trigrams[last_two_words].most_common(3))
-        
-        # Get similar sentences using TF-IDF and cosine similarity
-        if self.sentence_vectors is not None and len(self.sentences) > 0:
-            current_vector = self.vectorizer.transform([current_sentence])
-            similarities = cosine_similarity(current_vector, self.sentence_vectors).flatten()
-            similar_indices = similarities.argsort()[-3:][::-1]
-            suggestions.update([self.sentences[i] for i in similar_indices])
-        
-        return list(suggestions)
-
     def apply_sentence_suggestion(self, suggestion):
         try:
-            # Get the current sentence position
-            line = self.text_area.index("insert").split('.')[0]
-            col = int(self.text_area.index("insert").split('.')[1])
-            line_text = self.text_area.get(f"{line}.0", f"{line}.end")
-            
-            # Find the current sentence
-            sentences = sent_tokenize(line_text)
-            current_pos = 0
-            for sentence in sentences:
-                sentence_start = line_text.find(sentence, current_pos)
-                sentence_end = sentence_start + len(sentence)
-                if sentence_start <= col <= sentence_end:
-                    # Replace the sentence
-                    self.text_area.delete(f"{line}.{sentence_start}", f"{line}.{sentence_end}")
-                    self.text_area.insert(f"{line}.{sentence_start}", suggestion)
-                    break
-                current_pos = sentence_end
+            # Replace the sentence around the cursor
+            span = self.sentence_boundaries.sentence_at(self.text_offset("insert"))
+            if span:
+                start = self.text_index(span[0])
+                self.text_area.delete(start, self.text_index(span[1]))
+                self.text_area.insert(start, suggestion)
             
             # Hide suggestion box
-            self.sentence_suggestion_frame.pack_forget()
-        except:
-            pass
-
-    def update_ml_models(self, text):
-        # Update n-gram models
-        words = word_tokenize(text.lower())
-        
-        # Update bigrams
-        for bigram in ngrams(words, 2):
-            self.bigrams[bigram[0]][bigram[1]] += 1
-        
-        # Update trigrams
-        for trigram in ngrams(words, 3):
-            self.trigrams[' '.join(trigram[:2])][trigram[2]] += 1
-        
-        # Update sentence model
-        sentences = sent_tokenize(text)
-        self.sentences.extend(sentences)
-        if len(self.sentences) > 1000:  # Keep only last 1000 sentences
-            self.sentences = self.sentences[-1000:]
-        
-        # Update TF-IDF vectors
-        if len(self.sentences) > 0:
-            self.sentence_vectors = self.vectorizer.fit_transform(self.sentences)
-        
-        # Save updated models
-        self.save_ml_models()
-
-    def load_ml_models(self):
-        try:
-            with open("ml_models.json", "r") as f:
-                data = json.load(f)
-                self.bigrams = defaultdict(Counter, {k: Counter(v) for k, v in data['bigrams'].items()})
-                self.trigrams = defaultdict(Counter, {k: Counter(v) for k, v in data['trigrams'].items()})
-                self.sentences = data['sentences']
-                if len(self.sentences) > 0:
-                    self.sentence_vectors = self.vectorizer.fit_transform(self.sentences)
-        except:
-            pass
-
-    def save_ml_models(self):
-        try:
-            data = {
-                'bigrams': {k: dict(v) for k, v in self.bigrams.items()},
-                'trigrams': {k: dict(v) for k, v in self.trigrams.items()},
-                'sentences': self.sentences
-            }
-            with open("ml_models.json", "w") as f:
-                json.dump(data, f)
+            self.update_suggestion_bar(self.sentence_bar, [], immediate=True)
         except:
             pass
 
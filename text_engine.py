@@ -0,0 +1,2108 @@
+import os
+import re
+import sys
+import json
+import argparse
+import threading
+import multiprocessing
+import bisect
+import heapq
+import math
+import zlib
+import time
+import random
+import mmap
+import struct
+from array import array
+from collections import defaultdict, Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# The language side of the editor: spell checking, word and sentence
+# suggestions and the models they learn from. Nothing here needs a display,
+# so it can be used from scripts, servers and CI:
+#
+#     python text_engine.py --help
+#
+# pyspellchecker, nltk and scikit-learn are imported on first use.
+
+# Number of spell dictionary words kept in the fuzzy lookup index. The index
+# is built once and saved to DICTIONARY_INDEX_FILE in the model directory,
+# where later runs map it instead of rebuilding it.
+DICTIONARY_INDEX_SIZE = 100000
+DICTIONARY_INDEX_FILE = "dictionary_index.bin"
+DICTIONARY_INDEX_HEADER = struct.Struct('<4sIIIHHQI')
+
+# Number of sentences kept for similar-sentence suggestions
+MAX_SENTENCES = 100000
+
+# Bulk spell checking: documents at least PARALLEL_SPELLCHECK_SIZE characters
+# long are checked in a process pool, SPELLCHECK_CHUNK_SIZE characters per task
+PARALLEL_SPELLCHECK_SIZE = 4 << 20
+SPELLCHECK_CHUNK_SIZE = 1 << 20
+
+# Worker processes are started with this method everywhere; fork would copy
+# the caller's threads' held locks (the editor's and the store's) into them
+PROCESS_START_METHOD = "spawn"
+
+# The profiler keeps the last PROFILE_WINDOW timings of each span for its
+# histograms, and the last PROFILE_TRACE_EVENTS spans for trace export
+PROFILE_WINDOW = 1000
+PROFILE_TRACE_EVENTS = 100000
+
+# WordNet synonyms compiled by `python text_engine.py --build-synonyms`. When
+# the table exists, synonym lookups never load NLTK.
+SYNONYM_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "synonyms.bin")
+SYNONYM_TABLE_HEADER = struct.Struct('<4sIIII')
+
+# Suffix rewrites tried for words that are not in the synonym table, in the
+# order WordNet's morphy tries them for nouns, verbs and adjectives
+MORPHY_SUFFIXES = [('s', ''), ('ses', 's'), ('xes', 'x'), ('zes', 'z'), ('ches', 'ch'),
+                   ('shes', 'sh'), ('men', 'man'), ('ies', 'y'), ('es', 'e'), ('es', ''),
+                   ('ed', 'e'), ('ed', ''), ('ing', 'e'), ('ing', ''), ('er', ''), ('est', ''),
+                   ('er', 'e'), ('est', 'e')]
+
+# Training from a folder reads files about TRAINING_CHUNK_SIZE characters
+# (whole lines) at a time, keeps at most two chunks per process in flight and
+# samples up to TRAINING_SENTENCE_SAMPLE sentences of each chunk for the
+# sentence index
+TRAINING_CHUNK_SIZE = 4 << 20
+TRAINING_SENTENCE_SAMPLE = 10000
+
+# Suggestion caches keep up to SUGGESTION_CACHE_SIZE words each; entries older
+# than SUGGESTION_CACHE_TTL seconds are recomputed
+SUGGESTION_CACHE_SIZE = 4096
+SUGGESTION_CACHE_TTL = 600
+
+# Memory budgets: the most words, bigram and trigram entries and sentences
+# the models keep. Over budget, every count is aged by DECAY_FACTOR (rounding
+# half up), so entries that are no longer used fall behind ones learned
+# since, and then the entries with the lowest counts (the stalest first among
+# equal counts) are evicted until BUDGET_LOW_WATER of the budget is left.
+# Evicted entries go into count-min sketches of SKETCH_WIDTH x SKETCH_DEPTH
+# counters, which give them back an approximate count if they come back; the
+# sketches age by DECAY_FACTOR too. Training from a folder doesn't age the
+# counts, so every file in it weighs the same.
+MODEL_BUDGETS = {'vocabulary': 100000, 'bigrams': 1000000, 'trigrams': 1000000, 'sentences': MAX_SENTENCES}
+BUDGET_LOW_WATER = 0.9
+DECAY_FACTOR = 0.5
+SKETCH_WIDTH = 1 << 16
+SKETCH_DEPTH = 4
+
+# N-gram changes are collected in an overlay that is merged into the
+# count arrays once it holds this many entries (or an eighth of the arrays)
+NGRAM_MERGE_SIZE = 50000
+
+# Batch runs spell check this many documents per process pool round
+BATCH_SIZE = 256
+
+WORD_PATTERN = re.compile(r'\b\w+\b')
+WHITESPACE_PATTERN = re.compile(r'\s')
+
+# Used when NLTK or its data is missing; NLTK data is never downloaded
+TOKEN_PATTERN = re.compile(r"\w+(?:'\w+)?|[^\w\s]")
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+# Used when scikit-learn is missing
+FALLBACK_STOP_WORDS = frozenset('''a about above after again against all am an and any are as at be
+because been before being below between both but by can could did do does doing down during each
+few for from further had has have having he her here hers herself him himself his how i if in into
+is it its itself just me more most my myself no nor not now of off on once only or other our ours
+ourselves out over own same she should so some such than that the their theirs them themselves then
+there these they this those through to too under until up very was we were what when where which
+while who whom why will with would you your yours yourself yourselves'''.split())
+
+nltk_resources = {}
+stop_words = None
+synonym_table = None
+
+def nltk_available(resource):
+    # Whether NLTK and one of its data packages are installed, checked once
+    if resource not in nltk_resources:
+        try:
+            import nltk
+            nltk.data.find(resource)
+            nltk_resources[resource] = True
+        except (ImportError, LookupError):
+            nltk_resources[resource] = False
+    return nltk_resources[resource]
+
+def tokenize_words(text):
+    if nltk_available('tokenizers/punkt'):
+        try:
+            from nltk.tokenize import word_tokenize
+            return word_tokenize(text)
+        except LookupError:
+            nltk_resources['tokenizers/punkt'] = False
+    return TOKEN_PATTERN.findall(text)
+
+def tokenize_sentences(text):
+    if nltk_available('tokenizers/punkt'):
+        try:
+            from nltk.tokenize import sent_tokenize
+            return sent_tokenize(text)
+        except LookupError:
+            nltk_resources['tokenizers/punkt'] = False
+    return [sentence for sentence in SENTENCE_PATTERN.split(text.strip()) if sentence]
+
+def word_ngrams(words, n):
+    return zip(*(words[i:] for i in range(n)))
+
+def synonyms(word):
+    table = get_synonym_table()
+    if table:
+        return table.lookup(word)
+    return wordnet_synonyms(word)
+
+def wordnet_synonyms(word):
+    if not nltk_available('corpora/wordnet'):
+        return []
+    from nltk.corpus import wordnet
+    return [lemma.name() for syn in wordnet.synsets(word) for lemma in syn.lemmas()]
+
+def get_synonym_table():
+    # The compiled table, opened on first use; False when there is none
+    global synonym_table
+    if synonym_table is None:
+        synonym_table = SynonymTable.open(SYNONYM_TABLE_PATH) or False
+    return synonym_table
+
+def get_stop_words():
+    global stop_words
+    if stop_words is None:
+        try:
+            from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+            stop_words = ENGLISH_STOP_WORDS
+        except ImportError:
+            stop_words = FALLBACK_STOP_WORDS
+    return stop_words
+
+def create_spell_checker():
+    from spellchecker import SpellChecker
+    return SpellChecker()
+
+def diff_paragraphs(old, new):
+    # Find the smallest run of paragraphs that differs between two versions
+    # of a document: old[start:old_end] was replaced by new[start:new_end]
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+    
+    old_end, new_end = len(old), len(new)
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    return start, old_end, new_end
+
+def bounded_edit_distance(s1, s2, max_distance):
+    # Optimal string alignment distance (Levenshtein plus adjacent
+    # transpositions), only filling the diagonal band that can stay within
+    # max_distance and returning max_distance + 1 once it is exceeded
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    
+    # Common prefixes and suffixes never change the distance
+    start = 0
+    while start < len(s2) and s1[start] == s2[start]:
+        start += 1
+    end1, end2 = len(s1), len(s2)
+    while end2 > start and s1[end1 - 1] == s2[end2 - 1]:
+        end1 -= 1
+        end2 -= 1
+    s1, s2 = s1[start:end1], s2[start:end2]
+    
+    len1, len2 = len(s1), len(s2)
+    if len1 - len2 > max_distance:
+        return max_distance + 1
+    if len2 == 0:
+        return len1
+    
+    too_far = max_distance + 1
+    before_previous = None
+    previous_row = [j if j <= max_distance else too_far for j in range(len2 + 1)]
+    for i in range(1, len1 + 1):
+        c1 = s1[i - 1]
+        current_row = [too_far] * (len2 + 1)
+        current_row[0] = i if i <= max_distance else too_far
+        row_min = current_row[0]
+        for j in range(max(1, i - max_distance), min(len2, i + max_distance) + 1):
+            c2 = s2[j - 1]
+            cost = previous_row[j - 1] if c1 == c2 else previous_row[j - 1] + 1
+            if previous_row[j] + 1 < cost:
+                cost = previous_row[j] + 1
+            if current_row[j - 1] + 1 < cost:
+                cost = current_row[j - 1] + 1
+            if (before_previous is not None and j > 1 and
+                    c1 == s2[j - 2] and s1[i - 2] == c2 and
+                    before_previous[j - 2] + 1 < cost):
+                cost = before_previous[j - 2] + 1
+            current_row[j] = cost
+            if cost < row_min:
+                row_min = cost
+        if row_min > max_distance:
+            return too_far
+        before_previous, previous_row = previous_row, current_row
+    return min(previous_row[len2], too_far)
+
+class SymSpellIndex:
+    # Symmetric-delete fuzzy index: every word is filed under the strings left
+    # after deleting up to max_distance characters from its prefix, so a lookup
+    # only has to generate the deletes of the query instead of scanning the
+    # vocabulary. Limiting deletes to the first prefix_length characters and
+    # capping the number of words keeps memory bounded.
+    def __init__(self, max_distance=2, prefix_length=6, max_words=200000):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.max_words = max_words
+        self.words = {}
+        self.deletes = {}
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def add(self, word, count=1):
+        if word in self.words:
+            self.words[word] += count
+            return True
+        if not word or len(self.words) >= self.max_words:
+            return False
+        self.words[word] = count
+        for delete in self.generate_deletes(word[:self.prefix_length], self.max_distance):
+            key = self.bucket_key(delete, len(word))
+            # Most keys hold a single word, so store that as a plain string
+            bucket = self.deletes.get(key)
+            if bucket is None:
+                self.deletes[key] = word
+            elif isinstance(bucket, str):
+                self.deletes[key] = [bucket, word]
+            else:
+                bucket.append(word)
+        return True
+
+    def remove(self, word):
+        if self.words.pop(word, None) is None:
+            return
+        for delete in self.generate_deletes(word[:self.prefix_length], self.max_distance):
+            key = self.bucket_key(delete, len(word))
+            bucket = self.deletes.get(key)
+            if bucket == word:
+                del self.deletes[key]
+            elif isinstance(bucket, list) and word in bucket:
+                bucket.remove(word)
+                if len(bucket) == 1:
+                    self.deletes[key] = bucket[0]
+
+    def set_counts(self, counts):
+        for word in self.words:
+            if word in counts:
+                self.words[word] = counts[word]
+
+    def bucket_key(self, delete, length):
+        # Buckets are split by word length so lookups never visit words that
+        # are too long or too short to be within range. Keys are hashes rather
+        # than strings to save memory; a collision only adds a candidate that
+        # the distance check then rejects.
+        return hash((delete, length))
+
+    @staticmethod
+    def generate_deletes(word, max_distance):
+        deletes = {word}
+        frontier = [word]
+        for _ in range(max_distance):
+            next_frontier = []
+            for item in frontier:
+                for i in range(len(item)):
+                    delete = item[:i] + item[i + 1:]
+                    if delete not in deletes:
+                        deletes.add(delete)
+                        next_frontier.append(delete)
+            frontier = next_frontier
+        return deletes
+
+    def lookup(self, word, max_distance=None, limit=10, nearest=False):
+        # Returns up to `limit` (word, distance) pairs, closest and most
+        # frequent first, then alphabetically. Searching one distance at a
+        # time lets short words, which have huge distance-2 neighbourhoods,
+        # stop at distance 1; with nearest, any match stops the search.
+        if max_distance is None:
+            max_distance = self.max_distance
+        max_distance = min(max_distance, self.max_distance)
+        
+        matches = []
+        distances = {}
+        for distance in range(max_distance + 1):
+            matches = self.search(word, distance, distances, max_distance, limit)
+            if len(matches) >= limit or (nearest and matches):
+                break
+        matches.sort(key=lambda match: (match[1], -self.words[match[0]], match[0]))
+        return matches[:limit]
+
+    def search(self, word, max_distance, distances=None, bound=None, limit=None):
+        # (word, distance) of the words within max_distance of word. As in
+        # DictionaryIndex.search, candidates whose letter masks rule them out
+        # are skipped, and distances are computed up to bound and kept in
+        # distances for the wider searches of one lookup. With a limit, the
+        # search stops at `limit` matches: candidates already known to be
+        # closer go first, then the rest most frequent first, so the matches
+        # found rank above any that were not looked at.
+        if distances is None:
+            distances = {}
+        if bound is None:
+            bound = max_distance
+        candidates = set()
+        length = len(word)
+        lengths = range(max(1, length - max_distance), length + max_distance + 1)
+        for delete in self.generate_deletes(word[:self.prefix_length], max_distance):
+            for candidate_length in lengths:
+                bucket = self.deletes.get(self.bucket_key(delete, candidate_length))
+                if bucket is not None:
+                    candidates.update((bucket,) if isinstance(bucket, str) else bucket)
+        if limit is not None and len(candidates) > limit:
+            candidates = sorted(candidates, key=lambda candidate: (distances.get(candidate, max_distance),
+                                                                   -self.words[candidate], candidate))
+        
+        once, twice = letter_masks(word)
+        found = []
+        for candidate in candidates:
+            distance = distances.get(candidate)
+            if distance is None:
+                candidate_once, candidate_twice = letter_masks(candidate)
+                difference = bin(once ^ candidate_once).count('1') + bin(twice ^ candidate_twice).count('1')
+                if difference > 2 * bound:
+                    # Out of range for every search of the lookup
+                    distances[candidate] = bound + 1
+                    continue
+                if difference > 2 * max_distance:
+                    continue
+                distance = distances[candidate] = bounded_edit_distance(word, candidate, bound)
+            if distance <= max_distance:
+                found.append((candidate, distance))
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+def delete_key(delete, length):
+    # Stable key for a delete of a word of the given length, used in files
+    return zlib.crc32(delete.encode('utf-8')) << 8 | min(length, 255)
+
+def letter_masks(word):
+    # Bit sets of the characters in word (modulo 64) that occur at least
+    # once and at least twice. One edit changes at most two bits across
+    # both, so words whose masks differ in more than 2 * d bits are more
+    # than d edits apart.
+    once = twice = 0
+    for character in word:
+        bit = 1 << (ord(character) & 63)
+        twice |= once & bit
+        once |= bit
+    return once, twice
+
+def popcounts(values):
+    # Set bits of each uint64 in values
+    import numpy as np
+    m1, m2, m4 = (np.uint64(mask) for mask in (0x5555555555555555, 0x3333333333333333, 0x0F0F0F0F0F0F0F0F))
+    values = values - ((values >> np.uint64(1)) & m1)
+    values = (values & m2) + ((values >> np.uint64(2)) & m2)
+    values = (values + (values >> np.uint64(4))) & m4
+    return (values * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+class DictionaryIndex:
+    # Memory-mapped SymSpellIndex for the spell dictionary, which never
+    # changes, so it is built once instead of on every start. The file holds
+    # the (delete key, word number) pairs sorted by key, the words in order
+    # of frequency with their counts and letter masks, and a fingerprint of
+    # the dictionary it was built from. A lookup gathers the candidates for
+    # all of the query's deletes with one vectorised binary search and drops
+    # those whose letter masks rule them out before computing distances.
+    MAGIC = b'SYM1'
+
+    def __init__(self, data):
+        import numpy as np
+        self.data = data
+        (magic, count, blob_size, entry_count, self.max_distance, self.prefix_length,
+         self.fingerprint, _) = DICTIONARY_INDEX_HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError("not a dictionary index")
+        position = DICTIONARY_INDEX_HEADER.size
+        arrays = []
+        for dtype, size in (('<u8', entry_count), ('<u8', count), ('<u8', 2 * count),
+                            ('<u4', entry_count), ('<u4', count + 1)):
+            arrays.append(np.frombuffer(data, dtype=dtype, count=size, offset=position))
+            position += arrays[-1].nbytes
+        self.keys, self.counts, self.masks, self.word_ids, self.word_offsets = arrays
+        self.masks = self.masks.reshape(-1, 2)
+        self.blob = memoryview(data)[position:position + blob_size]
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def open(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError, struct.error):
+            return None
+
+    @staticmethod
+    def fingerprint_of(dictionary):
+        # Changes when the dictionary's words or counts do
+        fingerprint = 0
+        for word, count in dictionary:
+            fingerprint = (fingerprint + zlib.crc32(word.encode('utf-8')) * (count + 1)) & 0xFFFFFFFFFFFFFFFF
+        return fingerprint
+
+    @staticmethod
+    def write(path, dictionary, max_distance=2, prefix_length=6, max_words=DICTIONARY_INDEX_SIZE):
+        # dictionary is (word, count) pairs; the most frequent max_words are
+        # indexed
+        import numpy as np
+        dictionary = list(dictionary)
+        fingerprint = DictionaryIndex.fingerprint_of(dictionary)
+        words = sorted((item for item in dictionary if item[0]), key=lambda item: item[1], reverse=True)[:max_words]
+        
+        keys, word_ids = array('Q'), array('I')
+        word_offsets = array('I', [0])
+        blob = bytearray()
+        for i, (word, count) in enumerate(words):
+            for delete in SymSpellIndex.generate_deletes(word[:prefix_length], max_distance):
+                keys.append(delete_key(delete, len(word)))
+                word_ids.append(i)
+            blob += word.encode('utf-8')
+            word_offsets.append(len(blob))
+        keys = np.frombuffer(keys, dtype=np.uint64)
+        order = np.argsort(keys, kind='stable')
+        counts = np.array([count for word, count in words], dtype=np.uint64)
+        masks = np.array([letter_masks(word) for word, count in words], dtype=np.uint64).reshape(-1, 2)
+        
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(DICTIONARY_INDEX_HEADER.pack(DictionaryIndex.MAGIC, len(words), len(blob), len(keys),
+                                                 max_distance, prefix_length, fingerprint, 0))
+            for values, dtype in ((keys[order], '<u8'), (counts, '<u8'), (masks, '<u8'),
+                                  (np.frombuffer(word_ids, dtype=np.uint32)[order], '<u4'),
+                                  (np.frombuffer(word_offsets, dtype=np.uint32), '<u4')):
+                f.write(values.astype(dtype).tobytes())
+            f.write(blob)
+        os.replace(temp_path, path)
+        return len(words)
+
+    def word(self, i):
+        return bytes(self.blob[self.word_offsets[i]:self.word_offsets[i + 1]]).decode('utf-8')
+
+    def lookup(self, word, max_distance=None, limit=10, nearest=False):
+        # Like SymSpellIndex.lookup; words are numbered by frequency, so
+        # sorting by number puts the most frequent first
+        if max_distance is None:
+            max_distance = self.max_distance
+        max_distance = min(max_distance, self.max_distance)
+        
+        matches = []
+        distances = {}
+        for distance in range(max_distance + 1):
+            matches = self.search(word, distance, distances, max_distance, limit)
+            if len(matches) >= limit or (nearest and matches):
+                break
+        matches.sort(key=lambda match: (match[1], match[0]))
+        return [(self.word(i), distance) for i, distance in matches[:limit]]
+
+    def search(self, word, max_distance, distances, bound, limit=None):
+        # (word number, distance) of the words within max_distance of word.
+        # Distances are computed up to bound and kept in distances, so the
+        # wider searches of one lookup don't compute them again. As in
+        # SymSpellIndex.search, a limit stops the search once that many
+        # matches are found, looking at closer and more frequent words first.
+        import numpy as np
+        length = len(word)
+        keys = np.array([delete_key(delete, candidate_length)
+                         for delete in SymSpellIndex.generate_deletes(word[:self.prefix_length], max_distance)
+                         for candidate_length in range(max(1, length - max_distance), length + max_distance + 1)],
+                        dtype=np.uint64)
+        starts = self.keys.searchsorted(keys)
+        sizes = self.keys.searchsorted(keys, side='right') - starts
+        # The rows of every matching key, as one array
+        rows = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes - starts, sizes)
+        ids = np.unique(self.word_ids[rows])
+        differences = popcounts(self.masks[ids] ^ np.array(letter_masks(word), dtype=np.uint64)).sum(axis=1)
+        candidates = ids[differences <= 2 * max_distance].tolist()
+        if limit is not None and len(candidates) > limit:
+            candidates.sort(key=lambda i: (distances.get(i, max_distance), i))
+        found = []
+        for i in candidates:
+            distance = distances.get(i)
+            if distance is None:
+                distance = distances[i] = bounded_edit_distance(word, self.word(i), bound)
+            if distance <= max_distance:
+                found.append((i, distance))
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+class PrefixIndex:
+    # Sorted-array completion index. Words sharing a prefix form one
+    # contiguous range found by bisection; for ranges larger than k the k most
+    # frequent words are cached per prefix and kept ranked as counts change,
+    # so completing a prefix that was seen before is a single dict lookup.
+    def __init__(self, k=10):
+        self.k = k
+        self.words = []
+        self.counts = {}
+        self.top = {}
+
+    def __len__(self):
+        return len(self.words)
+
+    def load(self, counts):
+        self.counts = dict(counts)
+        self.words = sorted(self.counts)
+        self.top = {}
+
+    def add(self, word, count=1):
+        if word in self.counts:
+            self.counts[word] += count
+        else:
+            self.counts[word] = count
+            bisect.insort(self.words, word)
+        
+        # Re-rank the word in every cached prefix it belongs to
+        total = self.counts[word]
+        for i in range(1, len(word) + 1):
+            ranked = self.top.get(word[:i])
+            if ranked is None:
+                continue
+            if word not in ranked:
+                if total <= self.counts[ranked[-1]]:
+                    continue
+                ranked.append(word)
+            ranked.sort(key=self.counts.__getitem__, reverse=True)
+            del ranked[self.k:]
+
+    def complete(self, prefix, limit=None):
+        # Words starting with prefix, most frequent first
+        if not prefix:
+            return []
+        ranked = self.top.get(prefix)
+        if ranked is None:
+            start = bisect.bisect_left(self.words, prefix)
+            end = bisect.bisect_left(self.words, prefix + '\U0010ffff', start)
+            if end - start > self.k:
+                ranked = heapq.nlargest(self.k, self.words[start:end], key=self.counts.__getitem__)
+                self.top[prefix] = ranked
+            else:
+                ranked = sorted(self.words[start:end], key=self.counts.__getitem__, reverse=True)
+        return ranked[:limit]
+
+class SynonymTable:
+    # Memory-mapped synonym lists. The file holds the sorted UTF-8 words
+    # back to back with an offset array into them, and for every word an
+    # offset into one array of synonym word numbers, so opening it reads
+    # nothing and a lookup is a binary search over the mapped pages.
+    MAGIC = b'SYN1'
+
+    def __init__(self, data):
+        self.data = data
+        magic, count, blob_size, synonym_count, _ = SYNONYM_TABLE_HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError("not a synonym table")
+        view = memoryview(data)
+        position = SYNONYM_TABLE_HEADER.size
+        self.word_offsets, position = self.integers(view, position, count + 1)
+        self.synonym_offsets, position = self.integers(view, position, count + 1)
+        self.synonym_ids, position = self.integers(view, position, synonym_count)
+        self.blob = view[position:position + blob_size]
+        self.count = count
+
+    def integers(self, view, position, count):
+        end = position + 4 * count
+        if sys.byteorder == 'little':
+            return view[position:end].cast('I'), end
+        values = array('I', view[position:end])
+        values.byteswap()
+        return values, end
+
+    @classmethod
+    def open(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError, struct.error):
+            return None
+
+    @staticmethod
+    def write(path, entries):
+        # entries maps each word to its synonyms; synonyms that are not
+        # entries themselves are added as words without synonyms
+        words = set(entries)
+        for values in entries.values():
+            words.update(values)
+        words = sorted(words, key=lambda word: word.encode('utf-8'))
+        ids = {word: i for i, word in enumerate(words)}
+        
+        word_offsets, synonym_offsets, synonym_ids = array('I', [0]), array('I', [0]), array('I')
+        blob = bytearray()
+        for word in words:
+            blob += word.encode('utf-8')
+            word_offsets.append(len(blob))
+            synonym_ids.extend(ids[value] for value in dict.fromkeys(entries.get(word, ())))
+            synonym_offsets.append(len(synonym_ids))
+        if sys.byteorder != 'little':
+            for values in (word_offsets, synonym_offsets, synonym_ids):
+                values.byteswap()
+        
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(SYNONYM_TABLE_HEADER.pack(SynonymTable.MAGIC, len(words), len(blob), len(synonym_ids), 0))
+            for values in (word_offsets, synonym_offsets, synonym_ids):
+                values.tofile(f)
+            f.write(blob)
+        os.replace(temp_path, path)
+        return len(words)
+
+    def word(self, i):
+        return bytes(self.blob[self.word_offsets[i]:self.word_offsets[i + 1]])
+
+    def find(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.word(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < self.count and self.word(low) == key else None
+
+    def synonyms_of(self, i):
+        return [self.word(j).decode('utf-8') for j in
+                self.synonym_ids[self.synonym_offsets[i]:self.synonym_offsets[i + 1]]]
+
+    def lookup(self, word):
+        # Like wordnet.synsets, look up the lower-cased word, and for words
+        # WordNet has no entry for, the base forms its suffix rules give
+        word = word.lower()
+        i = self.find(word.encode('utf-8'))
+        found = self.synonyms_of(i) if i is not None else []
+        if found:
+            return found
+        for suffix, ending in MORPHY_SUFFIXES:
+            if word.endswith(suffix) and len(word) > len(suffix):
+                i = self.find((word[:-len(suffix)] + ending).encode('utf-8'))
+                if i is not None:
+                    found.extend(self.synonyms_of(i))
+        return list(dict.fromkeys(found))
+
+def build_synonym_table(path=SYNONYM_TABLE_PATH):
+    # Compile WordNet's synonyms for every lemma and irregular form into a
+    # SynonymTable file; needs NLTK and its wordnet data
+    global synonym_table
+    if not nltk_available('corpora/wordnet'):
+        raise LookupError("NLTK wordnet data is not installed")
+    from nltk.corpus import wordnet
+    words = set(name.lower() for name in wordnet.all_lemma_names())
+    for exceptions in getattr(wordnet, '_exception_map', {}).values():
+        words.update(form.lower() for form in exceptions)
+    entries = {}
+    for word in words:
+        values = wordnet_synonyms(word)
+        if values:
+            entries[word] = values
+    count = SynonymTable.write(path, entries)
+    synonym_table = None
+    return count
+
+class SuggestionCache:
+    # LRU cache with a time to live, counting hits and misses. on_evict is
+    # called with each key that leaves the cache, however it leaves.
+    def __init__(self, max_size=SUGGESTION_CACHE_SIZE, ttl=SUGGESTION_CACHE_TTL, on_evict=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, compute):
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if entry is not None and (self.ttl is None or now - entry[1] < self.ttl):
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+        self.misses += 1
+        value = compute(key)
+        self.entries[key] = (value, now)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.evict(next(iter(self.entries)))
+        return value
+
+    def invalidate(self, keys):
+        for key in keys:
+            if key in self.entries:
+                self.invalidations += 1
+                self.evict(key)
+
+    def evict(self, key):
+        del self.entries[key]
+        if self.on_evict:
+            self.on_evict(key)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        for key in list(self.entries):
+            self.evict(key)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+class SentenceIndex:
+    # Sentence store for similarity suggestions. Terms are hashed to integer
+    # features, so vectors never need refitting; IDF weights come from running
+    # document frequencies. An inverted index from feature to sentences is
+    # probed rarest term first and stops after max_candidates sentences, so a
+    # query costs about the same however many sentences are stored.
+    def __init__(self, max_sentences=100000, max_candidates=300, n_features=1 << 20):
+        self.max_sentences = max_sentences
+        self.max_candidates = max_candidates
+        self.n_features = n_features
+        self.next_id = 0
+        self.sentences = OrderedDict()
+        self.ids_by_text = defaultdict(list)
+        self.postings = defaultdict(dict)
+        self.document_frequency = Counter()
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def texts(self):
+        return [text for text, terms in self.sentences.values()]
+
+    def features(self, text):
+        excluded = get_stop_words()
+        terms = [term for term in re.findall(r'\b\w\w+\b', text.lower())
+                 if term not in excluded]
+        return Counter(zlib.crc32(term.encode('utf-8')) % self.n_features for term in terms)
+
+    def add(self, text):
+        sentence_id = self.next_id
+        self.next_id += 1
+        terms = self.features(text)
+        self.sentences[sentence_id] = (text, terms)
+        self.ids_by_text[text].append(sentence_id)
+        for feature in terms:
+            self.postings[feature][sentence_id] = None
+            self.document_frequency[feature] += 1
+        
+        # Evict the oldest sentences once over capacity
+        while len(self.sentences) > self.max_sentences:
+            self.discard(next(iter(self.sentences)))
+
+    def remove(self, text):
+        # Drop the most recent copy; older ones may already be evicted
+        ids = self.ids_by_text.get(text)
+        if ids:
+            self.discard(ids[-1])
+
+    def discard(self, sentence_id):
+        text, terms = self.sentences.pop(sentence_id)
+        ids = self.ids_by_text[text]
+        ids.remove(sentence_id)
+        if not ids:
+            del self.ids_by_text[text]
+        for feature in terms:
+            posting = self.postings[feature]
+            del posting[sentence_id]
+            if not posting:
+                del self.postings[feature]
+            self.document_frequency[feature] -= 1
+            if self.document_frequency[feature] <= 0:
+                del self.document_frequency[feature]
+
+    def idf(self, feature):
+        # Smoothed IDF, as used by scikit-learn's TfidfVectorizer
+        return math.log((1 + len(self.sentences)) / (1 + self.document_frequency[feature])) + 1
+
+    def weigh(self, terms):
+        weights = {feature: count * self.idf(feature) for feature, count in terms.items()}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+        return weights, norm
+
+    def similar(self, text, limit=3):
+        # The stored sentences most similar to text by TF-IDF cosine similarity
+        query, query_norm = self.weigh(self.features(text))
+        if not query_norm:
+            return []
+        
+        # Collect candidates from the rarest terms' postings, newest first
+        candidates = set()
+        for feature in sorted(query, key=lambda f: self.document_frequency[f]):
+            posting = self.postings.get(feature)
+            if not posting:
+                continue
+            for sentence_id in reversed(posting):
+                candidates.add(sentence_id)
+                if len(candidates) >= self.max_candidates:
+                    break
+            if len(candidates) >= self.max_candidates:
+                break
+        
+        scored = []
+        for sentence_id in candidates:
+            candidate_text, terms = self.sentences[sentence_id]
+            weights, norm = self.weigh(terms)
+            dot = sum(weight * weights.get(feature, 0) for feature, weight in query.items())
+            scored.append((dot / (norm * query_norm), sentence_id, candidate_text))
+        scored.sort(reverse=True)
+        return [candidate_text for score, sentence_id, candidate_text in scored[:limit]]
+
+class CountMinSketch:
+    # Approximate counts for keys evicted from the exact tables. Each of the
+    # depth rows hashes a key to one of width counters and the estimate is
+    # the smallest of them, so it can overcount but never undercount. decay()
+    # ages the counts. Keys are numpy uint64 arrays.
+    MULTIPLIERS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9,
+                   0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53)
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.bits = max(1, width.bit_length() - 1)
+        self.depth = min(depth, len(self.MULTIPLIERS))
+        self.table = None
+
+    def rows(self, keys):
+        import numpy as np
+        keys = np.asarray(keys, dtype=np.uint64)
+        shift = np.uint64(64 - self.bits)
+        for row in range(self.depth):
+            yield row, (keys * np.uint64(self.MULTIPLIERS[row])) >> shift
+
+    def add(self, keys, counts):
+        import numpy as np
+        if self.table is None:
+            self.table = np.zeros((self.depth, 1 << self.bits), dtype=np.float32)
+        for row, columns in self.rows(keys):
+            np.add.at(self.table[row], columns, counts)
+
+    def estimate(self, keys):
+        import numpy as np
+        if self.table is None:
+            return np.zeros(len(keys), dtype=np.float32)
+        return np.min([self.table[row][columns] for row, columns in self.rows(keys)], axis=0)
+
+    def decay(self, factor):
+        if self.table is not None:
+            self.table *= factor
+
+    def clear(self):
+        self.table = None
+
+def word_keys(words):
+    # Sketch keys for words
+    return [zlib.crc32(word.encode('utf-8')) << 8 | min(len(word), 255) for word in words]
+
+class Vocabulary:
+    # Interns words as small integer ids shared by the n-gram stores
+    def __init__(self, words=()):
+        self.words = []
+        self.ids = {}
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self.words)
+
+    def add(self, word):
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word_id = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def get(self, word):
+        return self.ids.get(word)
+
+    def keep(self, word_ids):
+        # Drop every word but word_ids (sorted), renumbering them from zero
+        self.words = [self.words[i] for i in word_ids]
+        self.ids = {word: i for i, word in enumerate(self.words)}
+
+class NgramStore:
+    # Counts of (context, next word) pairs for n-grams of one order, with
+    # words interned in a shared Vocabulary. Counts live in CSR-style numpy
+    # arrays: sorted context keys, row offsets, and each row's next-word ids
+    # and counts ordered by count, so the top k for a context is one binary
+    # search and a slice. Changes go to an overlay of small dicts that is
+    # merged into the arrays once it grows, so merging stays amortised
+    # O(log n) per change. A context key packs up to two 32-bit word ids.
+    # With a budget, merging ages the counts and evicts the lowest into the
+    # sketch until the entries fit.
+    def __init__(self, order, vocabulary, merge_after=NGRAM_MERGE_SIZE, budget=None):
+        self.order = order
+        self.vocabulary = vocabulary
+        self.merge_after = merge_after
+        self.budget = budget
+        self.sketch = CountMinSketch()
+        self.keys = None
+        self.offsets = None
+        self.next_words = None
+        self.counts = None
+        self.overlay = {}
+        self.overlay_size = 0
+
+    def __len__(self):
+        # Stored entries, counting overlay entries that may still cancel out
+        return (0 if self.counts is None else len(self.counts)) + self.overlay_size
+
+    @property
+    def nbytes(self):
+        if self.counts is None:
+            return 0
+        return self.keys.nbytes + self.offsets.nbytes + self.next_words.nbytes + self.counts.nbytes
+
+    def context_key(self, ids):
+        key = 0
+        for word_id in ids:
+            key = (key << 32) | word_id
+        return key
+
+    def add(self, context, word, weight):
+        key = self.context_key([self.vocabulary.add(w) for w in context])
+        word_id = self.vocabulary.add(word)
+        row = self.overlay.get(key)
+        if row is None:
+            row = self.overlay[key] = {}
+        count = row.get(word_id)
+        if count is None:
+            self.overlay_size += 1
+            count = 0
+        row[word_id] = count + weight
+        if self.overlay_size >= max(self.merge_after, len(self) // 8):
+            self.merge()
+
+    def entry_keys(self, keys, words):
+        # Sketch keys for (context key, word id) entries
+        import numpy as np
+        return keys * np.uint64(0x9E3779B97F4A7C15) + words.astype(np.uint64)
+
+    def row(self, key):
+        # (start, end) of a context's entries in the arrays, or None
+        if self.keys is None:
+            return None
+        i = int(self.keys.searchsorted(key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return int(self.offsets[i]), int(self.offsets[i + 1])
+        return None
+
+    def most_common(self, context, k):
+        # The k most frequent next words after context, as (word, count)
+        ids = [self.vocabulary.get(w) for w in context]
+        if None in ids:
+            return []
+        key = self.context_key(ids)
+        overlay = self.overlay.get(key, {})
+        bounds = self.row(key)
+        
+        candidates = {}
+        if bounds:
+            import numpy as np
+            start, end = bounds
+            # Words without pending changes keep their rank in the row, so
+            # the row's first k + len(overlay) entries hold enough of them
+            top = min(end, start + k + len(overlay))
+            for word_id, count in zip(self.next_words[start:top].tolist(), self.counts[start:top].tolist()):
+                if word_id not in overlay:
+                    candidates[word_id] = count
+            if overlay:
+                words = self.next_words[start:end]
+                for i in np.flatnonzero(np.isin(words, list(overlay))).tolist():
+                    candidates[int(words[i])] = int(self.counts[start + i])
+        for word_id, delta in overlay.items():
+            count = candidates.get(word_id, 0) + delta
+            if count > 0:
+                candidates[word_id] = count
+            else:
+                candidates.pop(word_id, None)
+        
+        best = heapq.nlargest(k, candidates.items(), key=lambda item: item[1])
+        return [(self.vocabulary.words[word_id], count) for word_id, count in best]
+
+    def merge(self, extra=None, decay=DECAY_FACTOR):
+        # Fold the overlay, and optionally (keys, words, counts) arrays of
+        # further changes, into the arrays, dropping counts that reach zero.
+        # Over budget, counts are multiplied by decay before evicting.
+        import numpy as np
+        if (not self.overlay and extra is None and self.counts is not None
+                and (self.budget is None or len(self.counts) <= self.budget)):
+            return
+        overlay_keys, overlay_words, overlay_counts = [], [], []
+        for key, row in self.overlay.items():
+            for word_id, count in row.items():
+                overlay_keys.append(key)
+                overlay_words.append(word_id)
+                overlay_counts.append(count)
+        self.overlay = {}
+        self.overlay_size = 0
+        
+        keys = np.array(overlay_keys, dtype=np.uint64)
+        words = np.array(overlay_words, dtype=np.uint32)
+        counts = np.array(overlay_counts, dtype=np.int64)
+        if extra is not None:
+            keys = np.concatenate([keys, extra[0].astype(np.uint64)])
+            words = np.concatenate([words, extra[1].astype(np.uint32)])
+            counts = np.concatenate([counts, extra[2].astype(np.int64)])
+        stored = np.zeros(len(keys), dtype=bool)
+        if self.counts is not None:
+            keys = np.concatenate([self.entries()[0], keys])
+            words = np.concatenate([self.next_words, words])
+            counts = np.concatenate([self.counts.astype(np.int64), counts])
+            stored = np.concatenate([np.ones(len(self.counts), dtype=bool), stored])
+        
+        # Sum the counts of each (context, word) pair
+        order = np.lexsort((words, keys))
+        keys, words, counts, stored = keys[order], words[order], counts[order], stored[order]
+        if len(keys):
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = (keys[1:] != keys[:-1]) | (words[1:] != words[:-1])
+            starts = np.flatnonzero(first)
+            keys, words = keys[starts], words[starts]
+            counts = np.add.reduceat(counts, starts)
+            stored = np.maximum.reduceat(stored, starts)
+            
+            # New entries get back what they had when they were evicted
+            if self.sketch.table is not None and not stored.all():
+                new = ~stored
+                estimates = self.sketch.estimate(self.entry_keys(keys[new], words[new]))
+                counts[new] += np.floor(estimates + 0.5).astype(np.int64)
+            kept = counts > 0
+            keys, words, counts, stored = keys[kept], words[kept], counts[kept], stored[kept]
+        
+        if self.budget is not None and len(counts) > self.budget:
+            # Age the counts, then evict the lowest, entries stored earlier
+            # before ones just added, down to the low-water mark
+            if decay != 1:
+                counts = np.floor(counts * decay + 0.5).astype(np.int64)
+            excess = len(counts) - int(self.budget * BUDGET_LOW_WATER)
+            evicted = np.zeros(len(counts), dtype=bool)
+            evicted[np.lexsort((~stored, counts))[:excess]] = True
+            self.sketch.decay(decay)
+            self.sketch.add(self.entry_keys(keys[evicted], words[evicted]), counts[evicted])
+            kept = ~evicted
+            keys, words, counts = keys[kept], words[kept], counts[kept]
+        self.build(keys, words, counts)
+
+    def entries(self):
+        # The context key of every stored entry
+        import numpy as np
+        return np.repeat(self.keys, np.diff(self.offsets)), self.next_words
+
+    def used_words(self):
+        # Ids of the words that appear in any stored entry
+        import numpy as np
+        self.merge()
+        if self.counts is None:
+            return np.zeros(0, dtype=np.int64)
+        parts = [self.next_words.astype(np.int64)]
+        keys = self.keys
+        for _ in range(self.order - 1):
+            parts.append((keys & np.uint64(0xFFFFFFFF)).astype(np.int64))
+            keys = keys >> np.uint64(32)
+        return np.unique(np.concatenate(parts))
+
+    def renumber(self, mapping):
+        # Apply a word id mapping (an array from old to new id) after the
+        # shared vocabulary was compacted
+        import numpy as np
+        self.merge()
+        self.sketch.clear()
+        if self.counts is None:
+            return
+        keys, words = self.entries()
+        new_keys = np.zeros(len(keys), dtype=np.uint64)
+        for shift in range(self.order - 1):
+            ids = (keys >> np.uint64(32 * shift)) & np.uint64(0xFFFFFFFF)
+            new_keys |= mapping[ids.astype(np.int64)].astype(np.uint64) << np.uint64(32 * shift)
+        self.build(new_keys, mapping[words.astype(np.int64)], self.counts.astype(np.int64))
+
+    def build(self, keys, words, counts):
+        import numpy as np
+        # Rows ordered by key, entries within a row by falling count
+        order = np.lexsort((words, -counts, keys))
+        keys, words, counts = keys[order], words[order], counts[order]
+        self.keys, starts = np.unique(keys, return_index=True)
+        self.offsets = np.append(starts, len(keys)).astype(np.int64)
+        self.next_words = words.astype(np.uint32)
+        self.counts = counts.astype(np.int32)
+
+    def to_arrays(self, prefix):
+        self.merge()
+        return {prefix + '_keys': self.keys, prefix + '_offsets': self.offsets,
+                prefix + '_words': self.next_words, prefix + '_counts': self.counts}
+
+    def from_arrays(self, arrays, prefix):
+        self.keys = arrays[prefix + '_keys']
+        self.offsets = arrays[prefix + '_offsets']
+        self.next_words = arrays[prefix + '_words']
+        self.counts = arrays[prefix + '_counts']
+        self.overlay = {}
+        self.overlay_size = 0
+
+def save_ngrams(path, seq, vocabulary, stores):
+    # Writes the vocabulary and n-gram arrays to a compressed .npz, through a
+    # temp file renamed into place; seq is the model log position it includes
+    import numpy as np
+    arrays = {'seq': np.array([seq], dtype=np.int64),
+              'vocabulary': np.frombuffer('\0'.join(vocabulary.words).encode('utf-8'), dtype=np.uint8)}
+    for name, store in stores.items():
+        arrays.update(store.to_arrays(name))
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez_compressed(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def load_ngrams(path, vocabulary, stores):
+    # Loads what save_ngrams wrote; returns its log position, or None when
+    # there is no (readable) file
+    try:
+        import numpy as np
+        with np.load(path) as arrays:
+            text = arrays['vocabulary'].tobytes().decode('utf-8')
+            for word in (text.split('\0') if text else []):
+                vocabulary.add(word)
+            for name, store in stores.items():
+                store.from_arrays(arrays, name)
+            return int(arrays['seq'][0])
+    except (OSError, ValueError, KeyError, ImportError):
+        return None
+
+class WriteBehindStore:
+    # Persists a model as a JSON snapshot plus an append-only log of deltas.
+    # Deltas are buffered in memory and appended in batches by flush(); once
+    # the log grows past compact_after bytes the owner writes a new snapshot
+    # with compact(). Snapshots go to a temp file that is renamed into place,
+    # and record the last log sequence number they include, so a crash at
+    # any point leaves either the old or the new state on disk, never a
+    # truncated file or deltas applied twice.
+    def __init__(self, path, compact_after=1 << 20):
+        self.path = path
+        self.log_path = path + ".log"
+        self.compact_after = compact_after
+        self.seq = 0
+        self.pending = []
+        # Length of the log's good lines when it ends in a torn one
+        self.torn_at = None
+
+    def load(self, with_seq=False):
+        # Returns the snapshot payload (or None) and the deltas logged after
+        # it, as (seq, delta) pairs with with_seq
+        payload, snapshot_seq = None, 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict) and set(data) == {"seq", "data"}:
+                payload, snapshot_seq = data["data"], data["seq"]
+            else:
+                # Plain file written before the log existed
+                payload = data
+        except (OSError, ValueError):
+            pass
+        
+        deltas = []
+        self.seq = snapshot_seq
+        try:
+            with open(self.log_path, "rb") as f:
+                good = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        seq, delta = json.loads(line)
+                    except ValueError:
+                        break
+                    good += len(line)
+                    if seq > snapshot_seq:
+                        deltas.append((seq, delta) if with_seq else delta)
+                        self.seq = seq
+                # A crash mid-append can leave a torn last line. The next
+                # write cuts it off, so loading works on a read-only log.
+                f.seek(0, os.SEEK_END)
+                self.torn_at = good if f.tell() > good else None
+        except OSError:
+            pass
+        return payload, deltas
+
+    def record(self, delta):
+        self.seq += 1
+        self.pending.append((self.seq, delta))
+
+    def flush(self):
+        if not self.pending:
+            return
+        lines = ''.join(json.dumps(entry) + '\n' for entry in self.pending)
+        self.pending = []
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            if self.torn_at is not None:
+                f.truncate(self.torn_at)
+                self.torn_at = None
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def needs_compaction(self):
+        try:
+            return os.path.getsize(self.log_path) >= self.compact_after
+        except OSError:
+            return False
+
+    def compact(self, payload):
+        # payload must already include every delta recorded so far
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"seq": self.seq, "data": payload}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.pending = []
+        self.torn_at = None
+        with open(self.log_path, "w", encoding="utf-8"):
+            pass
+
+process_spell_checker = None
+
+def find_misspelled_spans(text, base=0, spell=None):
+    # Tokenises text in a single pass and returns the (start, end) offsets of
+    # misspelled words, shifted by base. Each distinct word is only looked up
+    # once. Without a spell checker, one is created per process so this can
+    # run in a process pool.
+    global process_spell_checker
+    if spell is None:
+        if process_spell_checker is None:
+            process_spell_checker = create_spell_checker()
+        spell = process_spell_checker
+    
+    verdicts = {}
+    spans = []
+    for match in WORD_PATTERN.finditer(text):
+        word = match.group()
+        misspelled = verdicts.get(word)
+        if misspelled is None:
+            misspelled = verdicts[word] = word.lower() not in spell
+        if misspelled:
+            spans.append((base + match.start(), base + match.end()))
+    return spans
+
+def split_text(text, chunk_size):
+    # (offset, chunk) pieces of text, each cut at whitespace so no word is split
+    start = 0
+    while start < len(text):
+        match = WHITESPACE_PATTERN.search(text, start + chunk_size)
+        end = match.end() if match else len(text)
+        yield start, text[start:end]
+        start = end
+
+def process_pool(workers=None):
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(PROCESS_START_METHOD))
+
+class ProfileSpan:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+class Profiler:
+    # Timing spans for the editor's stages, kept as rolling per-stage windows
+    # of recent timings plus a bounded list of trace events. Spans can be
+    # recorded from any thread. The trace exports in the Chrome trace event
+    # format, which chrome://tracing and ui.perfetto.dev open directly.
+    def __init__(self, window=PROFILE_WINDOW, trace_events=PROFILE_TRACE_EVENTS):
+        self.window = window
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counts = Counter()
+        self.events = deque(maxlen=trace_events)
+        self.counters = {}
+        self.pid = os.getpid()
+
+    def span(self, name):
+        # with profiler.span("stage"): ...
+        return ProfileSpan(self, name)
+
+    def record(self, name, start, end):
+        # Timestamps come from time.perf_counter()
+        with self.lock:
+            timings = self.timings.get(name)
+            if timings is None:
+                timings = self.timings[name] = deque(maxlen=self.window)
+            timings.append(end - start)
+            self.counts[name] += 1
+            self.events.append((name, start, end, threading.get_ident()))
+
+    def set_counters(self, counters):
+        with self.lock:
+            now = time.perf_counter()
+            self.counters.update(counters)
+            self.events.append(('counters', now, None, dict(counters)))
+
+    def stats(self):
+        # {stage: {'count', 'p50_ms', 'p99_ms', 'max_ms'}} over each window
+        with self.lock:
+            windows = {name: sorted(timings) for name, timings in self.timings.items()}
+            counts = dict(self.counts)
+        stats = {}
+        for name, ordered in windows.items():
+            stats[name] = {
+                'count': counts[name],
+                'p50_ms': ordered[len(ordered) // 2] * 1000,
+                'p99_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+                'max_ms': ordered[-1] * 1000,
+            }
+        return stats
+
+    def export_trace(self, path):
+        with self.lock:
+            events = list(self.events)
+        trace = []
+        for name, start, end, detail in events:
+            if end is None:
+                trace.append({'name': name, 'ph': 'C', 'ts': start * 1e6, 'pid': self.pid, 'args': detail})
+            else:
+                trace.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                              'pid': self.pid, 'tid': detail})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        return len(trace)
+
+class TextEngine:
+    # Spell checker, word frequencies, fuzzy and prefix indexes, n-gram models
+    # and the sentence index, with everything that learns from or queries
+    # them. Not thread-safe: the editor only calls it from its worker thread,
+    # except for the spell checker, which is guarded by a lock.
+    def __init__(self, model_dir='.', profiler=None, budgets=None):
+        self.profiler = profiler or Profiler()
+        self.budgets = dict(MODEL_BUDGETS, **(budgets or {}))
+        self.spell_checker = None
+        self.spell_lock = threading.Lock()
+        self.word_frequency = defaultdict(int)
+        self.word_sketch = CountMinSketch()
+        self.frequency_store = WriteBehindStore(os.path.join(model_dir, "word_frequency.json"))
+        
+        # Fuzzy lookup indexes over the spell dictionary and the user's words
+        self.dictionary_index = SymSpellIndex(max_words=DICTIONARY_INDEX_SIZE)
+        self.dictionary_index_path = os.path.join(model_dir, DICTIONARY_INDEX_FILE)
+        self.vocabulary_index = SymSpellIndex()
+        
+        # Frequency-ranked completions of the user's words
+        self.completion_index = PrefixIndex()
+        
+        # Memoized suggestions. Dictionary corrections and synonyms never
+        # depend on what the user types; ranked lists depend on the counts of
+        # the words that complete them or are within edit distance, so the
+        # cached queries are kept in a fuzzy index to find those quickly.
+        self.spelling_cache = SuggestionCache()
+        self.synonym_cache = SuggestionCache()
+        self.cached_queries = SymSpellIndex(max_words=SUGGESTION_CACHE_SIZE + 1)
+        self.suggestion_cache = SuggestionCache(on_evict=self.cached_queries.remove)
+        
+        # Initialize ML models
+        self.initialize_ml_models(model_dir)
+
+    def initialize_ml_models(self, model_dir='.'):
+        # Initialize n-gram models over one shared vocabulary
+        self.ngram_vocabulary = Vocabulary()
+        self.ngram_vocabulary_limit = self.budgets['vocabulary']
+        self.bigrams = NgramStore(2, self.ngram_vocabulary, budget=self.budgets['bigrams'])
+        self.trigrams = NgramStore(3, self.ngram_vocabulary, budget=self.budgets['trigrams'])
+        self.ngram_path = os.path.join(model_dir, "ml_models.npz")
+        
+        # Initialize TF-IDF sentence index for sentence similarity
+        self.sentence_index = SentenceIndex(self.budgets['sentences'])
+        
+        # Paragraphs of the open document the models have already learned from
+        self.document_paragraphs = []
+        
+        self.model_store = WriteBehindStore(os.path.join(model_dir, "ml_models.json"))
+
+    @property
+    def spell(self):
+        # Loading the dictionary takes a while, so it happens on first use
+        # (normally while building the word indexes)
+        with self.spell_lock:
+            if self.spell_checker is None:
+                self.spell_checker = create_spell_checker()
+            return self.spell_checker
+
+    def load(self):
+        # Load the saved models and build the indexes suggestions come from
+        self.load_word_frequency()
+        self.load_ml_models()
+        self.set_budgets({})
+        self.build_word_indexes()
+
+    def set_budgets(self, budgets):
+        # Change memory budgets at run time and enforce them straight away
+        self.budgets.update(budgets)
+        self.bigrams.budget = self.budgets['bigrams']
+        self.trigrams.budget = self.budgets['trigrams']
+        self.bigrams.merge()
+        self.trigrams.merge()
+        self.sentence_index.max_sentences = self.budgets['sentences']
+        while len(self.sentence_index) > self.sentence_index.max_sentences:
+            self.sentence_index.discard(next(iter(self.sentence_index.sentences)))
+        self.enforce_vocabulary_budget()
+
+    def learn_word(self, word):
+        count = 1
+        if word not in self.word_frequency and self.word_sketch.table is not None:
+            # A word evicted earlier gets back its approximate count
+            count += int(float(self.word_sketch.estimate(word_keys([word]))[0]) + 0.5)
+        # Re-inserting keeps the frequencies in least recently learned order
+        self.word_frequency[word] = self.word_frequency.pop(word, 0) + count
+        self.vocabulary_index.add(word, count)
+        self.completion_index.add(word, count)
+        self.frequency_store.record({word: count})
+        self.invalidate_suggestions(word)
+        if len(self.word_frequency) > self.budgets['vocabulary']:
+            self.enforce_vocabulary_budget()
+
+    def enforce_vocabulary_budget(self, decay=DECAY_FACTOR):
+        # Age every count by decay, then evict the least frequent words, the
+        # least recently learned first among equal counts, from the
+        # frequencies and both indexes until the vocabulary is down to the
+        # low-water mark of its budget
+        if len(self.word_frequency) <= self.budgets['vocabulary']:
+            return
+        if decay != 1:
+            for word, count in self.word_frequency.items():
+                self.word_frequency[word] = int(count * decay + 0.5)
+            self.vocabulary_index.set_counts(self.word_frequency)
+        excess = len(self.word_frequency) - int(self.budgets['vocabulary'] * BUDGET_LOW_WATER)
+        # sorted() is stable, so equal counts stay in insertion order
+        evicted = sorted(self.word_frequency.items(), key=lambda item: item[1])[:excess]
+        for word, count in evicted:
+            del self.word_frequency[word]
+            self.vocabulary_index.remove(word)
+        self.word_sketch.decay(decay)
+        self.word_sketch.add(word_keys([word for word, count in evicted]),
+                             [count for word, count in evicted])
+        self.completion_index.load(self.word_frequency)
+        self.suggestion_cache.clear()
+        # The logged deltas would bring the evicted words back
+        self.save_word_frequency()
+
+    def enforce_ngram_vocabulary(self):
+        # Words evicted from every n-gram still hold an id; once they are at
+        # least half the shared vocabulary, compact it
+        if len(self.ngram_vocabulary) <= self.ngram_vocabulary_limit:
+            return
+        import numpy as np
+        used = np.union1d(self.bigrams.used_words(), self.trigrams.used_words())
+        if len(used) * 2 <= len(self.ngram_vocabulary):
+            mapping = np.full(len(self.ngram_vocabulary), -1, dtype=np.int64)
+            mapping[used] = np.arange(len(used))
+            self.ngram_vocabulary.keep(used.tolist())
+            self.bigrams.renumber(mapping)
+            self.trigrams.renumber(mapping)
+        self.ngram_vocabulary_limit = max(self.budgets['vocabulary'], 2 * len(self.ngram_vocabulary))
+
+    def build_word_indexes(self):
+        with self.profiler.span("load.dictionary_index"):
+            self.dictionary_index = self.open_dictionary_index()
+        for word, count in list(self.word_frequency.items()):
+            self.vocabulary_index.add(word, count)
+        self.completion_index.load(self.word_frequency)
+        self.suggestion_cache.clear()
+
+    def open_dictionary_index(self):
+        # The saved dictionary index if it was built from this dictionary,
+        # otherwise a newly built and saved one. If it can't be saved, the
+        # index is built in memory, most frequent words first so the size
+        # cap only drops rare ones.
+        dictionary = list(self.spell.word_frequency.items())
+        index = DictionaryIndex.open(self.dictionary_index_path)
+        if (index is not None and len(index) == min(len(dictionary), DICTIONARY_INDEX_SIZE)
+                and index.fingerprint == DictionaryIndex.fingerprint_of(dictionary)):
+            return index
+        # Unmap the stale file so it can be replaced
+        index = None
+        try:
+            DictionaryIndex.write(self.dictionary_index_path, dictionary)
+            index = DictionaryIndex.open(self.dictionary_index_path)
+        except OSError:
+            pass
+        if index is not None:
+            return index
+        index = SymSpellIndex(max_words=DICTIONARY_INDEX_SIZE)
+        for word, count in sorted(dictionary, key=lambda item: item[1], reverse=True):
+            if not index.add(word, count):
+                break
+        return index
+
+    def get_suggestions(self, word):
+        suggestions = list(self.suggestion_cache.get(word.lower(), self.rank_suggestions))
+        
+        # Add wordnet synonyms
+        with self.profiler.span("suggest.wordnet"):
+            suggestions.extend(self.synonym_cache.get(word, synonyms))
+        
+        # Drop duplicates but keep the ranking
+        return list(dict.fromkeys(suggestions))
+
+    def rank_suggestions(self, word_lower):
+        self.cached_queries.add(word_lower)
+        suggestions = []
+        
+        # Add completions of the word, most frequent first
+        with self.profiler.span("suggest.completions"):
+            suggestions.extend(self.completion_index.complete(word_lower))
+        
+        # Add similar words from the user's typing history
+        with self.profiler.span("suggest.vocabulary"):
+            suggestions.extend(w for w, distance in self.vocabulary_index.lookup(word_lower))
+        
+        # Add spell checker suggestions: the closest dictionary words
+        with self.profiler.span("suggest.spelling"):
+            suggestions.extend(self.spelling_cache.get(word_lower, self.spelling_corrections))
+        return suggestions
+
+    def spelling_corrections(self, word_lower):
+        if word_lower in self.spell:
+            return []
+        # Only the closest corrections are kept, so the search can stop at
+        # the first distance that has any
+        matches = self.dictionary_index.lookup(word_lower, nearest=True)
+        if not matches:
+            return []
+        closest = matches[0][1]
+        return [w for w, distance in matches if distance == closest]
+
+    def invalidate_suggestions(self, word):
+        # Drop the cached lists a change to word's count can affect: those
+        # for its prefixes, which it completes, and those for words within
+        # the vocabulary index's edit distance, which it may correct
+        affected = [word[:i] for i in range(len(word) + 1)]
+        affected.extend(query for query, distance in
+                        self.cached_queries.search(word, self.vocabulary_index.max_distance))
+        self.suggestion_cache.invalidate(affected)
+
+    def get_sentence_suggestions(self, current_sentence):
+        # Next words and similar sentences, as plain strings without repeats,
+        # each kind in its ranked order
+        suggestions = {}
+        
+        # Get n-gram based suggestions
+        with self.profiler.span("sentence.ngrams"):
+            words = tokenize_words(current_sentence.lower())
+            if len(words) >= 2:
+                # Get bigram suggestions
+                suggestions.update((word, None) for word, count in self.bigrams.most_common(words[-1:], 3))
+            
+            if len(words) >= 3:
+                # Get trigram suggestions
+                suggestions.update((word, None) for word, count in self.trigrams.most_common(words[-2:], 3))
+        
+        # Get similar sentences using TF-IDF and cosine similarity
+        with self.profiler.span("sentence.tfidf"):
+            suggestions.update((sentence, None) for sentence in self.sentence_index.similar(current_sentence, 3))
+        
+        return list(suggestions)
+
+    def update_ml_models(self, start, learned_end, paragraphs, record=True):
+        with self.profiler.span("learn.paragraphs"):
+            self.learn_paragraphs(start, learned_end, paragraphs, record)
+
+    def learn_paragraphs(self, start, learned_end, paragraphs, record=True):
+        # Learn from the paragraphs (lines) that replaced learned lines start
+        # to learned_end, un-learning the ones they replaced. Without record
+        # the change is not logged, and is only kept by save_ml_models().
+        old_paragraphs = self.document_paragraphs[start:learned_end]
+        self.document_paragraphs[start:learned_end] = paragraphs
+        first, old_end, new_end = diff_paragraphs(old_paragraphs, paragraphs)
+        if first == old_end and first == new_end:
+            return
+        
+        delta = {'bigrams': [], 'trigrams': [], 'sentences': []}
+        for paragraph in old_paragraphs[first:old_end]:
+            self.learn_paragraph(paragraph, -1, delta)
+        for paragraph in paragraphs[first:new_end]:
+            self.learn_paragraph(paragraph, 1, delta)
+        self.apply_model_delta(delta)
+        self.enforce_ngram_vocabulary()
+        
+        # Queue the change to be saved
+        if record:
+            self.model_store.record(delta)
+
+    def forget_document(self):
+        # Start learning the next document from scratch without un-learning
+        # the current one
+        self.document_paragraphs = []
+
+    def learn_paragraph(self, paragraph, weight, delta):
+        # Collect the changes for adding (weight 1) or removing (weight -1) a
+        # paragraph's n-grams and sentences
+        words = tokenize_words(paragraph.lower())
+        
+        # Update bigrams
+        for bigram in word_ngrams(words, 2):
+            delta['bigrams'].append([bigram[0], bigram[1], weight])
+        
+        # Update trigrams
+        for trigram in word_ngrams(words, 3):
+            delta['trigrams'].append([' '.join(trigram[:2]), trigram[2], weight])
+        
+        # Update sentence model
+        for sentence in tokenize_sentences(paragraph):
+            delta['sentences'].append([sentence, weight])
+
+    def apply_model_delta(self, delta, ngrams=True):
+        # Used both for live learning and for replaying the model log;
+        # trigram contexts are logged as space-joined word pairs
+        if ngrams:
+            for context, word, weight in delta['bigrams']:
+                self.bigrams.add((context,), word, weight)
+            for context, word, weight in delta['trigrams']:
+                self.trigrams.add(context.split(' '), word, weight)
+        
+        for sentence, weight in delta['sentences']:
+            if weight > 0:
+                self.sentence_index.add(sentence)
+            else:
+                self.sentence_index.remove(sentence)
+
+    def load_word_frequency(self):
+        try:
+            counts, deltas = self.frequency_store.load()
+            self.word_frequency = defaultdict(int, counts or {})
+            for delta in deltas:
+                for word, count in delta.items():
+                    self.word_frequency[word] += count
+        except:
+            pass
+
+    def save_word_frequency(self):
+        try:
+            self.frequency_store.compact(dict(self.word_frequency))
+        except:
+            pass
+
+    def load_ml_models(self):
+        # N-grams come from ml_models.npz, sentences from ml_models.json.
+        # The .npz is written first when saving, so it may include log
+        # entries the JSON snapshot does not; those are only replayed into
+        # the sentence index.
+        try:
+            data, deltas = self.model_store.load(with_seq=True)
+            ngram_seq = load_ngrams(self.ngram_path, self.ngram_vocabulary,
+                                    {'bigrams': self.bigrams, 'trigrams': self.trigrams})
+            if data:
+                if ngram_seq is None and 'bigrams' in data:
+                    # Models saved as dicts of counts before the .npz existed
+                    for context, counts in data['bigrams'].items():
+                        for word, count in counts.items():
+                            self.bigrams.add((context,), word, count)
+                    for context, counts in data['trigrams'].items():
+                        for word, count in counts.items():
+                            self.trigrams.add(context.split(' '), word, count)
+                for sentence in data['sentences']:
+                    self.sentence_index.add(sentence)
+            for seq, delta in deltas:
+                self.apply_model_delta(delta, ngrams=ngram_seq is None or seq > ngram_seq)
+        except:
+            pass
+
+    def save_ml_models(self):
+        try:
+            save_ngrams(self.ngram_path, self.model_store.seq, self.ngram_vocabulary,
+                        {'bigrams': self.bigrams, 'trigrams': self.trigrams})
+            self.model_store.compact({'sentences': self.sentence_index.texts()})
+        except:
+            pass
+
+    def flush(self):
+        # Append buffered model changes to disk, compacting logs that grew too long
+        for store, save, name in ((self.frequency_store, self.save_word_frequency, "save.word_frequency"),
+                                  (self.model_store, self.save_ml_models, "save.ml_models")):
+            try:
+                with self.profiler.span(name):
+                    store.flush()
+                    if store.needs_compaction():
+                        save()
+            except OSError:
+                pass
+
+    def memory_counters(self):
+        # Sizes of the models, for the profiler
+        counters = {
+            'vocabulary': len(self.word_frequency),
+            'dictionary_index': len(self.dictionary_index),
+            'ngram_words': len(self.ngram_vocabulary),
+            'bigram_entries': len(self.bigrams),
+            'trigram_entries': len(self.trigrams),
+            'ngram_bytes': self.bigrams.nbytes + self.trigrams.nbytes,
+            'vocabulary_index': len(self.vocabulary_index),
+            'sentences': len(self.sentence_index),
+            'sentence_postings': sum(len(postings) for postings in self.sentence_index.postings.values()),
+        }
+        for name, cache in (('suggestion', self.suggestion_cache), ('spelling', self.spelling_cache),
+                            ('synonym', self.synonym_cache)):
+            counters[f'{name}_cache'] = len(cache)
+            counters[f'{name}_cache_hit_pct'] = round(cache.hit_rate() * 100)
+        self.profiler.set_counters(counters)
+        return counters
+
+    def check_text(self, text):
+        # (start, end) offsets of the misspelled words in one document; long
+        # documents are split at whitespace and checked in a process pool
+        if len(text) < PARALLEL_SPELLCHECK_SIZE:
+            return find_misspelled_spans(text, 0, self.spell)
+        spans = []
+        with process_pool() as pool:
+            chunks = list(split_text(text, SPELLCHECK_CHUNK_SIZE))
+            for chunk_spans in pool.map(find_misspelled_spans, [chunk for offset, chunk in chunks],
+                                        [offset for offset, chunk in chunks]):
+                spans.extend(chunk_spans)
+        return spans
+
+    def analyze(self, text, limit=5, sentences=False, spans=None, cache=None):
+        # Misspelled words of a document with their offsets and suggestions,
+        # and optionally suggestions for each sentence. Suggestions are cached
+        # per word in cache, which can be shared between documents.
+        if spans is None:
+            spans = self.check_text(text)
+        if cache is None:
+            cache = {}
+        
+        misspellings = []
+        for start, end in spans:
+            word = text[start:end]
+            if word not in cache:
+                cache[word] = self.get_suggestions(word)[:limit]
+            misspellings.append({'start': start, 'end': end, 'word': word, 'suggestions': cache[word]})
+        result = {'misspellings': misspellings}
+        
+        if sentences:
+            result['sentences'] = []
+            position = 0
+            for sentence in tokenize_sentences(text):
+                start = text.find(sentence, position)
+                if start < 0:
+                    continue
+                position = start + len(sentence)
+                result['sentences'].append({'start': start, 'end': position,
+                                            'suggestions': self.get_sentence_suggestions(sentence)[:limit]})
+        return result
+
+    def analyze_documents(self, documents, limit=5, sentences=False, processes=None, learn=False):
+        # Yields analyze() results for an iterable of documents, in order.
+        # Documents are spell checked BATCH_SIZE at a time in a process pool
+        # (or inline with processes=1); suggestions are computed here and
+        # cached across the whole run. With learn, the models also learn
+        # from each document; that is not logged, so call save_ml_models()
+        # to keep it.
+        cache = {}
+        pool = process_pool(processes) if processes != 1 else None
+        try:
+            batch = []
+            for document in documents:
+                batch.append(document)
+                if len(batch) >= BATCH_SIZE:
+                    yield from self.analyze_batch(batch, pool, cache, limit, sentences, learn)
+                    batch = []
+            if batch:
+                yield from self.analyze_batch(batch, pool, cache, limit, sentences, learn)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    def analyze_batch(self, batch, pool, cache, limit, sentences, learn):
+        if pool is None:
+            all_spans = [find_misspelled_spans(text, 0, self.spell) for text in batch]
+        else:
+            all_spans = pool.map(find_misspelled_spans, batch, chunksize=max(1, len(batch) // 32))
+        for text, spans in zip(batch, all_spans):
+            result = self.analyze(text, limit, sentences, spans, cache)
+            if learn:
+                self.forget_document()
+                self.update_ml_models(0, 0, text.split('\n'), record=False)
+            yield result
+
+    def analyze_file(self, path, lines=False, encoding='utf-8', **options):
+        # analyze_documents() over a file, either as one document or with each
+        # line as a document; '-' reads standard input
+        if path == '-':
+            return self.analyze_documents(read_documents(sys.stdin, lines), **options)
+        return self.analyze_documents(read_file_documents(path, lines, encoding), **options)
+
+    def train(self, paths, processes=None, progress=None, cancelled=None):
+        # Learn from every text file under paths. Chunks of text are counted
+        # in a process pool (or inline with processes=1) and the counts are
+        # merged into the models here, so memory is bounded by the chunks in
+        # flight and the model budgets. progress(done, total) is called in
+        # bytes after each chunk, and cancelled (a threading.Event) is checked
+        # between chunks. The models are saved when done.
+        files = list(training_files(paths))
+        total = sum(os.path.getsize(path) for path in files)
+        stats = {'files': len(files), 'bytes': 0, 'words': 0, 'sentences': 0}
+        pending = {'bigrams': [], 'trigrams': []}
+        reservoir = []
+        seen = 0
+        rng = random.Random(0)
+        
+        # One worker per CPU by default; Windows allows at most 61
+        workers = processes or min(os.cpu_count() or 1, 61)
+        pool = process_pool(workers) if processes != 1 else None
+        in_flight = deque()
+        chunks = read_training_chunks(files)
+        try:
+            with self.profiler.span("train"):
+                while True:
+                    # Keep the pool busy without reading ahead of it
+                    while len(in_flight) < (2 * workers if pool else 1):
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        text, done = chunk
+                        seed = rng.random()
+                        if pool:
+                            in_flight.append((pool.submit(count_training_text, text, seed), done))
+                        else:
+                            in_flight.append((count_training_text(text, seed), done))
+                    if not in_flight or (cancelled and cancelled.is_set()):
+                        break
+                    
+                    result, done = in_flight.popleft()
+                    if pool:
+                        result = result.result()
+                    seen = self.merge_training_counts(result, pending, reservoir, seen, rng)
+                    stats['bytes'] = done
+                    stats['words'] += result['tokens']
+                    if progress:
+                        progress(done, total)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        
+        self.flush_training_counts(pending)
+        for sentence in reservoir:
+            self.sentence_index.add(sentence)
+        stats['sentences'] = len(reservoir)
+        stats['cancelled'] = bool(cancelled and cancelled.is_set())
+        
+        # Rebuild the word indexes from the merged frequencies
+        for word in self.word_frequency:
+            self.vocabulary_index.add(word, 0)
+        self.vocabulary_index.set_counts(self.word_frequency)
+        self.completion_index.load(self.word_frequency)
+        self.suggestion_cache.clear()
+        self.save_word_frequency()
+        self.save_ml_models()
+        return stats
+
+    def merge_training_counts(self, result, pending, reservoir, seen, rng):
+        # Reduce step of train(): map a chunk's local word numbers to the
+        # shared vocabulary and add its counts; returns the number of
+        # sentences seen so far
+        import numpy as np
+        words = result['words']
+        mapping = np.array([self.ngram_vocabulary.add(word) for word in words], dtype=np.uint64)
+        for word, count in zip(words, result['counts'].tolist()):
+            if count and word.isalpha():
+                self.word_frequency[word] += count
+        if len(self.word_frequency) > self.budgets['vocabulary']:
+            self.enforce_vocabulary_budget(decay=1)
+        
+        bigrams, counts = result['bigrams']
+        pending['bigrams'].append((mapping[bigrams[:, 0]], mapping[bigrams[:, 1]], counts))
+        trigrams, counts = result['trigrams']
+        keys = (mapping[trigrams[:, 0]] << np.uint64(32)) | mapping[trigrams[:, 1]]
+        pending['trigrams'].append((keys, mapping[trigrams[:, 2]], counts))
+        if any(sum(len(part[2]) for part in pending[name]) >= max(NGRAM_MERGE_SIZE, len(store))
+               for name, store in (('bigrams', self.bigrams), ('trigrams', self.trigrams))):
+            self.flush_training_counts(pending)
+        
+        # Keep a uniform sample of the sentences, as many as the index holds
+        for sentence in result['sentences']:
+            seen += 1
+            if len(reservoir) < self.sentence_index.max_sentences:
+                reservoir.append(sentence)
+            else:
+                i = rng.randrange(seen)
+                if i < len(reservoir):
+                    reservoir[i] = sentence
+        return seen
+
+    def flush_training_counts(self, pending):
+        # Merge pending n-gram counts into both stores, and only then compact
+        # the vocabulary, which renumbers the ids the pending counts use
+        import numpy as np
+        for name, store in (('bigrams', self.bigrams), ('trigrams', self.trigrams)):
+            if pending[name]:
+                store.merge(tuple(np.concatenate(column) for column in zip(*pending[name])), decay=1)
+                pending[name] = []
+        self.enforce_ngram_vocabulary()
+
+def read_documents(file, lines=False):
+    if lines:
+        for line in file:
+            yield line.rstrip('\r\n')
+    else:
+        yield file.read()
+
+def read_file_documents(path, lines=False, encoding='utf-8'):
+    with open(path, 'r', encoding=encoding) as file:
+        yield from read_documents(file, lines)
+
+def training_files(paths):
+    # Every file under paths that does not look binary, in a stable order
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirectories, names in os.walk(path):
+                subdirectories.sort()
+                for name in sorted(names):
+                    yield from training_files([os.path.join(directory, name)])
+        elif os.path.isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    if b'\0' in f.read(1024):
+                        continue
+            except OSError:
+                continue
+            yield path
+
+def read_training_chunks(files, chunk_size=TRAINING_CHUNK_SIZE):
+    # (text, bytes read so far) for chunks of whole lines of the files;
+    # unreadable files are skipped
+    done = 0
+    for path in files:
+        try:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                while True:
+                    lines = f.readlines(chunk_size)
+                    if not lines:
+                        break
+                    yield ''.join(lines), done + f.buffer.tell()
+        except OSError:
+            pass
+        done += os.path.getsize(path)
+
+def count_training_text(text, seed):
+    # Map step of train(): word, bigram and trigram counts of one chunk,
+    # over words numbered in order of appearance, plus a sample of its
+    # sentences. Lines are paragraphs, as in the editor.
+    import numpy as np
+    ids = {}
+    tokens = []
+    bigrams = []
+    trigrams = []
+    sentences = []
+    for paragraph in text.split('\n'):
+        if not paragraph.strip():
+            continue
+        numbers = [ids.setdefault(word, len(ids)) for word in tokenize_words(paragraph.lower())]
+        tokens.extend(numbers)
+        bigrams.extend(zip(numbers, numbers[1:]))
+        trigrams.extend(zip(numbers, numbers[1:], numbers[2:]))
+        sentences.extend(tokenize_sentences(paragraph))
+    
+    def count(rows, width):
+        if not rows:
+            return np.zeros((0, width), dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.unique(np.array(rows, dtype=np.int64), axis=0, return_counts=True)
+    
+    if len(sentences) > TRAINING_SENTENCE_SAMPLE:
+        sentences = random.Random(seed).sample(sentences, TRAINING_SENTENCE_SAMPLE)
+    return {
+        'words': list(ids),
+        'counts': np.bincount(np.array(tokens, dtype=np.int64), minlength=len(ids)),
+        'tokens': len(tokens),
+        'bigrams': count(bigrams, 2),
+        'trigrams': count(trigrams, 3),
+        'sentences': sentences,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Spell check documents and suggest corrections without a display. "
+                    "Writes one JSON object per document to standard output.")
+    parser.add_argument("paths", nargs="*", default=["-"],
+                        help="files to analyze, '-' for standard input (default)")
+    parser.add_argument("--lines", action="store_true",
+                        help="treat every line as a separate document")
+    parser.add_argument("--limit", type=int, default=5,
+                        help="suggestions per word or sentence (default 5)")
+    parser.add_argument("--sentences", action="store_true",
+                        help="also suggest sentences for every sentence")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="spell checking processes (default: one per CPU, 1 to disable)")
+    parser.add_argument("--models", default=".",
+                        help="directory holding word_frequency.json and ml_models.json (default .)")
+    parser.add_argument("--learn", action="store_true",
+                        help="learn from the documents as they are analyzed")
+    parser.add_argument("--save", action="store_true",
+                        help="save what was learned back to the model directory")
+    parser.add_argument("--build-synonyms", nargs="?", const=SYNONYM_TABLE_PATH, metavar="PATH",
+                        help="compile WordNet synonyms into a lookup table (default next to this "
+                             "file) and exit")
+    parser.add_argument("--train", nargs="+", metavar="PATH",
+                        help="learn from every text file under these folders or files, save the "
+                             "models to --models and exit")
+    args = parser.parse_args(argv)
+    
+    if args.train:
+        # Training writes the models, so make sure they have somewhere to go
+        os.makedirs(args.models, exist_ok=True)
+        engine = TextEngine(args.models)
+        engine.load()
+        started = time.perf_counter()
+        def progress(done, total):
+            sys.stderr.write(f"\rTraining... {done / max(total, 1):6.1%} "
+                             f"({done / (1 << 20):,.0f} of {total / (1 << 20):,.0f} MB)")
+            sys.stderr.flush()
+        stats = engine.train(args.train, processes=args.jobs, progress=progress)
+        sys.stderr.write(f"\nLearned {stats['words']:,} words from {stats['files']:,} files in "
+                         f"{time.perf_counter() - started:.1f}s\n")
+        return 0
+    
+    if args.build_synonyms:
+        try:
+            count = build_synonym_table(args.build_synonyms)
+        except LookupError as e:
+            parser.error(str(e))
+        print(f"Wrote {count} words to {args.build_synonyms}", file=sys.stderr)
+        return 0
+    
+    engine = TextEngine(args.models)
+    engine.load()
+    out = sys.stdout
+    try:
+        for path in args.paths:
+            results = engine.analyze_file(path, args.lines, limit=args.limit, sentences=args.sentences,
+                                          processes=args.jobs, learn=args.learn)
+            for i, result in enumerate(results):
+                out.write(json.dumps({'source': path, 'document': i, **result}) + '\n')
+    except BrokenPipeError:
+        pass
+    if args.save:
+        engine.save_word_frequency()
+        engine.save_ml_models()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file